@@ -1,7 +1,9 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import Author, Story
+from .models import Author, Story, DeletedStory, ApiToken
 
 admin.site.register(Author)
 admin.site.register(Story)
+admin.site.register(DeletedStory)
+admin.site.register(ApiToken)
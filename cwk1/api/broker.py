@@ -0,0 +1,69 @@
+import asyncio
+import threading
+
+# most new stories queued for one subscriber; a subscriber that falls further behind stops
+# being queued to and catches up from the database at its own pace instead
+QUEUE_SIZE = 256
+
+# subscriptions of this process
+subscriptions = set()
+subscriptionsLock = threading.Lock()
+
+
+# one subscriber's filter and queue of new stories, living on the event loop that serves it
+class Subscription:
+
+    def __init__(self, cat, reg, loop):
+        self.cat = cat
+        self.reg = reg
+        self.loop = loop
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        # set when stories may be missing from the queue, so the subscriber reads them from the database
+        self.lagging = False
+
+    def matches(self, cat, reg):
+        return self.cat in (cat, '*') and self.reg in (reg, '*')
+
+    # queue (id, story) pairs, runs on the subscription's loop
+    def offer(self, items):
+        for item in items:
+            if self.lagging:
+                return
+            try:
+                self.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                self.lagging = True
+
+
+# register a subscription for new stories in a (category, region) filter on the running event loop
+def subscribe(cat, reg):
+    subscription = Subscription(cat, reg, asyncio.get_running_loop())
+    with subscriptionsLock:
+        subscriptions.add(subscription)
+    return subscription
+
+
+def unsubscribe(subscription):
+    with subscriptionsLock:
+        subscriptions.discard(subscription)
+
+
+# hand new stories, as (id, category, region, story) tuples, to every matching subscription
+# safe to call from any thread once the stories are committed
+def publish(stories):
+    with subscriptionsLock:
+        current = list(subscriptions)
+    for subscription in current:
+        items = [(storyId, story) for storyId, cat, reg, story in stories if subscription.matches(cat, reg)]
+        if not items:
+            continue
+        try:
+            subscription.loop.call_soon_threadsafe(subscription.offer, items)
+        except RuntimeError:
+            # the loop serving it has closed
+            unsubscribe(subscription)
+
+
+def subscriberCount():
+    with subscriptionsLock:
+        return len(subscriptions)
@@ -0,0 +1,60 @@
+import gzip
+
+# brotli and zstd are used when their packages are installed ('pip install brotli zstandard'),
+# zstd also comes with Python 3.14 as compression.zstd
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+# smallest body worth compressing, in bytes
+MIN_SIZE = 512
+# content types that are compressed
+COMPRESSIBLE_TYPES = ('application/json', 'application/msgpack', 'application/vnd.news.', 'text/')
+
+# encoding name to compression function, at levels that favour speed over the last few bytes
+ENCODERS = {'gzip': lambda data: gzip.compress(data, compresslevel=6, mtime=0)}
+if brotli is not None:
+    ENCODERS['br'] = lambda data: brotli.compress(data, quality=5)
+if zstd is not None:
+    ENCODERS['zstd'] = lambda data: zstd.compress(data, 3)
+# the order encodings are chosen in when a client accepts several equally
+PREFERENCE = ['zstd', 'br', 'gzip']
+
+
+def compressible(contentType):
+    return contentType.startswith(COMPRESSIBLE_TYPES)
+
+
+# the available encoding a client prefers from its Accept-Encoding header, or None for no compression
+def negotiate(acceptEncoding):
+    accepted = {}
+    for part in acceptEncoding.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip().lower()] = q
+    choices = []
+    for rank, encoding in enumerate(PREFERENCE):
+        if encoding in ENCODERS:
+            q = accepted.get(encoding, accepted.get('*', 0.0))
+            if q > 0:
+                choices.append((q, -rank, encoding))
+    return max(choices)[2] if choices else None
+
+
+def compress(data, encoding):
+    return ENCODERS[encoding](data)
@@ -0,0 +1,76 @@
+import json
+
+# MessagePack formats are served when the msgpack package is installed ('pip install msgpack')
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# format name to media type, compact formats first as they are preferred when a client accepts several equally
+MEDIA_TYPES = {
+    'columnar': 'application/vnd.news.columnar+msgpack',
+    'msgpack': 'application/msgpack',
+    'json': 'application/json',
+}
+# other media types clients send for a format
+ALIASES = {'application/x-msgpack': 'msgpack'}
+
+# story fields in the order of the columnar format
+FIELDS = ('key', 'headline', 'story_cat', 'story_region', 'author', 'story_date', 'story_details')
+# fields whose values repeat across stories, sent as a list of distinct values and an index into it per story
+DICTIONARY_FIELDS = ('story_cat', 'story_region', 'author', 'story_date')
+
+
+def available(name):
+    return name == 'json' or (name in MEDIA_TYPES and msgpack is not None)
+
+
+# the format to send: the format parameter if given (None if it is not available), otherwise the best available
+# match for the Accept header, falling back to JSON when nothing else is acceptable
+def negotiate(accept, formatParam=None):
+    if formatParam is not None:
+        return formatParam if available(formatParam) else None
+    choices = []
+    for part in accept.split(','):
+        mediaType, _, params = part.strip().partition(';')
+        mediaType = mediaType.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        name = ALIASES.get(mediaType) or next((name for name, media in MEDIA_TYPES.items() if media == mediaType), None)
+        # a wildcard stands for JSON, and loses to a named type of the same quality
+        specific = 1
+        if name is None and mediaType in ('*/*', 'application/*'):
+            name, specific = 'json', 0
+        if name is not None and q > 0 and available(name):
+            choices.append((q, specific, -list(MEDIA_TYPES).index(name), name))
+    return max(choices)[3] if choices else 'json'
+
+
+# stories as columns, with each dictionary field as its distinct values and an index into them per story
+def columns(stories):
+    result = {'count': len(stories)}
+    for field in FIELDS:
+        values = [story[field] for story in stories]
+        if field == 'key':
+            values = [int(value) for value in values]
+        if field in DICTIONARY_FIELDS:
+            codes = {}
+            indexes = [codes.setdefault(value, len(codes)) for value in values]
+            result[field] = {'values': list(codes), 'indexes': indexes}
+        else:
+            result[field] = values
+    return result
+
+
+# a {"stories": [...], ...} payload in a format, as bytes or a string
+def encode(payload, name):
+    if name == 'json':
+        return json.dumps(payload)
+    if name == 'columnar':
+        payload = dict(payload, stories=columns(payload['stories']))
+    return msgpack.packb(payload)
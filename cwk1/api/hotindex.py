@@ -0,0 +1,222 @@
+from django.conf import settings
+
+from asgiref.sync import sync_to_async
+
+from .models import Story, DeletedStory
+
+from array import array
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import sys
+import threading
+
+# story columns held for each story, the same as views.STORY_FIELDS
+FIELDS = ('id', 'headline', 'category', 'region', 'author__user__username', 'date', 'details')
+
+# a story's position in its bucket is (date ordinal << ID_BITS) | id, so one integer sorts by date then id
+ID_BITS = 40
+ID_MASK = (1 << ID_BITS) - 1
+
+# the index of this process, built by the first request that needs it
+index = None
+# held while the index is read or changed
+indexLock = threading.Lock()
+# held while the index is built or caught up with the database, so only one thread does it at a time
+refreshLock = threading.Lock()
+
+# counters for this process
+stats = {'hits': 0, 'misses': 0, 'builds': 0, 'catch_ups': 0}
+
+
+def sortKey(storyDate, storyId):
+    return (storyDate.toordinal() << ID_BITS) | storyId
+
+
+# the first day the index should hold, HOT_INDEX_DAYS days back including today
+def cutoff():
+    return datetime.now().date() - timedelta(days=settings.HOT_INDEX_DAYS - 1)
+
+
+# one story in the index, with repeated strings and dates shared between stories
+class HotStory:
+    __slots__ = ('id', 'headline', 'category', 'region', 'author', 'date', 'details')
+
+    def __init__(self, row, dates):
+        self.id = row['id']
+        self.headline = row['headline']
+        self.category = sys.intern(row['category'])
+        self.region = sys.intern(row['region'])
+        self.author = sys.intern(row['author__user__username'])
+        self.date = dates.setdefault(row['date'], row['date'])
+        self.details = row['details']
+
+    # the story as a row of FIELDS, as read from the database
+    def row(self):
+        return {'id': self.id, 'headline': self.headline, 'category': self.category, 'region': self.region,
+                'author__user__username': self.author, 'date': self.date, 'details': self.details}
+
+
+# every story dated on or after 'since', as a sorted array of positions per (category, region) and the stories by id
+class HotIndex:
+
+    def __init__(self, since):
+        self.since = since
+        self.buckets = {(cat, reg): array('q') for cat, _ in Story.categoryTypes for reg, _ in Story.regionTypes}
+        self.stories = {}
+        self.dates = {}
+        # the last story id and deleted story log id read from the database
+        self.lastStoryId = 0
+        self.lastDeletedId = 0
+
+    def add(self, row):
+        if row['date'] < self.since or row['id'] in self.stories:
+            return
+        story = HotStory(row, self.dates)
+        self.stories[story.id] = story
+        # new stories are the newest, so this is nearly always an append
+        insort(self.buckets[(story.category, story.region)], sortKey(story.date, story.id))
+
+    def remove(self, storyId):
+        story = self.stories.pop(storyId, None)
+        if story is None:
+            return
+        bucket = self.buckets[(story.category, story.region)]
+        position = bisect_left(bucket, sortKey(story.date, story.id))
+        if position < len(bucket) and bucket[position] & ID_MASK == storyId:
+            del bucket[position]
+
+    # drop the stories dated before a day, moving the start of the index on to it
+    def dropBefore(self, since):
+        if since <= self.since:
+            return
+        self.since = since
+        sinceKey = sortKey(since, 0)
+        for bucket in self.buckets.values():
+            end = bisect_left(bucket, sinceKey)
+            for position in range(end):
+                del self.stories[bucket[position] & ID_MASK]
+            del bucket[:end]
+        self.dates = {storyDate: storyDate for storyDate in self.dates if storyDate >= since}
+
+    # keep memory bounded by dropping whole days, oldest first, until at most HOT_INDEX_MAX_STORIES remain
+    def trim(self):
+        while len(self.stories) > settings.HOT_INDEX_MAX_STORIES:
+            oldest = min(bucket[0] for bucket in self.buckets.values() if bucket) >> ID_BITS
+            self.dropBefore(datetime.fromordinal(oldest).date() + timedelta(days=1))
+
+    # whether every change up to a change sequence (see storycache.changeSequence) has been read
+    def caughtUp(self, sequence):
+        return self.lastStoryId >= sequence[0] and self.lastDeletedId >= sequence[1] and self.since >= cutoff()
+
+    # up to 'limit' rows newest first in a (category, region) filter, dated on or after fromDate (None for any date)
+    # and after a (date, id) cursor, or None if stories outside the index could be among them
+    def query(self, cat, reg, fromDate, limit, after):
+        lower = sortKey(max(fromDate, self.since) if fromDate is not None else self.since, 0)
+        upper = sortKey(*after) if after is not None else sys.maxsize
+        positions = []
+        for (bucketCat, bucketReg), bucket in self.buckets.items():
+            if cat in (bucketCat, '*') and reg in (bucketReg, '*'):
+                start, end = bisect_left(bucket, lower), bisect_left(bucket, upper)
+                positions.append(map(bucket.__getitem__, range(end - 1, start - 1, -1)))
+        found = list(itertools.islice(heapq.merge(*positions, reverse=True), limit))
+        # the answer is only complete if the filter starts inside the index or the stories in it fill the page
+        if (fromDate is None or fromDate < self.since) and (limit is None or len(found) < limit):
+            return None
+        return [self.stories[position & ID_MASK].row() for position in found]
+
+
+# the latest story id and deleted story log id, read before the stories so nothing falls between them
+def lastIds():
+    lastStoryId = Story.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    lastDeletedId = DeletedStory.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    return lastStoryId, lastDeletedId
+
+
+# a new index of the stories since the cutoff, holding at most HOT_INDEX_MAX_STORIES
+def build():
+    hot = HotIndex(cutoff())
+    hot.lastStoryId, hot.lastDeletedId = lastIds()
+    rows = list(Story.objects.filter(date__gte=hot.since).order_by('-date', '-id').values(*FIELDS)[:settings.HOT_INDEX_MAX_STORIES + 1])
+    # add oldest first so every story is appended
+    for row in reversed(rows):
+        hot.add(row)
+    hot.trim()
+    return hot
+
+
+# bring the index up to a change sequence read from the database (the newest story id and deleted story log id),
+# building it if there is none; changes made by this process are already in it, and changes made by any process
+# are read from the stories and the deleted story log between the last ids seen and the sequence, the same way
+# as the changes feed, so the index follows the database rather than anything kept in this process
+def refresh(sequence):
+    global index
+    with refreshLock:
+        hot = index
+        if hot is not None and hot.caughtUp(sequence):
+            return hot
+        if hot is None:
+            hot = build()
+            with indexLock:
+                index = hot
+                stats['builds'] += 1
+            return hot
+        lastStoryId, lastDeletedId = sequence
+        created = list(Story.objects.filter(id__gt=hot.lastStoryId, id__lte=lastStoryId, date__gte=hot.since).order_by('id').values(*FIELDS))
+        deleted = list(DeletedStory.objects.filter(id__gt=hot.lastDeletedId, id__lte=lastDeletedId).values_list('key', flat=True))
+        with indexLock:
+            for row in created:
+                hot.add(row)
+            for storyId in deleted:
+                hot.remove(storyId)
+            hot.dropBefore(cutoff())
+            hot.trim()
+            hot.lastStoryId, hot.lastDeletedId = max(hot.lastStoryId, lastStoryId), max(hot.lastDeletedId, lastDeletedId)
+            stats['catch_ups'] += 1
+        return hot
+
+
+# up to 'limit' rows of a stories filter newest first (all of them if limit is None), from the index without reading
+# the database, or None if the index is turned off or does not hold every story the answer needs
+# sequence is the change sequence the request read (storycache.syncVersions), and the index is caught up to it first
+async def lookup(cat, reg, fromDate, limit, after, sequence):
+    if settings.HOT_INDEX_DAYS <= 0 or (fromDate is None and limit is None):
+        return None
+    hot = index
+    if hot is None or not hot.caughtUp(sequence):
+        hot = await sync_to_async(refresh)(sequence)
+    with indexLock:
+        rows = hot.query(cat, reg, fromDate, limit, after)
+        stats['misses' if rows is None else 'hits'] += 1
+    return rows
+
+
+# add new stories, as rows of FIELDS, once they are committed
+def add(rows):
+    with indexLock:
+        if index is not None:
+            for row in rows:
+                index.add(row)
+            index.trim()
+
+
+# remove deleted stories by id once the deletion is committed
+def remove(storyIds):
+    with indexLock:
+        if index is not None:
+            for storyId in storyIds:
+                index.remove(storyId)
+
+
+# drop the index, so the next request builds it again from the database
+def reset():
+    global index
+    with refreshLock, indexLock:
+        index = None
+
+
+# copy of the counters with the number of stories held
+def getStats():
+    with indexLock:
+        return dict(stats, stories=len(index.stories) if index is not None else 0)
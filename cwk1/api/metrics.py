@@ -0,0 +1,103 @@
+import threading
+
+# upper bounds of the histogram buckets for each measurement
+DURATION_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+QUERY_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100]
+SIZE_BUCKETS = [100, 1000, 10000, 100000, 1000000, 10000000]
+
+# name, help text and buckets of each histogram, kept per view
+HISTOGRAMS = {
+    'news_request_duration_seconds': ('Wall time of each request.', DURATION_BUCKETS),
+    'news_db_queries': ('Database queries run by each request.', QUERY_BUCKETS),
+    'news_db_duration_seconds': ('Time spent in database queries by each request.', DURATION_BUCKETS),
+    'news_response_size_bytes': ('Size of each buffered response body.', SIZE_BUCKETS),
+}
+QUANTILES = [0.5, 0.95, 0.99]
+
+
+# cumulative bucket counts with a sum, as in a Prometheus histogram
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    # estimate a quantile by interpolating inside the bucket it falls in
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count > 0:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                # the overflow bucket has no upper bound, so report its lower bound
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+# histograms for every (name, view), shared by all threads of this process
+histograms = {}
+lock = threading.Lock()
+
+
+# record the measurements of one request to a view
+def record(view, duration, queries, queryTime, size=None):
+    values = {
+        'news_request_duration_seconds': duration,
+        'news_db_queries': queries,
+        'news_db_duration_seconds': queryTime,
+        'news_response_size_bytes': size,
+    }
+    with lock:
+        for name, value in values.items():
+            if value is None:
+                continue
+            key = (name, view)
+            if key not in histograms:
+                histograms[key] = Histogram(HISTOGRAMS[name][1])
+            histograms[key].observe(value)
+
+
+# every histogram in the Prometheus text format, with in-process quantile estimates as gauges
+def prometheusText():
+    lines = []
+    with lock:
+        for name, (helpText, buckets) in HISTOGRAMS.items():
+            views = sorted(view for histogramName, view in histograms if histogramName == name)
+            lines.append('# HELP ' + name + ' ' + helpText)
+            lines.append('# TYPE ' + name + ' histogram')
+            for view in views:
+                histogram = histograms[(name, view)]
+                cumulative = 0
+                for bound, count in zip(buckets + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{view="%s",le="%s"} %d' % (name, view, bound, cumulative))
+                lines.append('%s_sum{view="%s"} %s' % (name, view, repr(histogram.sum)))
+                lines.append('%s_count{view="%s"} %d' % (name, view, histogram.count))
+            lines.append('# HELP ' + name + '_quantile Estimated quantiles of ' + name + ' in this process.')
+            lines.append('# TYPE ' + name + '_quantile gauge')
+            for view in views:
+                for q in QUANTILES:
+                    lines.append('%s_quantile{view="%s",quantile="%s"} %s' % (name, view, q, repr(histograms[(name, view)].quantile(q))))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    with lock:
+        histograms.clear()
@@ -0,0 +1,197 @@
+from django.db import connection
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+from . import compression, metrics, storycache, tokens
+
+import time
+
+
+# counts and times the database queries run while it is installed with connection.execute_wrapper
+class QueryTimer:
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += time.perf_counter() - start
+
+
+# install and remove a query wrapper on the calling thread's connection
+def addWrapper(wrapper):
+    connection.execute_wrappers.append(wrapper)
+
+
+def removeWrapper(wrapper):
+    connection.execute_wrappers.remove(wrapper)
+
+
+# records wall time, database queries and response size of every request per view,
+# adds them to the response as a Server-Timing header and to the histograms in api/metrics.py
+# (queries run while a streamed response is sent come after the response leaves and are not counted)
+# it runs in async mode under ASGI so async views are not pushed onto a thread
+class TimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.timeAsync(request)
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        return self.finish(request, response, timer, time.perf_counter() - start)
+
+    async def timeAsync(self, request):
+        timer = QueryTimer()
+        start = time.perf_counter()
+        # connections belong to a thread, so the timer goes on the connection of the thread that
+        # runs this request's ORM calls (the same thread for every sync_to_async call of a request)
+        await sync_to_async(addWrapper)(timer)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(removeWrapper)(timer)
+        return self.finish(request, response, timer, time.perf_counter() - start)
+
+    def finish(self, request, response, timer, duration):
+        size = None if response.streaming else len(response.content)
+        # the view that handled the request, read after the fact so no process_view hook is needed
+        match = getattr(request, 'resolver_match', None)
+        viewName = getattr(match.func, '__name__', 'unknown') if match is not None else 'unmatched'
+        metrics.record(viewName, duration, timer.count, timer.time, size)
+        response['Server-Timing'] = 'total;dur=%.3f, db;dur=%.3f;desc="%d queries"' % (duration * 1000, timer.time * 1000, timer.count)
+        return response
+
+
+# compresses responses for clients that accept it (zstd, br or gzip, see api/compression.py)
+# a response with an ETag is compressed once per encoding and its bytes reused from the stories cache;
+# streamed responses, such as event streams, are sent as they are
+class CompressionMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.compressAsync(request)
+        return self.encode(request, self.get_response(request))
+
+    # the cached compressed bytes are read and stored with the cache's async methods, off the event loop
+    async def compressAsync(self, request):
+        response = await self.get_response(request)
+        encoding = self.encodingFor(request, response)
+        if encoding is None:
+            return response
+        etag = response.get('ETag')
+        content = await storycache.agetCompressed(request.path, etag, encoding) if etag else None
+        if content is None:
+            content = compression.compress(response.content, encoding)
+            if etag:
+                await storycache.astoreCompressed(request.path, etag, encoding, content)
+        return self.applyEncoding(response, encoding, content)
+
+    def encode(self, request, response):
+        encoding = self.encodingFor(request, response)
+        if encoding is None:
+            return response
+        etag = response.get('ETag')
+        content = storycache.getCompressed(request.path, etag, encoding) if etag else None
+        if content is None:
+            content = compression.compress(response.content, encoding)
+            if etag:
+                storycache.storeCompressed(request.path, etag, encoding, content)
+        return self.applyEncoding(response, encoding, content)
+
+    # the encoding to compress a response with, or None to send it as it is
+    def encodingFor(self, request, response):
+        if response.streaming or response.has_header('Content-Encoding') or not compression.compressible(response.get('Content-Type', '')):
+            return None
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if response.status_code != 200 or len(response.content) < compression.MIN_SIZE:
+            return None
+        return compression.negotiate(request.headers.get('Accept-Encoding', ''))
+
+    def applyEncoding(self, response, encoding, content):
+        if len(content) >= len(response.content):
+            return response
+
+        etag = response.get('ETag')
+        response.content = content
+        response['Content-Length'] = str(len(content))
+        response['Content-Encoding'] = encoding
+        # the compressed bytes differ from the uncompressed ones, so the ETag only matches weakly
+        if etag and not etag.startswith('W/'):
+            response['ETag'] = 'W/' + etag
+        return response
+
+
+# logs in requests that carry an API token ('Authorization: Token <token>', see api/tokens.py) as the token's author,
+# in place of the session; verified tokens come from the token cache, so a request with a known token reads
+# neither the session nor the user from the database, and its author id is kept on the request as tokenAuthorId
+# an unknown or revoked token is refused with 401 before it reaches a view
+class TokenAuthenticationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.authenticateAsync(request)
+        token = tokens.fromHeader(request.headers.get('Authorization', ''))
+        if token is None:
+            return self.get_response(request)
+        identity = tokens.verify(token)
+        if identity is None:
+            return self.refuse()
+        self.login(request, identity)
+        return self.get_response(request)
+
+    async def authenticateAsync(self, request):
+        token = tokens.fromHeader(request.headers.get('Authorization', ''))
+        if token is None:
+            return await self.get_response(request)
+        # only a token missing from the cache needs a thread for the database
+        digest = tokens.digestOf(token)
+        identity = await tokens.acachedIdentity(digest)
+        if identity is None:
+            identity = await sync_to_async(tokens.loadIdentity)(digest)
+        if not identity:
+            return self.refuse()
+        self.login(request, identity)
+        return await self.get_response(request)
+
+    def login(self, request, identity):
+        user, authorId = identity
+
+        async def auser():
+            return user
+
+        request.user = user
+        request.auser = auser
+        request.tokenAuthorId = authorId
+
+    def refuse(self):
+        return HttpResponse("API token is not valid.", status=401, content_type='text/plain')
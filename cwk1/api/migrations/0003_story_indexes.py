@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_auto_20240221_1138'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='story',
+            name='headline',
+            field=models.CharField(max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(fields=['category', 'region', '-date', '-id'], name='story_cat_reg_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(fields=['region', '-date', '-id'], name='story_reg_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(fields=['-date', '-id'], name='story_date_idx'),
+        ),
+    ]
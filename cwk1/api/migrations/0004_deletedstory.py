@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_story_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletedStory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.BigIntegerField()),
+                ('category', models.CharField(choices=[('pol', 'politics'), ('art', 'art'), ('tech', 'technology'), ('trivia', 'trivial')], max_length=6)),
+                ('region', models.CharField(choices=[('uk', 'UK'), ('eu', 'EU'), ('w', 'World')], max_length=2)),
+                ('deleted', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
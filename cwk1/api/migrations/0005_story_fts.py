@@ -0,0 +1,45 @@
+# Full-text index over story headlines and details for the 'q' search parameter (SQLite FTS5)
+
+from django.db import migrations
+
+CREATE_SQL = [
+    "CREATE VIRTUAL TABLE api_story_fts USING fts5(headline, details, content='api_story', content_rowid='id')",
+    # keep the index in step with every insert, update and delete on api_story, including bulk ones
+    "CREATE TRIGGER api_story_fts_insert AFTER INSERT ON api_story BEGIN "
+    "INSERT INTO api_story_fts(rowid, headline, details) VALUES (new.id, new.headline, new.details); END",
+    "CREATE TRIGGER api_story_fts_delete AFTER DELETE ON api_story BEGIN "
+    "INSERT INTO api_story_fts(api_story_fts, rowid, headline, details) VALUES ('delete', old.id, old.headline, old.details); END",
+    "CREATE TRIGGER api_story_fts_update AFTER UPDATE OF headline, details ON api_story BEGIN "
+    "INSERT INTO api_story_fts(api_story_fts, rowid, headline, details) VALUES ('delete', old.id, old.headline, old.details); "
+    "INSERT INTO api_story_fts(rowid, headline, details) VALUES (new.id, new.headline, new.details); END",
+    # index the stories already in the table
+    "INSERT INTO api_story_fts(api_story_fts) VALUES ('rebuild')",
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS api_story_fts_insert",
+    "DROP TRIGGER IF EXISTS api_story_fts_delete",
+    "DROP TRIGGER IF EXISTS api_story_fts_update",
+    "DROP TABLE IF EXISTS api_story_fts",
+]
+
+
+def run(statements):
+    def apply(apps, schema_editor):
+        # search is only available on SQLite
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return apply
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_deletedstory'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(CREATE_SQL), run(DROP_SQL)),
+    ]
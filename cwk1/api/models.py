@@ -19,3 +19,37 @@ class Story(models.Model):
     author = models.ForeignKey(Author, on_delete=models.CASCADE)
     date = models.DateField()
     details = models.CharField(max_length=128)
+
+    class Meta:
+        # composite indexes matching the filters used by the stories view, newest first
+        indexes = [
+            models.Index(fields=['category', 'region', '-date', '-id'], name='story_cat_reg_date_idx'),
+            models.Index(fields=['region', '-date', '-id'], name='story_reg_date_idx'),
+            models.Index(fields=['-date', '-id'], name='story_date_idx'),
+        ]
+
+
+
+# Log of deleted stories, read by the changes feed
+# Story and DeletedStory ids both use AUTOINCREMENT, so they only ever grow and act as change sequences
+class DeletedStory(models.Model):
+    key = models.BigIntegerField()
+    category = models.CharField(max_length=6, choices=Story.categoryTypes)
+    region = models.CharField(max_length=2, choices=Story.regionTypes)
+    deleted = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return str(self.key)
+
+
+# API token of an author, sent as 'Authorization: Token <token>' in place of logging in
+# the token given out is a random secret and the row keeps only its SHA-256 digest; revoking it marks the row
+class ApiToken(models.Model):
+    author = models.ForeignKey(Author, on_delete=models.CASCADE)
+    name = models.CharField(max_length=64, blank=True)
+    digest = models.CharField(max_length=64, unique=True)
+    created = models.DateTimeField(auto_now_add=True)
+    revoked = models.BooleanField(default=False)
+
+    def __str__(self):
+        return str(self.author) + ': ' + (self.name or str(self.id))
@@ -0,0 +1,324 @@
+from django.conf import settings
+from django.http import HttpResponse
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+
+from functools import wraps
+import itertools
+import math
+import sqlite3
+import threading
+import time
+
+# locks of the in-process buckets; a client's bucket is guarded by one of them, chosen by its key,
+# so requests from different clients rarely wait on each other
+STRIPES = 16
+# most buckets kept in each stripe, past which the full ones (idle clients) are dropped, and then the least
+# recently used until PRUNE_TO of them are left
+MAX_BUCKETS_PER_STRIPE = 10000
+PRUNE_TO = 0.9
+# seconds after which an idle bucket in the shared database is deleted (it would have refilled by then)
+SHARED_IDLE_SECONDS = 3600
+# weight of the latest request in a route's moving average of latency
+LATENCY_WEIGHT = 0.1
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600}
+
+# requests refused per (view, reason) in this process
+refused = {}
+refusedLock = threading.Lock()
+
+
+# (tokens per second, bucket size) of a 'count/period' limit such as '120/m', or None for no limit
+# a client can make up to 'count' requests at once, and then one more each time a token is added back
+def parseRate(rate):
+    if rate is None:
+        return None
+    count, _, period = rate.partition('/')
+    return int(count) / PERIODS[period], int(count)
+
+
+# token buckets of this process, by key
+class MemoryBuckets:
+    blocking = False
+
+    def __init__(self, stripes=STRIPES, maxPerStripe=MAX_BUCKETS_PER_STRIPE):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        # key to (tokens left, time of last update, time the bucket is full again), least recently used first
+        self.stripes = [{} for _ in range(stripes)]
+        self.maxPerStripe = maxPerStripe
+
+    # take a token from a bucket, returning 0 if there was one, otherwise the seconds until there is
+    def take(self, key, rate, capacity):
+        now = time.monotonic()
+        stripe = hash(key) % len(self.stripes)
+        with self.locks[stripe]:
+            buckets = self.stripes[stripe]
+            # taken out and put back, so the bucket moves to the most recently used end
+            bucket = buckets.pop(key, None)
+            if bucket is None:
+                if len(buckets) >= self.maxPerStripe:
+                    self.prune(buckets, now)
+                tokens = capacity
+            else:
+                tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if wait == 0.0:
+                tokens -= 1
+            buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            return wait
+
+    # drop the buckets that have refilled, which behave the same as a new one, then the least recently used
+    # until PRUNE_TO of the limit are left, so a client making many new keys cannot reset the bucket of a busy one
+    def prune(self, buckets, now):
+        for key in [key for key, bucket in buckets.items() if bucket[2] <= now]:
+            del buckets[key]
+        excess = len(buckets) - int(self.maxPerStripe * PRUNE_TO)
+        if excess > 0:
+            for key in list(itertools.islice(buckets, excess)):
+                del buckets[key]
+
+    def reset(self):
+        for lock, buckets in zip(self.locks, self.stripes):
+            with lock:
+                buckets.clear()
+
+
+# token buckets in a SQLite file shared by every worker process on the machine (settings.RATE_LIMIT_DB)
+# each take is one short write transaction; if the file cannot be written the request is let through
+class SqliteBuckets:
+    blocking = True
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.takes = 0
+
+    # this thread's connection to the file, making the table on first use
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # the buckets are worth less than the time to sync them to disk
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            self.local.connection = connection
+        return connection
+
+    def take(self, key, rate, capacity):
+        now = time.time()
+        try:
+            connection = self.connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+                wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+                if wait == 0.0:
+                    tokens -= 1
+                connection.execute('INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) '
+                                   'ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated', (key, tokens, now))
+                self.takes += 1
+                if self.takes % 1000 == 0:
+                    connection.execute('DELETE FROM buckets WHERE updated < ?', (now - SHARED_IDLE_SECONDS,))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        except sqlite3.Error:
+            return 0.0
+        return wait
+
+    def reset(self):
+        self.connection().execute('DELETE FROM buckets')
+
+
+# the buckets of this process, or of every process when settings.RATE_LIMIT_DB names a shared file
+bucketStore = None
+bucketStoreLock = threading.Lock()
+
+
+def buckets():
+    global bucketStore
+    if bucketStore is None:
+        with bucketStoreLock:
+            if bucketStore is None:
+                bucketStore = SqliteBuckets(settings.RATE_LIMIT_DB) if settings.RATE_LIMIT_DB else MemoryBuckets()
+    return bucketStore
+
+
+# the address of the client, read from X-Forwarded-For when settings.RATE_LIMIT_TRUSTED_PROXIES
+# proxies (each adding the address it got the request from) stand in front of the server
+def clientAddress(request):
+    proxies = settings.RATE_LIMIT_TRUSTED_PROXIES
+    if proxies:
+        forwarded = [address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',') if address.strip()]
+        if len(forwarded) >= proxies:
+            return forwarded[-proxies]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+# the id of the logged-in user of a request, from its API token or its session, without loading the user
+def userIdOf(request):
+    if getattr(request, 'tokenAuthorId', None) is not None:
+        return request.user.pk
+    if hasattr(request, 'session'):
+        return request.session.get('_auth_user_id')
+    return None
+
+
+# the same for async views, where a session read from the database has to go through a thread
+async def auserIdOf(request):
+    if getattr(request, 'tokenAuthorId', None) is not None:
+        return request.user.pk
+    if hasattr(request, 'session'):
+        return await request.session.aget('_auth_user_id')
+    return None
+
+
+def countRefused(route, reason):
+    with refusedLock:
+        refused[(route, reason)] = refused.get((route, reason), 0) + 1
+
+
+# the seconds a request must wait for its client's bucket, 0 if it may go ahead
+# a logged-in client is limited as its user and any other client by its address, as is a logged-in one on a
+# route with no user rate (such as logging in), so a session does not lift the limit
+def waitFor(request, route, userId, ipRate, userRate):
+    if userId is not None and userRate is not None:
+        key, rate = route + ':user:' + str(userId), userRate
+    else:
+        key, rate = route + ':ip:' + clientAddress(request), ipRate
+    if rate is None:
+        return 0.0
+    return buckets().take(key, *rate)
+
+
+def tooManyRequests(route, wait):
+    countRefused(route, 'rate_limited')
+    response = HttpResponse("Too many requests, please slow down.", status=429, content_type='text/plain')
+    response['Retry-After'] = str(max(1, math.ceil(wait)))
+    return response
+
+
+# sheds load from a route by the number of requests it is running and its recent latency: once its
+# average latency is over SHED_LATENCY_TARGET with at least SHED_MIN_CONCURRENCY requests running, costly
+# requests are refused; at SHED_MAX_CONCURRENCY every request is refused until some finish
+class LoadShedder:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.latency = 0.0
+
+    # start a request if it is admitted, returning False if it should be refused
+    def start(self, costly):
+        with self.lock:
+            if self.running >= settings.SHED_MAX_CONCURRENCY:
+                return False
+            if costly and self.running >= settings.SHED_MIN_CONCURRENCY and self.latency > settings.SHED_LATENCY_TARGET:
+                return False
+            self.running += 1
+            return True
+
+    def finish(self, duration):
+        with self.lock:
+            self.running -= 1
+            self.latency += LATENCY_WEIGHT * (duration - self.latency)
+
+    # finish a request once its response has been sent; a streamed response is mostly made while it is sent,
+    # after the view returns, so it finishes when the server closes it (once, however many times that is)
+    def finishWhenSent(self, response, start):
+        if not response.streaming:
+            self.finish(time.perf_counter() - start)
+            return response
+        close = response.close
+        # taken by the first close only
+        once = threading.Lock()
+
+        def closeAndFinish():
+            try:
+                close()
+            finally:
+                if once.acquire(blocking=False):
+                    self.finish(time.perf_counter() - start)
+
+        response.close = closeAndFinish
+        return response
+
+
+def serviceUnavailable(route):
+    countRefused(route, 'shed')
+    response = HttpResponse("The server is busy, please try again shortly.", status=503, content_type='text/plain')
+    response['Retry-After'] = '1'
+    return response
+
+
+# wrap a view with admission control, for use in urls.py
+# ip and user are 'count/period' limits (period 's', 'm' or 'h') on each client address and each logged-in user,
+# with a bucket per route; costly, if given, is a function of the request that is true for the requests to
+# refuse first when the route is overloaded, and turns on load shedding for the route
+def limited(view, ip=None, user=None, costly=None):
+    route = view.__name__
+    ipRate, userRate = parseRate(ip), parseRate(user)
+    shedder = LoadShedder() if costly is not None else None
+
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if settings.RATE_LIMIT_ENABLED:
+                userId = await auserIdOf(request)
+                if buckets().blocking:
+                    wait = await sync_to_async(waitFor, thread_sensitive=False)(request, route, userId, ipRate, userRate)
+                else:
+                    wait = waitFor(request, route, userId, ipRate, userRate)
+                if wait:
+                    return tooManyRequests(route, wait)
+            if shedder is None:
+                return await view(request, *args, **kwargs)
+            if not shedder.start(costly(request)):
+                return serviceUnavailable(route)
+            start = time.perf_counter()
+            try:
+                response = await view(request, *args, **kwargs)
+            except BaseException:
+                shedder.finish(time.perf_counter() - start)
+                raise
+            return shedder.finishWhenSent(response, start)
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if settings.RATE_LIMIT_ENABLED:
+                wait = waitFor(request, route, userIdOf(request), ipRate, userRate)
+                if wait:
+                    return tooManyRequests(route, wait)
+            if shedder is None:
+                return view(request, *args, **kwargs)
+            if not shedder.start(costly(request)):
+                return serviceUnavailable(route)
+            start = time.perf_counter()
+            try:
+                response = view(request, *args, **kwargs)
+            except BaseException:
+                shedder.finish(time.perf_counter() - start)
+                raise
+            return shedder.finishWhenSent(response, start)
+    wrapper.shedder = shedder
+    return wrapper
+
+
+# refused request counters in the Prometheus text format
+def prometheusText():
+    with refusedLock:
+        current = sorted(refused.items())
+    lines = ['# HELP news_refused_requests_total Requests refused by rate limits (429) or load shedding (503).',
+             '# TYPE news_refused_requests_total counter']
+    for (route, reason), count in current:
+        lines.append('news_refused_requests_total{view="%s",reason="%s"} %d' % (route, reason, count))
+    return '\n'.join(lines) + '\n'
+
+
+# empty the buckets, for tests
+def reset():
+    buckets().reset()
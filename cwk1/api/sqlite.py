@@ -0,0 +1,14 @@
+from django.conf import settings
+
+
+# apply settings.SQLITE_PRAGMAS to a new SQLite connection, on the raw connection so the
+# pragmas are not counted as queries of the request that opened it
+# settings.SQLITE_JOURNAL_MODE is only set when the database is in another mode, as setting it rewrites the file
+def configureConnection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite' or not getattr(settings, 'SQLITE_TUNING', False):
+        return
+    for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+        connection.connection.execute('PRAGMA %s = %s' % (name, value))
+    journalMode = getattr(settings, 'SQLITE_JOURNAL_MODE', None)
+    if journalMode and connection.connection.execute('PRAGMA journal_mode').fetchone()[0].lower() != journalMode.lower():
+        connection.connection.execute('PRAGMA journal_mode = %s' % journalMode)
@@ -0,0 +1,219 @@
+from django.core.cache import caches
+from django.db import connection
+
+from .models import Story, DeletedStory
+
+import hashlib
+import threading
+import time
+
+# name of the cache in settings.CACHES that holds serialized story responses
+CACHE_ALIAS = 'stories'
+
+# hit/miss counters for this process
+stats = {'hits': 0, 'misses': 0, 'compressed_hits': 0, 'compressed_misses': 0}
+statsLock = threading.Lock()
+
+# the change sequence this process last brought the versions up to, None until it first reads it
+seen = None
+seenLock = threading.Lock()
+
+
+# the cache holding responses and filter versions
+def storyCache():
+    return caches[CACHE_ALIAS]
+
+
+# the (category, region) filters whose results change when a story in (cat, reg) is added or removed
+def affectedFilters(cat, reg):
+    return [(cat, reg), (cat, '*'), ('*', reg), ('*', '*')]
+
+
+def versionKey(cat, reg):
+    return 'version:' + cat + ':' + reg
+
+
+# current version of the stories matching a (category, region) filter
+# versions are nanosecond timestamps of the last change, so a version lost to eviction
+# is replaced by a newer one and can never bring back an out of date response
+def getVersion(cat, reg):
+    cache = storyCache()
+    key = versionKey(cat, reg)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key, time.time_ns())
+    return version
+
+
+# the same for async code; the cache backends do their I/O (disk, for the file cache) off the event loop
+async def agetVersion(cat, reg):
+    cache = storyCache()
+    key = versionKey(cat, reg)
+    version = await cache.aget(key)
+    if version is None:
+        await cache.aadd(key, time.time_ns(), timeout=None)
+        version = await cache.aget(key, time.time_ns())
+    return version
+
+
+# version keys of every filter touched by a change to stories in the given (category, region) pairs
+def changedKeys(changed):
+    keys = set()
+    for cat, reg in changed:
+        for filterCat, filterReg in affectedFilters(cat, reg):
+            keys.add(versionKey(filterCat, filterReg))
+    return keys
+
+
+# move on the version of every filter touched by a change to stories in the given (category, region) pairs
+def invalidate(changed):
+    keys = changedKeys(changed)
+    if not keys:
+        return
+    cache = storyCache()
+    current = cache.get_many(keys)
+    now = time.time_ns()
+    cache.set_many({key: max(now, current.get(key, 0) + 1) for key in keys}, timeout=None)
+
+
+async def ainvalidate(changed):
+    keys = changedKeys(changed)
+    if not keys:
+        return
+    cache = storyCache()
+    current = await cache.aget_many(keys)
+    now = time.time_ns()
+    await cache.aset_many({key: max(now, current.get(key, 0) + 1) for key in keys}, timeout=None)
+
+
+# every (category, region) pair a story can have
+def allFilters():
+    return [(cat, reg) for cat, _ in Story.categoryTypes for reg, _ in Story.regionTypes]
+
+
+# the newest story id and deleted story log id; neither kind of id is ever reused (AUTOINCREMENT), and every post
+# or delete, made by any process, raises one of them, so together they are a change sequence for the stories
+def changeSequence():
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT (SELECT MAX(id) FROM ' + Story._meta.db_table + '), (SELECT MAX(id) FROM ' + DeletedStory._meta.db_table + ')')
+        lastStoryId, lastDeletedId = cursor.fetchone()
+    return lastStoryId or 0, lastDeletedId or 0
+
+
+# move on the versions of the filters changed since this process last looked, by this process or any other,
+# returning the current change sequence; the versions are kept per process (or per cache), so without this
+# a post or delete made by another worker would leave this one answering, and sending ETags, for the old stories
+def syncVersions():
+    global seen
+    with seenLock:
+        current = changeSequence()
+        previous = seen
+        if previous == current:
+            return current
+        # the first look, or a change the log cannot explain (a story removed without a tombstone, a restored
+        # database): any filter may have changed
+        if previous is None or current[1] < previous[1] or (current[0] < previous[0] and current[1] == previous[1]):
+            invalidate(allFilters())
+        else:
+            changes = []
+            if current[0] > previous[0]:
+                changes.append(Story.objects.filter(id__gt=previous[0], id__lte=current[0]).values_list('category', 'region'))
+            if current[1] > previous[1]:
+                changes.append(DeletedStory.objects.filter(id__gt=previous[1], id__lte=current[1]).values_list('category', 'region'))
+            changed = changes[0].union(*changes[1:])
+            invalidate(set(changed))
+        seen = current
+        return current
+
+
+# digest of the normalized filter tuple (host, category, region, date, limit, cursor, search, format) and the
+# version of its stories, along with that version; the digest names both the cached response and its ETag
+def filterState(host, cat, reg, date, limit, cursor, search=None, fmt='json'):
+    version = getVersion(cat, reg)
+    return filterDigest(host, cat, reg, date, limit, cursor, search, fmt, version), version
+
+
+async def afilterState(host, cat, reg, date, limit, cursor, search=None, fmt='json'):
+    version = await agetVersion(cat, reg)
+    return filterDigest(host, cat, reg, date, limit, cursor, search, fmt, version), version
+
+
+def filterDigest(host, cat, reg, date, limit, cursor, search, fmt, version):
+    filterTuple = '|'.join([host, cat, reg, date, str(limit), str(cursor), str(search), fmt, str(version)])
+    return hashlib.sha1(filterTuple.encode()).hexdigest()
+
+
+def responseKey(digest):
+    return 'response:' + digest
+
+
+# cached (status, content, content type) for a key, or None on a miss
+def getResponse(key):
+    return countResponse(storyCache().get(key))
+
+
+async def agetResponse(key):
+    return countResponse(await storyCache().aget(key))
+
+
+def countResponse(cached):
+    with statsLock:
+        if cached is None:
+            stats['misses'] += 1
+        else:
+            stats['hits'] += 1
+    return cached
+
+
+def storeResponse(key, status, content, contentType):
+    storyCache().set(key, (status, content, contentType))
+
+
+async def astoreResponse(key, status, content, contentType):
+    await storyCache().aset(key, (status, content, contentType))
+
+
+# compressed bodies are keyed by path, ETag and encoding; an ETag names the exact bytes of a response,
+# so identical responses share one compressed copy that goes out of date along with them
+def compressedKey(path, etag, encoding):
+    return 'compressed:' + encoding + ':' + hashlib.sha1((path + '|' + etag).encode()).hexdigest()
+
+
+# cached compressed body of a response, or None on a miss
+def getCompressed(path, etag, encoding):
+    return countCompressed(storyCache().get(compressedKey(path, etag, encoding)))
+
+
+async def agetCompressed(path, etag, encoding):
+    return countCompressed(await storyCache().aget(compressedKey(path, etag, encoding)))
+
+
+def countCompressed(cached):
+    with statsLock:
+        stats['compressed_misses' if cached is None else 'compressed_hits'] += 1
+    return cached
+
+
+def storeCompressed(path, etag, encoding, content):
+    storyCache().set(compressedKey(path, etag, encoding), content)
+
+
+async def astoreCompressed(path, etag, encoding, content):
+    await storyCache().aset(compressedKey(path, etag, encoding), content)
+
+
+# empty the cache and forget the change sequence, for tests
+def reset():
+    global seen
+    with seenLock:
+        storyCache().clear()
+        seen = None
+
+
+# copy of the counters with the hit ratio
+def getStats():
+    with statsLock:
+        current = dict(stats)
+    total = current['hits'] + current['misses']
+    return dict(current, hit_ratio=current['hits'] / total if total else 0.0)
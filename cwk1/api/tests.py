@@ -1,3 +1,911 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.contrib.auth.models import User
+from django.core import signing
 
-# Create your tests here.
+from .models import Author, Story, ApiToken
+from .views import deleteStory
+from .urls import storiesView
+from . import views, storycache, metrics, broker, compression, formats, hotindex, tokens, ratelimit, sqlite
+
+from datetime import date, timedelta
+from types import SimpleNamespace
+import asyncio
+import gzip
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+
+# helper to create a number of stories, each by a different author
+def makeStories(count, category='pol', region='uk', storyDate=None):
+    stories = []
+    for i in range(count):
+        user = User.objects.create(username='author%d' % Author.objects.count())
+        author = Author.objects.create(user=user)
+        stories.append(Story.objects.create(headline='Headline %d' % i, category=category, region=region, author=author, date=storyDate or date.today(), details='Details %d' % i))
+    storycache.invalidate([(category, region)])
+    return stories
+
+
+# clears the response cache, the hot index and the rate limits, which outlive the database rollback between tests
+class StoriesTestCase(TestCase):
+
+    def setUp(self):
+        storycache.reset()
+        hotindex.reset()
+        ratelimit.reset()
+
+
+# tests for GET /api/stories
+class StoriesGetTests(StoriesTestCase):
+
+    def test_no_stories_returns_404(self):
+        response = self.client.get('/api/stories', {'story_cat': '*', 'story_region': '*', 'story_date': '*'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_author_username_returned(self):
+        makeStories(1)
+        response = self.client.get('/api/stories', {'story_cat': '*', 'story_region': '*', 'story_date': '*'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['stories'][0]['author'], 'author0')
+
+    # the change sequence, the filters changed since it was last read and the stories
+    def test_query_count_constant_as_stories_grow(self):
+        params = {'story_cat': '*', 'story_region': '*', 'story_date': '*'}
+        makeStories(1)
+        self.client.get('/api/stories', params)
+        makeStories(1)
+        with self.assertNumQueries(3):
+            self.client.get('/api/stories', params)
+        makeStories(20)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/stories', params)
+        self.assertEqual(len(response.json()['stories']), 22)
+
+
+# tests for cursor pagination of GET /api/stories
+class StoriesPaginationTests(StoriesTestCase):
+
+    def test_unpaginated_request_has_no_next(self):
+        makeStories(3)
+        response = self.client.get('/api/stories', {'story_cat': '*', 'story_region': '*', 'story_date': '*'})
+        self.assertNotIn('next', response.json())
+        self.assertEqual(len(response.json()['stories']), 3)
+
+    def test_pages_follow_next_links(self):
+        makeStories(3, storyDate=date(2024, 1, 1))
+        makeStories(2, storyDate=date(2024, 1, 2))
+        response = self.client.get('/api/stories', {'story_cat': '*', 'story_region': '*', 'story_date': '*', 'limit': '2'})
+        keys = []
+        while True:
+            payload = response.json()
+            keys += [story['key'] for story in payload['stories']]
+            if payload['next'] is None:
+                break
+            with self.assertNumQueries(2):
+                response = self.client.get(payload['next'])
+        expected = [str(story.id) for story in Story.objects.order_by('-date', '-id')]
+        self.assertEqual(keys, expected)
+
+    def test_invalid_cursor_and_limit(self):
+        params = {'story_cat': '*', 'story_region': '*', 'story_date': '*'}
+        self.assertEqual(self.client.get('/api/stories', dict(params, cursor='!!')).status_code, 400)
+        self.assertEqual(self.client.get('/api/stories', dict(params, limit='0')).status_code, 400)
+
+
+# tests for the response cache on GET /api/stories
+class StoriesCacheTests(StoriesTestCase):
+
+    params = {'story_cat': '*', 'story_region': '*', 'story_date': '*'}
+
+    def setUp(self):
+        super().setUp()
+        makeStories(2)
+        self.client.force_login(User.objects.get(username='author0'))
+
+    def test_repeat_request_is_served_from_cache(self):
+        # aggregators read without logging in, so no session is read
+        self.client.logout()
+        self.assertEqual(self.client.get('/api/stories', self.params)['X-Cache'], 'MISS')
+        # only the change sequence is read
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/stories', self.params)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(len(response.json()['stories']), 2)
+
+    def test_post_invalidates_matching_filters_only(self):
+        artParams = dict(self.params, story_cat='art')
+        self.client.get('/api/stories', self.params)
+        self.client.get('/api/stories', artParams)
+        story = {'headline': 'New', 'category': 'pol', 'region': 'uk', 'details': 'New story'}
+        self.client.post('/api/stories', json.dumps(story), content_type='application/json')
+        response = self.client.get('/api/stories', self.params)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.json()['stories']), 3)
+        self.assertEqual(self.client.get('/api/stories', artParams)['X-Cache'], 'HIT')
+
+    def test_delete_invalidates(self):
+        self.client.get('/api/stories', self.params)
+        self.client.delete('/api/stories/' + str(Story.objects.first().id))
+        response = self.client.get('/api/stories', self.params)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.json()['stories']), 1)
+
+    def test_changes_from_another_process_invalidate(self):
+        self.client.get('/api/stories', self.params)
+        artParams = dict(self.params, story_cat='art')
+        makeStories(1, category='art')
+        self.client.get('/api/stories', artParams)
+        # written straight to the database, as another worker would, without touching this process's cache
+        author = Author.objects.first()
+        Story.objects.create(headline='Elsewhere', category='pol', region='uk', author=author, date=date.today(), details='Posted elsewhere')
+        response = self.client.get('/api/stories', self.params)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.json()['stories']), 4)
+        self.assertEqual(self.client.get('/api/stories', artParams)['X-Cache'], 'HIT')
+        deleteStory(Story.objects.get(headline='Elsewhere').id)
+        self.assertEqual(len(self.client.get('/api/stories', self.params).json()['stories']), 3)
+
+
+# tests for conditional GET /api/stories
+class StoriesConditionalTests(StoriesTestCase):
+
+    params = {'story_cat': '*', 'story_region': '*', 'story_date': '*'}
+
+    def test_matching_etag_returns_304_reading_only_the_change_sequence(self):
+        makeStories(2)
+        etag = self.client.get('/api/stories', self.params)['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/stories', self.params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+    # move the version of the '*' filter back to a second that has passed, as if the last write was a while ago
+    def ageVersion(self, seconds):
+        storycache.storyCache().set(storycache.versionKey('*', '*'), time.time_ns() - seconds * 1000000000, timeout=None)
+
+    def test_no_last_modified_within_the_second_of_a_write(self):
+        makeStories(1)
+        self.client.get('/api/stories', self.params)
+        storycache.invalidate([('pol', 'uk')])
+        self.assertFalse(self.client.get('/api/stories', self.params).has_header('Last-Modified'))
+
+    def test_if_modified_since_returns_304(self):
+        makeStories(1)
+        self.client.get('/api/stories', self.params)
+        self.ageVersion(5)
+        lastModified = self.client.get('/api/stories', self.params)['Last-Modified']
+        response = self.client.get('/api/stories', self.params, HTTP_IF_MODIFIED_SINCE=lastModified)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Last-Modified'], lastModified)
+        makeStories(1)
+        self.assertEqual(self.client.get('/api/stories', self.params, HTTP_IF_MODIFIED_SINCE=lastModified).status_code, 200)
+
+    def test_etag_changes_after_new_story(self):
+        makeStories(1)
+        etag = self.client.get('/api/stories', self.params)['ETag']
+        makeStories(1)
+        response = self.client.get('/api/stories', self.params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_changes_after_story_from_another_process(self):
+        makeStories(1)
+        etag = self.client.get('/api/stories', self.params)['ETag']
+        Story.objects.create(headline='Elsewhere', category='art', region='w', author=Author.objects.first(), date=date.today(), details='Posted elsewhere')
+        response = self.client.get('/api/stories', self.params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['stories']), 2)
+
+
+# tests for streamed GET /api/stories
+class StoriesStreamTests(StoriesTestCase):
+
+    params = {'story_cat': '*', 'story_region': '*', 'story_date': '*', 'stream': '1'}
+
+    def test_streamed_payload_matches_buffered(self):
+        makeStories(3)
+        response = self.client.get('/api/stories', self.params)
+        self.assertTrue(response.streaming)
+        streamed = json.loads(b''.join(response.streaming_content))
+        buffered = self.client.get('/api/stories', dict(self.params, stream='0')).json()
+        self.assertEqual(streamed, buffered)
+
+    def test_streamed_empty_result_returns_404(self):
+        self.assertEqual(self.client.get('/api/stories', self.params).status_code, 404)
+
+
+# tests for GET /api/stories/changes
+class StoriesChangesTests(StoriesTestCase):
+
+    def test_returns_only_changes_since_token(self):
+        first, second = makeStories(2)
+        payload = self.client.get('/api/stories/changes').json()
+        self.assertEqual([story['key'] for story in payload['stories']], [str(first.id), str(second.id)])
+        token = payload['next']
+
+        self.client.force_login(User.objects.get(username='author0'))
+        self.client.delete('/api/stories/' + str(first.id))
+        third = makeStories(1)[0]
+        payload = self.client.get('/api/stories/changes', {'since': token}).json()
+        self.assertEqual([story['key'] for story in payload['stories']], [str(third.id)])
+        self.assertEqual(payload['deleted'], [str(first.id)])
+
+        payload = self.client.get('/api/stories/changes', {'since': payload['next']}).json()
+        self.assertEqual(payload['stories'], [])
+        self.assertEqual(payload['deleted'], [])
+
+    def test_limit_and_filter(self):
+        makeStories(3, category='art')
+        makeStories(1, category='pol')
+        payload = self.client.get('/api/stories/changes', {'story_cat': 'art', 'limit': '2'}).json()
+        self.assertEqual(len(payload['stories']), 2)
+        self.assertTrue(payload['more'])
+        payload = self.client.get('/api/stories/changes', {'story_cat': 'art', 'since': payload['next']}).json()
+        self.assertEqual(len(payload['stories']), 1)
+        self.assertFalse(payload['more'])
+
+    def test_invalid_token(self):
+        self.assertEqual(self.client.get('/api/stories/changes', {'since': 'x'}).status_code, 400)
+
+
+# tests for POST /api/stories/bulk
+class StoriesBulkTests(StoriesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create(username='publisher')
+        Author.objects.create(user=user)
+        self.client.force_login(user)
+
+    def test_json_array_with_invalid_items(self):
+        stories = [
+            {'headline': 'One', 'category': 'pol', 'region': 'uk', 'details': 'First'},
+            {'headline': 'Two', 'category': 'sport', 'region': 'uk', 'details': 'Bad category'},
+            {'headline': 'Three', 'category': 'art', 'region': 'w', 'details': 'Third'},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/stories/bulk', json.dumps(stories), content_type='application/json')
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('INSERT')]), 1)
+        self.assertEqual(response.status_code, 200)
+        payload = response.json()
+        self.assertEqual((payload['created'], payload['rejected']), (2, 1))
+        self.assertFalse(payload['results'][1]['created'])
+        self.assertEqual(Story.objects.get(id=payload['results'][2]['key']).headline, 'Three')
+
+    def test_ndjson(self):
+        body = '{"headline": "One", "category": "tech", "region": "eu", "details": "First"}\nnot json\n'
+        response = self.client.post('/api/stories/bulk', body, content_type='application/x-ndjson')
+        payload = response.json()
+        self.assertEqual((payload['created'], payload['rejected']), (1, 1))
+        self.assertEqual(Story.objects.count(), 1)
+
+    def test_body_that_is_not_utf8(self):
+        body = b'{"headline": "\xff", "category": "tech", "region": "eu", "details": "First"}\n'
+        self.assertEqual(self.client.post('/api/stories/bulk', body, content_type='application/x-ndjson').status_code, 400)
+        self.assertEqual(self.client.post('/api/stories/bulk', b'[' + body + b']', content_type='application/json').status_code, 400)
+        self.assertEqual(Story.objects.count(), 0)
+
+    def test_body_must_be_array(self):
+        response = self.client.post('/api/stories/bulk', json.dumps({'headline': 'One'}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+# tests for DELETE /api/stories/bulk
+class StoriesBulkDeleteTests(StoriesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.art = makeStories(3, category='art')
+        self.pol = makeStories(2, category='pol')
+        self.client.force_login(User.objects.get(username='author0'))
+
+    def test_delete_by_ids_in_one_statement(self):
+        ids = [self.art[0].id, self.pol[0].id]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.delete('/api/stories/bulk', json.dumps({'ids': ids}), content_type='application/json')
+        self.assertEqual(response.json(), {'deleted': 2})
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('DELETE')]), 1)
+        self.assertEqual(Story.objects.count(), 3)
+        self.assertEqual(self.client.get('/api/stories/changes').json()['deleted'], [str(id) for id in ids])
+
+    def test_delete_by_filter_invalidates_cache(self):
+        params = {'story_cat': '*', 'story_region': '*', 'story_date': '*'}
+        self.client.get('/api/stories', params)
+        response = self.client.delete('/api/stories/bulk?story_cat=art&story_region=*&story_date=*')
+        self.assertEqual(response.json(), {'deleted': 3})
+        self.assertEqual(len(self.client.get('/api/stories', params).json()['stories']), 2)
+
+    def test_requires_ids_or_valid_filter(self):
+        self.assertEqual(self.client.delete('/api/stories/bulk').status_code, 400)
+        response = self.client.delete('/api/stories/bulk', json.dumps({'ids': 'all'}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+# tests for full-text search on GET /api/stories
+class StoriesSearchTests(StoriesTestCase):
+
+    params = {'story_cat': '*', 'story_region': '*', 'story_date': '*'}
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create(username='publisher'))
+        Author.objects.create(user=User.objects.get(username='publisher'))
+        stories = [
+            {'headline': 'Election results announced', 'category': 'pol', 'region': 'uk', 'details': 'Votes counted overnight'},
+            {'headline': 'Gallery opens', 'category': 'art', 'region': 'eu', 'details': 'New election themed exhibition'},
+            {'headline': 'Election election election', 'category': 'pol', 'region': 'w', 'details': 'Election again'},
+            {'headline': 'Robots', 'category': 'tech', 'region': 'w', 'details': 'Nothing to do with voting'},
+        ]
+        self.client.post('/api/stories/bulk', json.dumps(stories), content_type='application/json')
+
+    def search(self, **params):
+        return self.client.get('/api/stories', dict(self.params, **params))
+
+    def test_ranked_matches(self):
+        payload = self.search(q='election').json()
+        headlines = [story['headline'] for story in payload['stories']]
+        self.assertFalse(payload['truncated'])
+        self.assertEqual(headlines[0], 'Election election election')
+        self.assertEqual(len(headlines), 3)
+        self.assertEqual(len(self.search(q='election', story_cat='art').json()['stories']), 1)
+
+    def test_search_pages(self):
+        first = self.search(q='election', limit='2').json()
+        second = self.client.get(first['next']).json()
+        keys = [story['key'] for story in first['stories'] + second['stories']]
+        self.assertEqual(keys, [story['key'] for story in self.search(q='election').json()['stories']])
+        self.assertIsNone(second['next'])
+
+    def test_only_newest_matches_are_ranked(self):
+        searchMaxMatches = views.SEARCH_MAX_MATCHES
+        views.SEARCH_MAX_MATCHES = 2
+        try:
+            payload = self.search(q='election').json()
+        finally:
+            views.SEARCH_MAX_MATCHES = searchMaxMatches
+        self.assertEqual([story['headline'] for story in payload['stories']], ['Election election election', 'Gallery opens'])
+        self.assertTrue(payload['truncated'])
+
+    def test_pages_go_on_past_the_ranked_window(self):
+        searchMaxMatches = views.SEARCH_MAX_MATCHES
+        views.SEARCH_MAX_MATCHES = 2
+        try:
+            pages = [self.search(q='election', limit='1').json()]
+            while pages[-1]['next'] is not None:
+                pages.append(self.client.get(pages[-1]['next']).json())
+        finally:
+            views.SEARCH_MAX_MATCHES = searchMaxMatches
+        headlines = [story['headline'] for page in pages for story in page['stories']]
+        self.assertEqual(headlines, ['Election election election', 'Gallery opens', 'Election results announced'])
+
+    def test_search_with_filter_pages(self):
+        first = self.search(q='election', story_cat='pol', limit='1').json()
+        second = self.client.get(first['next']).json()
+        self.assertEqual([story['headline'] for story in first['stories'] + second['stories']], ['Election election election', 'Election results announced'])
+        self.assertIsNone(second['next'])
+
+    def test_index_follows_deletes(self):
+        story = Story.objects.get(headline='Robots')
+        self.assertEqual(self.search(q='robots').status_code, 200)
+        self.client.delete('/api/stories/' + str(story.id))
+        self.assertEqual(self.search(q='robots').status_code, 404)
+
+    def test_operators_are_taken_literally(self):
+        self.assertEqual(self.search(q='election) "(-').status_code, 200)
+        self.assertEqual(self.search(q='"*"').status_code, 400)
+
+
+# tests for the timing middleware and GET /api/metrics
+class MetricsTests(StoriesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+
+    def test_server_timing_header(self):
+        makeStories(1)
+        response = self.client.get('/api/stories', {'story_cat': '*', 'story_region': '*', 'story_date': '*'})
+        self.assertRegex(response['Server-Timing'], r'^total;dur=[0-9.]+, db;dur=[0-9.]+;desc="2 queries"$')
+
+    def test_histograms_in_prometheus_format(self):
+        for i in range(3):
+            self.client.get('/api/stories', {'story_cat': '*', 'story_region': '*', 'story_date': '*'})
+        text = self.client.get('/api/metrics').content.decode()
+        self.assertIn('news_request_duration_seconds_count{view="stories"} 3', text)
+        self.assertIn('news_db_queries_bucket{view="stories",le="+Inf"} 3', text)
+        self.assertIn('news_request_duration_seconds_quantile{view="stories",quantile="0.99"}', text)
+
+    def test_quantile_estimate(self):
+        histogram = metrics.Histogram([1, 2, 3, 4])
+        for value in [0.5] * 50 + [3.5] * 50:
+            histogram.observe(value)
+        self.assertEqual(histogram.quantile(0.5), 1)
+        self.assertEqual(histogram.quantile(0.99), 3.98)
+
+
+# tests for the async views served over ASGI
+class StoriesAsyncTests(StoriesTestCase):
+
+    params = {'story_cat': '*', 'story_region': '*', 'story_date': '*'}
+
+    def setUp(self):
+        super().setUp()
+        self.stories = makeStories(3)
+        self.user = User.objects.get(username='author0')
+
+    async def test_get_counts_queries(self):
+        response = await self.async_client.get('/api/stories', self.params)
+        self.assertEqual(len(response.json()['stories']), 3)
+        self.assertIn('desc="2 queries"', response['Server-Timing'])
+
+    async def test_streamed_payload_matches_buffered(self):
+        response = await self.async_client.get('/api/stories', dict(self.params, stream='1'))
+        streamed = json.loads(b''.join([chunk async for chunk in response.streaming_content]))
+        buffered = (await self.async_client.get('/api/stories', self.params)).json()
+        self.assertEqual(streamed, buffered)
+
+    async def test_login_post_delete_logout(self):
+        await self.async_client.aforce_login(self.user)
+        story = {'headline': 'New', 'category': 'pol', 'region': 'uk', 'details': 'New story'}
+        response = await self.async_client.post('/api/stories', json.dumps(story), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        response = await self.async_client.delete('/api/stories/' + str(self.stories[0].id))
+        self.assertEqual(response.status_code, 200)
+        response = await self.async_client.delete('/api/stories/' + str(self.stories[0].id))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual((await self.async_client.post('/api/logout')).status_code, 200)
+        self.assertEqual((await self.async_client.post('/api/logout')).status_code, 401)
+        self.assertEqual(await Story.objects.acount(), 3)
+
+
+# tests for the in-memory index of recent stories behind GET /api/stories
+class StoriesHotIndexTests(StoriesTestCase):
+
+    params = {'story_cat': '*', 'story_region': '*', 'story_date': '*'}
+
+    def setUp(self):
+        super().setUp()
+        makeStories(3, storyDate=date.today() - timedelta(days=30))
+        makeStories(3, category='art', storyDate=date.today() - timedelta(days=1))
+        makeStories(3, region='eu')
+        self.client.force_login(User.objects.get(username='author0'))
+
+    def get(self, **params):
+        return self.client.get('/api/stories', dict(self.params, **params))
+
+    def test_recent_filters_answered_without_queries(self):
+        # aggregators read without logging in, so no session is read
+        self.client.logout()
+        self.get(story_cat='art', limit='2')
+        self.assertEqual(hotindex.getStats()['stories'], 6)
+        # only the change sequence is read
+        with self.assertNumQueries(1):
+            response = self.get(story_cat='pol', limit='2')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual([story['story_region'] for story in response.json()['stories']], ['eu'] * 2)
+        since = (date.today() - timedelta(days=1)).strftime('%d/%m/%Y')
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.get(story_date=since).json()['stories']), 6)
+
+    # keys of every story of a request, following next links
+    def keys(self, **params):
+        keys = []
+        response = self.get(**params)
+        while response.status_code == 200:
+            payload = response.json()
+            keys += [story['key'] for story in payload['stories']]
+            if payload.get('next') is None:
+                break
+            response = self.client.get(payload['next'])
+        return keys
+
+    def test_answers_match_the_database(self):
+        since = (date.today() - timedelta(days=1)).strftime('%d/%m/%Y')
+        requests = [{'limit': '2'}, {'story_cat': 'art', 'limit': '5'}, {'story_region': 'eu', 'story_date': since}, {'story_date': since, 'limit': '4'}]
+        hits = hotindex.getStats()['hits']
+        answers = [self.keys(**params) for params in requests]
+        self.assertGreater(hotindex.getStats()['hits'], hits)
+        storycache.storyCache().clear()
+        with override_settings(HOT_INDEX_DAYS=0):
+            self.assertEqual(answers, [self.keys(**params) for params in requests])
+
+    def test_post_and_delete_update_the_index(self):
+        self.get(limit='1')
+        story = {'headline': 'New', 'category': 'tech', 'region': 'w', 'details': 'New story'}
+        self.client.post('/api/stories', json.dumps(story), content_type='application/json')
+        newest = self.get(story_cat='tech', limit='1').json()['stories']
+        self.assertEqual(newest[0]['headline'], 'New')
+        self.client.delete('/api/stories/' + newest[0]['key'])
+        self.assertEqual(self.get(story_cat='tech', limit='1').status_code, 404)
+
+    def test_changes_from_another_process_are_caught_up(self):
+        self.get(limit='1')
+        # stories written straight to the database, as another process would, touch neither the index nor the cache
+        Story.objects.create(headline='Elsewhere', category='trivia', region='w', author=Author.objects.first(), date=date.today(), details='Posted by another process')
+        deleteStory(Story.objects.filter(category='art').first().id)
+        self.assertEqual(len(self.get(story_cat='trivia', limit='5').json()['stories']), 1)
+        self.assertEqual(hotindex.getStats()['stories'], 6)
+
+    def test_older_stories_are_read_from_the_database(self):
+        self.get(limit='1')
+        misses = hotindex.getStats()['misses']
+        self.assertEqual(len(self.get().json()['stories']), 9)
+        self.assertEqual(len(self.get(limit='8').json()['stories']), 8)
+        self.assertEqual(hotindex.getStats()['misses'], misses + 1)
+
+    @override_settings(HOT_INDEX_MAX_STORIES=4)
+    def test_oldest_days_dropped_when_full(self):
+        self.get(limit='1')
+        self.assertEqual(hotindex.getStats()['stories'], 3)
+        misses = hotindex.getStats()['misses']
+        self.assertEqual(len(self.get(story_cat='art', limit='3').json()['stories']), 3)
+        self.assertEqual(hotindex.getStats()['misses'], misses + 1)
+
+
+# tests for API tokens and the session profile on the write paths
+class TokenAuthTests(StoriesTestCase):
+
+    story = {'headline': 'New', 'category': 'pol', 'region': 'uk', 'details': 'New story'}
+
+    def setUp(self):
+        super().setUp()
+        tokens.tokenCache().clear()
+        makeStories(1)
+        self.user = User.objects.get(username='author0')
+        self.client.force_login(self.user)
+        response = self.client.post('/api/tokens', {'name': 'publisher'})
+        self.assertEqual(response.status_code, 201)
+        self.key = response.json()['key']
+        self.headers = {'Authorization': 'Token ' + response.json()['token']}
+        self.client.logout()
+
+    def post(self, headers):
+        return self.client.post('/api/stories', json.dumps(self.story), content_type='application/json', headers=headers)
+
+    # tables read by a request, other than the stories and the deleted story log
+    def authTablesRead(self, queries):
+        return [query['sql'] for query in queries if 'auth_user' in query['sql'] or 'django_session' in query['sql'] or 'api_apitoken' in query['sql']]
+
+    def test_writes_with_a_verified_token_read_no_session_or_user(self):
+        self.assertEqual(self.post(self.headers).status_code, 201)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.post(self.headers).status_code, 201)
+            response = self.client.delete('/api/stories/' + str(Story.objects.order_by('-id').first().id), headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.authTablesRead(queries.captured_queries), [])
+        self.assertEqual(Story.objects.order_by('-id').first().author.user, self.user)
+
+    async def test_async_views_accept_tokens(self):
+        response = await self.async_client.post('/api/stories', json.dumps(self.story), content_type='application/json', headers=self.headers)
+        self.assertEqual(response.status_code, 201)
+        response = await self.async_client.post('/api/logout', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+
+    def test_made_up_tokens_are_refused(self):
+        for token in [self.key, signing.Signer(salt='api.tokens').sign(self.key), 'x' * 43]:
+            self.assertEqual(self.post({'Authorization': 'Token ' + token}).status_code, 401)
+        self.assertEqual(Story.objects.count(), 1)
+
+    def test_only_the_digest_is_stored(self):
+        token = self.headers['Authorization'].split(' ')[1]
+        stored = ApiToken.objects.get(id=self.key)
+        self.assertEqual(stored.digest, tokens.digestOf(token))
+        self.assertNotIn(token, [stored.digest, stored.name])
+
+    def test_revoked_token_is_refused(self):
+        self.assertEqual(self.post(self.headers).status_code, 201)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.delete('/api/tokens/' + self.key).status_code, 200)
+        self.assertEqual(self.client.delete('/api/tokens/' + self.key + '1').status_code, 404)
+        listed = self.client.get('/api/tokens').json()['tokens']
+        self.assertEqual(listed[0]['revoked'], True)
+        self.assertNotIn('token', listed[0])
+        self.client.logout()
+        self.assertEqual(self.post(self.headers).status_code, 401)
+
+    def test_tokens_need_an_author(self):
+        self.assertEqual(self.client.post('/api/tokens').status_code, 401)
+        self.client.force_login(User.objects.create(username='reader'))
+        self.assertEqual(self.client.post('/api/tokens').status_code, 403)
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cached_db')
+    def test_cached_sessions_are_not_read_from_the_database(self):
+        # a new client, as the session engine is picked when the middleware is loaded
+        self.client = self.client_class()
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.post({}).status_code, 201)
+        self.assertFalse(any('django_session' in query['sql'] for query in queries.captured_queries))
+
+
+# tests for rate limiting and load shedding
+class RateLimitTests(StoriesTestCase):
+
+    params = {'story_cat': '*', 'story_region': '*', 'story_date': '*'}
+
+    def test_client_address_limited_with_retry_after(self):
+        for _ in range(120):
+            self.assertEqual(self.client.get('/api/stories', self.params).status_code, 404)
+        response = self.client.get('/api/stories', self.params)
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        self.assertEqual(self.client.get('/api/stories', self.params, REMOTE_ADDR='10.0.0.2').status_code, 404)
+        # a logged-in client has its own bucket as a user
+        makeStories(1)
+        self.client.force_login(User.objects.get(username='author0'))
+        self.assertEqual(self.client.get('/api/stories', self.params).status_code, 200)
+        self.assertIn('news_refused_requests_total{view="stories",reason="rate_limited"}', self.client.get('/api/metrics').content.decode())
+
+    def test_logged_in_client_still_limited_on_login(self):
+        self.client.force_login(User.objects.create(username='guesser'))
+        statuses = [self.client.post('/api/login', {'username': 'guesser', 'password': 'guess%d' % i}).status_code for i in range(11)]
+        self.assertNotIn(429, statuses[:10])
+        self.assertEqual(statuses[10], 429)
+
+    def test_buckets_refill_over_time(self):
+        buckets = ratelimit.MemoryBuckets()
+        rate, capacity = ratelimit.parseRate('2/s')
+        self.assertEqual([buckets.take('client', rate, capacity) for _ in range(2)], [0.0, 0.0])
+        wait = buckets.take('client', rate, capacity)
+        self.assertTrue(0 < wait <= 0.5)
+        self.assertEqual(buckets.take('other', rate, capacity), 0.0)
+
+    def test_new_keys_do_not_reset_a_busy_client(self):
+        buckets = ratelimit.MemoryBuckets(stripes=1, maxPerStripe=10)
+        rate, capacity = ratelimit.parseRate('2/m')
+        buckets.take('busy', rate, capacity)
+        buckets.take('busy', rate, capacity)
+        # another client cycles through many addresses while the busy one keeps asking
+        for i in range(100):
+            buckets.take('cycling%d' % i, rate, capacity)
+            self.assertGreater(buckets.take('busy', rate, capacity), 0)
+        self.assertLessEqual(len(buckets.stripes[0]), 10)
+
+    def test_shared_buckets_are_seen_by_every_worker(self):
+        path = os.path.join(tempfile.mkdtemp(), 'ratelimit.sqlite3')
+        first, second = ratelimit.SqliteBuckets(path), ratelimit.SqliteBuckets(path)
+        rate, capacity = ratelimit.parseRate('2/m')
+        self.assertEqual(first.take('client', rate, capacity), 0.0)
+        self.assertEqual(second.take('client', rate, capacity), 0.0)
+        self.assertGreater(first.take('client', rate, capacity), 25)
+
+    def test_unfiltered_queries_shed_first(self):
+        makeStories(1)
+        shedder = storiesView.shedder
+        try:
+            shedder.running, shedder.latency = 4, 1.0
+            response = self.client.get('/api/stories', self.params)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '1')
+            self.assertEqual(self.client.get('/api/stories', dict(self.params, story_cat='pol')).status_code, 200)
+            self.assertEqual(self.client.get('/api/stories', dict(self.params, limit='10')).status_code, 200)
+            shedder.running = 64
+            self.assertEqual(self.client.get('/api/stories', dict(self.params, story_cat='pol')).status_code, 503)
+        finally:
+            shedder.running, shedder.latency = 0, 0.0
+
+    def test_streamed_request_counts_as_running_until_sent(self):
+        makeStories(2)
+        response = self.client.get('/api/stories', dict(self.params, stream='1'))
+        self.assertEqual(storiesView.shedder.running, 1)
+        b''.join(response.streaming_content)
+        self.assertEqual(storiesView.shedder.running, 0)
+        response.close()
+        self.assertEqual(storiesView.shedder.running, 0)
+
+
+# tests for GET /api/stories/subscribe
+class StoriesSubscribeTests(StoriesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        broker.subscriptions.clear()
+        self.stories = makeStories(3)
+        self.user = User.objects.get(username='author0')
+
+    # next chunk of an event stream, failing rather than hanging if none comes
+    async def nextEvents(self, response):
+        return (await asyncio.wait_for(anext(response.streaming_content), 5)).decode()
+
+    async def test_pushes_new_stories_matching_filter(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get('/api/stories/subscribe', {'story_cat': 'pol'})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertTrue((await self.nextEvents(response)).startswith('retry: '))
+        for category in ['art', 'pol']:
+            story = {'headline': 'New ' + category, 'category': category, 'region': 'uk', 'details': 'New story'}
+            await self.async_client.post('/api/stories', json.dumps(story), content_type='application/json')
+        events = await self.nextEvents(response)
+        self.assertIn('event: story\n', events)
+        self.assertIn('"headline": "New pol"', events)
+        self.assertNotIn('New art', events)
+
+    async def test_resumes_after_last_event_id(self):
+        response = await self.async_client.get('/api/stories/subscribe', headers={'Last-Event-ID': str(self.stories[0].id)})
+        await self.nextEvents(response)
+        events = await self.nextEvents(response)
+        self.assertEqual(events.count('event: story'), 2)
+        self.assertTrue(events.startswith('id: ' + str(self.stories[1].id) + '\n'))
+
+    async def test_slow_subscriber_catches_up_from_database(self):
+        response = await self.async_client.get('/api/stories/subscribe')
+        await self.nextEvents(response)
+        # more new stories than the queue holds arrive before the subscriber reads any
+        await self.async_client.aforce_login(self.user)
+        items = [{'headline': 'Bulk %d' % i, 'category': 'tech', 'region': 'w', 'details': 'Bulk story'} for i in range(broker.QUEUE_SIZE + 50)]
+        await self.async_client.post('/api/stories/bulk', json.dumps(items), content_type='application/json')
+        subscription = next(iter(broker.subscriptions))
+        self.assertTrue(subscription.lagging)
+        self.assertEqual(subscription.queue.qsize(), broker.QUEUE_SIZE)
+        received = 0
+        while received < len(items):
+            received += (await self.nextEvents(response)).count('event: story')
+        self.assertEqual(received, len(items))
+
+    async def test_long_poll(self):
+        response = await self.async_client.get('/api/stories/subscribe', {'poll': '1', 'last_event_id': '0'})
+        payload = response.json()
+        self.assertEqual(len(payload['stories']), 3)
+        self.assertEqual(payload['last_event_id'], str(self.stories[2].id))
+        response = await self.async_client.get('/api/stories/subscribe', {'poll': '1', 'last_event_id': payload['last_event_id']})
+        self.assertEqual(response.json()['stories'], [])
+        self.assertEqual(broker.subscriberCount(), 0)
+
+    async def test_long_poll_answered_by_new_story(self):
+        poll = asyncio.ensure_future(self.async_client.get('/api/stories/subscribe', {'poll': '5', 'story_cat': 'art', 'last_event_id': str(self.stories[2].id)}))
+        while not broker.subscriberCount():
+            await asyncio.sleep(0.01)
+        await self.async_client.aforce_login(self.user)
+        story = {'headline': 'New art', 'category': 'art', 'region': 'uk', 'details': 'New story'}
+        await self.async_client.post('/api/stories', json.dumps(story), content_type='application/json')
+        payload = (await asyncio.wait_for(poll, 5)).json()
+        self.assertEqual([story['headline'] for story in payload['stories']], ['New art'])
+        self.assertEqual(payload['last_event_id'], str((await Story.objects.alatest('id')).id))
+
+    async def test_long_poll_reads_database_after_timeout(self):
+        poll = asyncio.ensure_future(self.async_client.get('/api/stories/subscribe', {'poll': '1', 'last_event_id': str(self.stories[2].id)}))
+        while not broker.subscriberCount():
+            await asyncio.sleep(0.01)
+        # a story posted to another process is saved without reaching this process's broker
+        story = await Story.objects.acreate(headline='Elsewhere', category='pol', region='uk', author_id=self.stories[0].author_id, date=date.today(), details='Posted to another process')
+        payload = (await asyncio.wait_for(poll, 5)).json()
+        self.assertEqual([item['headline'] for item in payload['stories']], ['Elsewhere'])
+        self.assertEqual(payload['last_event_id'], str(story.id))
+
+    def test_event_stream_needs_asgi(self):
+        self.assertEqual(self.client.get('/api/stories/subscribe').status_code, 400)
+        self.assertEqual(self.client.get('/api/stories/subscribe', {'poll': '1'}).status_code, 200)
+
+
+# tests for the SQLite settings applied to every connection
+class SqliteTuningTests(TestCase):
+
+    def test_pragmas_applied(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 5000)
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -20000)
+
+    # journal mode of a database file after a connection to it is set up with the given SQLITE_JOURNAL_MODE
+    def journalModeAfterSetup(self, journalMode):
+        with tempfile.TemporaryDirectory() as folder, override_settings(SQLITE_JOURNAL_MODE=journalMode):
+            raw = sqlite3.connect(os.path.join(folder, 'db.sqlite3'))
+            try:
+                sqlite.configureConnection(None, SimpleNamespace(vendor='sqlite', connection=raw))
+                return raw.execute('PRAGMA journal_mode').fetchone()[0]
+            finally:
+                raw.close()
+
+    def test_journal_mode_left_alone_unless_asked_for(self):
+        self.assertEqual(self.journalModeAfterSetup(None), 'delete')
+        self.assertEqual(self.journalModeAfterSetup('WAL'), 'wal')
+
+
+# tests for compression of responses
+class CompressionTests(StoriesTestCase):
+
+    params = {'story_cat': '*', 'story_region': '*', 'story_date': '*'}
+
+    def test_gzip_response(self):
+        makeStories(10)
+        plain = self.client.get('/api/stories', self.params)
+        response = self.client.get('/api/stories', self.params, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertEqual(response['ETag'], 'W/' + plain['ETag'])
+
+    def test_small_response_not_compressed(self):
+        makeStories(1)
+        response = self.client.get('/api/stories', self.params, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_compressed_once_for_identical_responses(self):
+        makeStories(10)
+        before = storycache.getStats()
+        first = self.client.get('/api/stories', self.params, HTTP_ACCEPT_ENCODING='gzip')
+        second = self.client.get('/api/stories', self.params, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(first.content, second.content)
+        after = storycache.getStats()
+        self.assertEqual(after['compressed_misses'] - before['compressed_misses'], 1)
+        self.assertEqual(after['compressed_hits'] - before['compressed_hits'], 1)
+
+    def test_weak_etag_gets_304(self):
+        makeStories(10)
+        etag = self.client.get('/api/stories', self.params, HTTP_ACCEPT_ENCODING='gzip')['ETag']
+        response = self.client.get('/api/stories', self.params, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_negotiate(self):
+        self.assertEqual(compression.negotiate('gzip, deflate'), 'gzip')
+        self.assertIsNone(compression.negotiate('identity'))
+        self.assertIsNone(compression.negotiate('gzip;q=0'))
+        self.assertIsNone(compression.negotiate(''))
+        self.assertEqual(compression.negotiate('*'), [encoding for encoding in compression.PREFERENCE if encoding in compression.ENCODERS][0])
+        self.assertEqual(compression.negotiate('gzip;q=1.0, br;q=0.5, zstd;q=0.1'), 'gzip')
+
+
+# tests for the binary formats of GET /api/stories
+@unittest.skipIf(formats.msgpack is None, 'msgpack is not installed')
+class StoriesFormatTests(StoriesTestCase):
+
+    params = {'story_cat': '*', 'story_region': '*', 'story_date': '*', 'limit': '2'}
+
+    def setUp(self):
+        super().setUp()
+        makeStories(3)
+        self.expected = self.client.get('/api/stories', self.params).json()
+
+    def test_msgpack_by_parameter(self):
+        response = self.client.get('/api/stories', dict(self.params, format='msgpack'))
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        payload = formats.msgpack.unpackb(response.content)
+        self.assertEqual(payload['stories'], self.expected['stories'])
+        # the next page keeps the format
+        self.assertEqual(payload['next'], self.expected['next'].replace('&cursor', '&format=msgpack&cursor'))
+
+    def test_columnar_by_accept_header(self):
+        response = self.client.get('/api/stories', self.params, HTTP_ACCEPT='application/vnd.news.columnar+msgpack, application/json;q=0.5')
+        self.assertEqual(response['Content-Type'], 'application/vnd.news.columnar+msgpack')
+        payload = formats.msgpack.unpackb(response.content)
+        columns = payload['stories']
+        self.assertEqual(columns['story_cat'], {'values': ['pol'], 'indexes': [0, 0]})
+        stories = []
+        for i in range(columns['count']):
+            story = {}
+            for field in formats.FIELDS:
+                column = columns[field]
+                story[field] = column['values'][column['indexes'][i]] if field in formats.DICTIONARY_FIELDS else column[i]
+            story['key'] = str(story['key'])
+            stories.append(story)
+        self.assertEqual(stories, self.expected['stories'])
+        self.assertEqual(payload['next'], self.expected['next'])
+
+    def test_formats_have_their_own_etag(self):
+        json = self.client.get('/api/stories', self.params)
+        binary = self.client.get('/api/stories', dict(self.params, format='msgpack'))
+        self.assertNotEqual(json['ETag'], binary['ETag'])
+        self.assertIn('Accept', binary['Vary'])
+
+    def test_negotiation(self):
+        self.assertEqual(formats.negotiate(''), 'json')
+        self.assertEqual(formats.negotiate('*/*'), 'json')
+        self.assertEqual(formats.negotiate('application/x-msgpack, */*'), 'msgpack')
+        self.assertEqual(formats.negotiate('application/msgpack;q=0.2, application/json'), 'json')
+        self.assertEqual(formats.negotiate('text/html'), 'json')
+        self.assertIsNone(formats.negotiate('', 'xml'))
+        self.assertEqual(self.client.get('/api/stories', dict(self.params, format='xml')).status_code, 400)
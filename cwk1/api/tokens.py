@@ -0,0 +1,76 @@
+from django.core.cache import caches
+
+from .models import ApiToken
+
+import hashlib
+import secrets
+
+# name of the cache in settings.CACHES that holds verified tokens
+CACHE_ALIAS = 'tokens'
+
+
+def tokenCache():
+    return caches[CACHE_ALIAS]
+
+
+def cacheKey(digest):
+    return 'token:' + digest
+
+
+# tokens are random secrets and only their SHA-256 is stored, so a token can neither be made up nor read from the
+# database; a fast hash is enough, as a token has 256 random bits rather than the few of a password
+def digestOf(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+# issue a new token for an author, returning its row and the token to give out
+def issue(author, name=''):
+    value = secrets.token_urlsafe(32)
+    token = ApiToken.objects.create(author=author, name=name, digest=digestOf(value))
+    return token, value
+
+
+# the verified (user, author id) of a token digest from the cache, False if it is known to be revoked or unknown,
+# or None if it has not been checked since the cache entry expired
+def cachedIdentity(digest):
+    return tokenCache().get(cacheKey(digest))
+
+
+async def acachedIdentity(digest):
+    return await tokenCache().aget(cacheKey(digest))
+
+
+# check a token digest against the database and cache the answer for the cache timeout, so a token revoked in
+# another process is refused within that time (straight away in the process that revoked it)
+def loadIdentity(digest):
+    token = ApiToken.objects.select_related('author__user').filter(digest=digest, revoked=False).first()
+    identity = (token.author.user, token.author_id) if token is not None and token.author.user.is_active else False
+    tokenCache().set(cacheKey(digest), identity)
+    return identity
+
+
+# the (user, author id) a token stands for, or None if it is unknown or revoked
+def verify(token):
+    digest = digestOf(token)
+    identity = cachedIdentity(digest)
+    if identity is None:
+        identity = loadIdentity(digest)
+    return identity or None
+
+
+# revoke one of an author's tokens, returning False if they have no such token
+def revoke(author, tokenId):
+    digest = ApiToken.objects.filter(id=tokenId, author=author).values_list('digest', flat=True).first()
+    if digest is None:
+        return False
+    ApiToken.objects.filter(id=tokenId).update(revoked=True)
+    tokenCache().delete(cacheKey(digest))
+    return True
+
+
+# the token sent in an 'Authorization: Token <token>' (or 'Bearer <token>') header, or None
+def fromHeader(header):
+    scheme, _, token = header.partition(' ')
+    if scheme.lower() not in ('token', 'bearer') or not token.strip():
+        return None
+    return token.strip()
@@ -1,12 +1,24 @@
 from django.contrib import admin
 from django.urls import path
 
-from api.views import handleLogin, handleLogout, stories, delete
+from api.views import handleLogin, handleLogout, stories, delete, changes, subscribe, bulkStories, cacheStats, metricsText, apiTokens, revokeToken, unfilteredStories
+from api.ratelimit import limited
+
+# rate limits per client address and per logged-in user ('count/period', see api/ratelimit.py);
+# unfiltered stories requests are shed first when the stories view is overloaded
+storiesView = limited(stories, ip='120/m', user='600/m', costly=unfilteredStories)
 
 urlpatterns = [
-    path('login', handleLogin),
+    path('login', limited(handleLogin, ip='10/m')),
     path('logout', handleLogout),
-    path('stories', stories),
-    path('stories/', stories),
-    path('stories/<int:id>', delete),
-]
\ No newline at end of file
+    path('stories', storiesView),
+    path('stories/', storiesView),
+    path('stories/<int:id>', limited(delete, ip='60/m', user='300/m')),
+    path('stories/changes', limited(changes, ip='120/m', user='600/m')),
+    path('stories/subscribe', limited(subscribe, ip='30/m', user='60/m')),
+    path('stories/bulk', limited(bulkStories, ip='10/m', user='30/m')),
+    path('cache', cacheStats),
+    path('metrics', metricsText),
+    path('tokens', limited(apiTokens, ip='10/m', user='30/m')),
+    path('tokens/<int:id>', revokeToken),
+]
@@ -1,20 +1,347 @@
 from django.shortcuts import render
-from django.http import HttpResponse, HttpRequest, JsonResponse
+from django.http import HttpResponse, HttpRequest, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.contrib.auth import authenticate, login, logout
+from django.contrib.auth import aauthenticate, alogin, alogout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.core.serializers import serialize
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
 
-from .models import Author, Story
+from asgiref.sync import sync_to_async
+
+from .models import Author, Story, DeletedStory, ApiToken
+from . import storycache, metrics, broker, formats, hotindex, tokens, ratelimit
 
 from datetime import datetime, date
+import asyncio
+import base64
 import json
+import re
+import time
+
+# most stories accepted by one bulk post
+MAX_BULK_STORIES = 5000
+
+# page sizes for cursor pagination of stories
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# rows read from the database per chunk when streaming stories
+STREAM_CHUNK_SIZE = 500
+# newest matching stories ranked by a search, so a search of a common word costs about the same as a rare one
+SEARCH_MAX_MATCHES = 200
+
+# seconds between keep-alive comments on an idle event stream, each followed by a check of the database
+# for stories the in-process broker did not see (posted to another server process)
+SUBSCRIBE_HEARTBEAT = 15
+# milliseconds an event stream client waits before reconnecting
+SUBSCRIBE_RETRY = 3000
+# longest wait of a long-poll subscription, in seconds
+MAX_POLL_WAIT = 60
+
+# story columns read for the json payload, with the author username joined in
+STORY_FIELDS = ('id', 'headline', 'category', 'region', 'author__user__username', 'date', 'details')
+
+
+# format a row of STORY_FIELDS for json
+def storyItem(story):
+    return {'key': str(story['id']), 'headline':story['headline'], 'story_cat':story['category'], 'story_region':story['region'], 'author': story['author__user__username'], 'story_date':story['date'].strftime("%d/%m/%Y"), 'story_details': story['details']}
+
+
+# yield the {"stories": [...]} payload a chunk of stories at a time, starting with the first row
+def streamStories(first, rows):
+    yield '{"stories": [' + json.dumps(storyItem(first))
+    chunk = []
+    for story in rows:
+        chunk.append(json.dumps(storyItem(story)))
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield ', ' + ', '.join(chunk)
+            chunk = []
+    if chunk:
+        yield ', ' + ', '.join(chunk)
+    yield ']}'
+
+
+# the same payload from an async iterator of rows, for responses served over ASGI
+async def astreamStories(first, rows):
+    yield '{"stories": [' + json.dumps(storyItem(first))
+    chunk = []
+    async for story in rows:
+        chunk.append(json.dumps(storyItem(story)))
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield ', ' + ', '.join(chunk)
+            chunk = []
+    if chunk:
+        yield ', ' + ', '.join(chunk)
+    yield ']}'
+
+
+# a created story as a row of STORY_FIELDS
+def storyRow(story, username):
+    return {'id': story.id, 'headline': story.headline, 'category': story.category, 'region': story.region,
+            'author__user__username': username, 'date': story.date, 'details': story.details}
+
+
+# push newly created stories to the subscribers of matching filters
+def publishStories(newStories, username):
+    broker.publish([(story.id, story.category, story.region, storyItem(storyRow(story, username))) for story in newStories])
+
+
+# up to 'limit' stories in a (category, region) filter created after a story id, oldest first
+async def storiesAfter(cat, reg, lastId, limit):
+    query = Story.objects.filter(id__gt=lastId)
+    if cat != '*':
+        query = query.filter(category=cat)
+    if reg != '*':
+        query = query.filter(region=reg)
+    return [story async for story in query.order_by('id').values(*STORY_FIELDS)[:limit]]
+
+
+# format a story as a Server-Sent Event, with its id so a reconnecting client can resume after it
+def storyEvent(storyId, item):
+    return 'id: ' + str(storyId) + '\nevent: story\ndata: ' + json.dumps(item) + '\n\n'
+
+
+# yield new stories of a subscription as Server-Sent Events, starting after a story id
+# the next event is only made once the last one has been sent, so a slow client falls behind rather than
+# filling memory: its queue stops taking stories and it reads them from the database when it gets to them
+async def storyEvents(cat, reg, lastId):
+    # subscribe before the first read of the database so no story falls between the two
+    subscription = broker.subscribe(cat, reg)
+    catchUp = True
+    try:
+        yield 'retry: ' + str(SUBSCRIBE_RETRY) + '\n\n'
+        while True:
+            if catchUp or subscription.lagging:
+                subscription.lagging = False
+                stories = await storiesAfter(cat, reg, lastId, STREAM_CHUNK_SIZE)
+                # keep reading from the database until it has nothing more
+                catchUp = len(stories) == STREAM_CHUNK_SIZE
+                if stories:
+                    lastId = stories[-1]['id']
+                    yield ''.join(storyEvent(story['id'], storyItem(story)) for story in stories)
+                continue
+            try:
+                storyId, item = await asyncio.wait_for(subscription.queue.get(), SUBSCRIBE_HEARTBEAT)
+            except asyncio.TimeoutError:
+                catchUp = True
+                yield ': keep-alive\n\n'
+                continue
+            # stories already read from the database are skipped
+            if storyId > lastId:
+                lastId = storyId
+                yield storyEvent(storyId, item)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+# make an opaque cursor from the date and id of the last story on a page
+def encodeCursor(storyDate, storyId):
+    raw = storyDate.isoformat() + ':' + str(storyId)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+# read a cursor back into (date, id), returning None if it is not valid
+def decodeCursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        position, storyId = raw.split(':')
+        return date.fromisoformat(position), int(storyId)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+# make an opaque cursor for the next page of a search: ('ranked', rank, id, top) after the last story of a page
+# of the ranked window of matches with ids up to top, or ('older', id) for the older matches below an id
+def encodeSearchCursor(position):
+    raw = ':'.join(str(part) for part in position)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+# read a search cursor back, returning None if it is not valid
+def decodeSearchCursor(cursor):
+    try:
+        parts = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split(':')
+        if parts[0] == 'ranked' and len(parts) == 4:
+            return 'ranked', float(parts[1]), int(parts[2]), int(parts[3])
+        if parts[0] == 'older' and len(parts) == 2:
+            return 'older', int(parts[1])
+    except (ValueError, UnicodeDecodeError):
+        pass
+    return None
+
+
+# FTS5 query matching every word of a search, or None if it has no words
+def ftsQuery(search):
+    words = re.findall(r'\w+', search)
+    if not words:
+        return None
+    # quote each word so FTS5 operators and punctuation in the search are taken literally
+    return ' '.join('"' + word + '"' for word in words)
+
+
+# (id, rank) of up to 'count' stories matching an FTS5 query and a category, region and date filter, newest first,
+# with ids up to 'top' and below 'below' (either None for no bound); rank is None unless asked for, as FTS5 scores
+# every match of the query's words once any row's rank is read
+def searchMatches(cat, reg, fromDate, match, top, below, count, ranked):
+    where, params = ['api_story_fts MATCH %s'], [match]
+    if cat != '*':
+        where.append('api_story.category = %s')
+        params.append(cat)
+    if reg != '*':
+        where.append('api_story.region = %s')
+        params.append(reg)
+    if fromDate is not None:
+        where.append('api_story.date >= %s')
+        params.append(fromDate.isoformat())
+    if top is not None:
+        where.append('api_story_fts.rowid <= %s')
+        params.append(top)
+    if below is not None:
+        where.append('api_story_fts.rowid < %s')
+        params.append(below)
+    sql = ('SELECT api_story.id, ' + ('api_story_fts.rank' if ranked else 'NULL') + ' FROM api_story_fts '
+           'JOIN api_story ON api_story.id = api_story_fts.rowid WHERE ' + ' AND '.join(where) +
+           ' ORDER BY api_story_fts.rowid DESC LIMIT %s')
+    params.append(count)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+# a page of a search as ((id, rank) pairs, next search cursor or None, whether matches were left out)
+# the SEARCH_MAX_MATCHES newest matches come first, most relevant first (FTS5 ranks better matches lower, with id
+# as a tie-break), so the rows scored are bounded however common the words are; the first page pins the window to
+# the ids it saw, and after it the older matches follow newest first, unranked, so paging reaches every match
+# ranks come from the whole index at the time of each page, so stories added or deleted between pages can move a
+# story across a cursor; without a limit only the ranked window is answered, and 'truncated' says if more matched
+def searchPage(cat, reg, fromDate, match, position, limit):
+    if position is None or position[0] == 'ranked':
+        top = position[3] if position is not None else None
+        window = searchMatches(cat, reg, fromDate, match, top, None, SEARCH_MAX_MATCHES, True)
+        if top is None:
+            top = window[0][0] if window else 0
+        ranked = sorted(window, key=lambda pair: (pair[1], pair[0]))
+        if position is not None:
+            ranked = [pair for pair in ranked if (pair[1], pair[0]) > (position[1], position[2])]
+        full = len(window) == SEARCH_MAX_MATCHES
+        below = window[-1][0] if window else None
+        if limit is None:
+            return ranked, None, full and bool(searchMatches(cat, reg, fromDate, match, None, below, 1, False))
+        if len(ranked) > limit:
+            page = ranked[:limit]
+            return page, ('ranked', page[-1][1], page[-1][0], top), False
+        if not full:
+            return ranked, None, False
+        # the window has run out, so the page goes on with the older matches
+        page = ranked
+    else:
+        page, below = [], position[1]
+    older = searchMatches(cat, reg, fromDate, match, None, below, limit + 1 - len(page), False)
+    more = len(page) + len(older) > limit
+    older = older[:limit - len(page)]
+    page = page + older
+    return page, ('older', older[-1][0] if older else below) if more else None, False
+
+
+# check a category, region and date filter is in correct form, returning an error message or None if it is valid
+def validateFilter(cat, reg, date):
+    cats = ['pol', 'art', 'tech', 'trivia', '*']
+    regs = ['uk', 'eu', 'w', '*']
+    if cat not in cats:
+        return "Category should be: 'pol', 'art', 'tech' or 'trivia' if specifying."
+    if reg not in regs:
+        return "Region should be: 'uk', 'eu' or 'w' if specifying"
+    if date != '*':
+        try:
+            dateCheck = datetime.strptime(date, '%d/%m/%Y')
+            if date != dateCheck.strftime('%d/%m/%Y'):
+                return "Date must be valid and in the format: 'dd/mm/YYYY'."
+        except (ValueError, TypeError):
+            return "Date must be valid and in the format: 'dd/mm/YYYY'."
+    return None
+
+
+# queryset of the stories matching a valid category, region and date filter
+def filterStories(cat, reg, date):
+    # get all stories
+    query = Story.objects.all()
+    # get required category if needed
+    if cat != '*':
+        query = query.filter(category=cat)
+    # get required region if needed
+    if reg != '*':
+        query = query.filter(region=reg)
+    # get required dates if needed
+    if date != '*':
+        dateRequired = (datetime.strptime(date, "%d/%m/%Y")).date()
+        query = query.filter(date__gte=dateRequired)
+    return query
+
+
+# check a posted story is in correct form, returning an error message or None if it is valid
+def validateStory(payload):
+    if not isinstance(payload, dict):
+        return "Story should be a JSON object."
+    # check if category and region in correct form
+    cats = ['pol', 'art', 'tech', 'trivia']
+    regs = ['uk', 'eu', 'w']
+    if payload.get('category') not in cats:
+        return "Category should be: 'pol', 'art', 'tech' or 'trivia'."
+    if payload.get('region') not in regs:
+        return "Region should be: 'uk', 'eu' or 'w'"
+    # check that headline and details are not too long
+    if not isinstance(payload.get('headline'), str) or not isinstance(payload.get('details'), str):
+        return "Headline and Details should be strings."
+    if len(payload.get('headline')) > 64 or len(payload.get('details')) > 128:
+        return "Headline should be no more than 64 characters and Details should be no more than 128 characters"
+    return None
+
+
+# make an opaque changes token from the last story id and last deleted story log id seen
+def encodeChangesToken(storyId, deletedId):
+    raw = str(storyId) + '.' + str(deletedId)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+# read a changes token back into (story id, deleted story log id), returning None if it is not valid
+def decodeChangesToken(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        storyId, deletedId = raw.split('.')
+        return int(storyId), int(deletedId)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+# the whole second of a version to send as Last-Modified, or None while that second is still going on: a write
+# later in the same second would leave Last-Modified where it is, so If-Modified-Since would match the old stories
+def lastModifiedOf(version):
+    second = version // 1000000000
+    return second if second < int(time.time()) else None
+
+
+# set the ETag and Last-Modified headers of a stories response, which also varies with the Accept header
+def addValidators(response, etag, lastModified):
+    response['ETag'] = etag
+    if lastModified is not None:
+        response['Last-Modified'] = http_date(lastModified)
+    patch_vary_headers(response, ('Accept',))
+    return response
+
+
+# a GET of every story with no filter and no page size, the costliest request to answer and the first shed under load
+def unfilteredStories(request):
+    return request.method == 'GET' and 'limit' not in request.GET and 'cursor' not in request.GET and \
+        all(request.GET.get(name) == '*' for name in ('story_cat', 'story_region', 'story_date'))
+
 
 # login request
 @csrf_exempt
-def handleLogin(request):
+async def handleLogin(request):
     if(request.method == 'POST'):
         # get username and password
         uname = request.POST.get('username')
@@ -23,13 +350,13 @@ def handleLogin(request):
         if not isinstance(uname, str) or not isinstance(pword, str):
             return HttpResponse("Username and password must be strings.", status=400, content_type='text/plain')
         # check user exists
-        user = authenticate(request, username=uname, password=pword)
+        user = await aauthenticate(request, username=uname, password=pword)
     else:
         # if not post, return appropriate error
         return HttpResponse("Method not allowed.", status=405, content_type='text/plain')
     # login if possible, return httpresponse to client
     if user is not None:
-        login(request, user)
+        await alogin(request, user)
         return HttpResponse("You have logged in. Welcome!", status=200, reason='OK', content_type='text/plain')
     else:
         return HttpResponse("Invalid username or password. Please try again.", status=401, content_type='text/plain')
@@ -37,10 +364,11 @@ def handleLogin(request):
 
 # logout request
 @csrf_exempt
-def handleLogout(request):
+async def handleLogout(request):
     if(request.method == 'POST'):
-        if request.user.is_authenticated:
-            logout(request)
+        user = await request.auser()
+        if user.is_authenticated:
+            await alogout(request)
             return HttpResponse("You have logged out. Goodbye.", status=200, reason='OK', content_type='text/plain')
         else:
             return HttpResponse("You are not logged in.", status=401, content_type='text/plain')
@@ -51,32 +379,31 @@ def handleLogout(request):
 
 # stories request
 @csrf_exempt
-def stories(request):
+async def stories(request):
     # if post -> author posting story
     if(request.method == 'POST'):
         # check if user is authenticated:
-        if not request.user.is_authenticated:
+        user = await request.auser()
+        if not user.is_authenticated:
             return HttpResponse("You are not logged in.", status=503, content_type='text/plain')
         
         # get body of json
         payload = json.loads(request.body)
         
-        # check if category and region in correct form
-        cats = ['pol', 'art', 'tech', 'trivia']
-        regs = ['uk', 'eu', 'w']
-        if payload.get('category') not in cats:
-            return HttpResponse("Category should be: 'pol', 'art', 'tech' or 'trivia'.", status=503, reason='Service Unavailable', content_type='text/plain')
-        if payload.get('region') not in regs:
-            return HttpResponse("Region should be: 'uk', 'eu' or 'w'", status=503, reason='Service Unavailable', content_type='text/plain')
+        # check story is in correct form
+        error = validateStory(payload)
+        if error is not None:
+            return HttpResponse(error, status=503, reason='Service Unavailable', content_type='text/plain')
         
-        # check that headline and details are not too long
-        if len(payload.get('headline')) > 64 or len(payload.get('details')) > 128:
-            return HttpResponse("Headline should be no more than 64 characters and Details should be no more than 128 characters", status=503, reason='Service Unavailable', content_type='text/plain')
-        
-        # if no errors, add story to db
-        currentAuthor = Author.objects.get(user=request.user)
+        # if no errors, add story to db (a request with an API token already knows its author)
+        authorId = getattr(request, 'tokenAuthorId', None)
+        if authorId is None:
+            authorId = (await Author.objects.aget(user=user)).id
         currentDate = datetime.now().date()
-        story = Story.objects.create(headline=payload.get('headline'), category=payload.get('category'), region=payload.get('region'), author=currentAuthor, date=currentDate, details=payload.get('details'))
+        story = await Story.objects.acreate(headline=payload.get('headline'), category=payload.get('category'), region=payload.get('region'), author_id=authorId, date=currentDate, details=payload.get('details'))
+        hotindex.add([storyRow(story, user.username)])
+        await storycache.ainvalidate([(story.category, story.region)])
+        publishStories([story], user.username)
         return HttpResponse(status=201, reason='CREATED')
     
     # if get -> user retrieving stories
@@ -86,69 +413,455 @@ def stories(request):
         date = request.GET.get('story_date')
 
         # check if category, region and date in correct form
-        cats = ['pol', 'art', 'tech', 'trivia', '*']
-        regs = ['uk', 'eu', 'w', '*']
-        if cat not in cats:
-            return HttpResponse("Category should be: 'pol', 'art', 'tech' or 'trivia' if specifying.", status=400, content_type='text/plain')
-        if reg not in regs:
-            return HttpResponse("Region should be: 'uk', 'eu' or 'w' if specifying", status=400, content_type='text/plain')
-        if date != '*':
-            try:
-                dateCheck = datetime.strptime(date, '%d/%m/%Y')
-                if date != dateCheck.strftime('%d/%m/%Y'):
-                    return HttpResponse("Date must be valid and in the format: 'dd/mm/YYYY'.", status=400, content_type='text/plain')
-            except ValueError:
-                    return HttpResponse("Date must be valid and in the format: 'dd/mm/YYYY'.", status=400, content_type='text/plain')
+        error = validateFilter(cat, reg, date)
+        if error is not None:
+            return HttpResponse(error, status=400, content_type='text/plain')
+
+        # full-text search of headlines and details, if asked for
+        search = request.GET.get('q')
+        if search is not None:
+            if connection.vendor != 'sqlite':
+                return HttpResponse("Search is not available.", status=400, content_type='text/plain')
+            match = ftsQuery(search)
+            if match is None:
+                return HttpResponse("Search should contain at least one word.", status=400, content_type='text/plain')
         
-        # get all stories
-        query = Story.objects.all()
-        # get required category if needed
-        if cat != '*':
-            query = query.filter(category=cat)
-        # get required region if needed
-        if reg != '*':
-            query = query.filter(region=reg)
-        # get required dates if needed
-        if date != '*':
-            dateRequired = (datetime.strptime(date, "%d/%m/%Y")).date()
-            query = query.filter(date__gte=dateRequired)
-
-        # return error if no stories found
-        if len(query) == 0 :
-            return HttpResponse("No stories found", status=404, content_type="text/plain")
+        # only page the results if the client asks for it
+        limit = request.GET.get('limit')
+        cursor = request.GET.get('cursor')
+        paginated = limit is not None or cursor is not None
+        if paginated:
+            if limit is None:
+                limit = DEFAULT_PAGE_SIZE
+            elif not limit.isdigit() or not 1 <= int(limit) <= MAX_PAGE_SIZE:
+                return HttpResponse("Limit must be a number between 1 and " + str(MAX_PAGE_SIZE) + ".", status=400, content_type='text/plain')
+            limit = int(limit)
+            if cursor is not None and (decodeSearchCursor(cursor) if search is not None else decodeCursor(cursor)) is None:
+                return HttpResponse("Cursor is not valid.", status=400, content_type='text/plain')
+
+        # JSON, or a compact binary format asked for by the format parameter or the Accept header
+        fmt = formats.negotiate(request.headers.get('Accept', ''), request.GET.get('format'))
+        if fmt is None:
+            return HttpResponse("Format should be one of: " + ", ".join(name for name in formats.MEDIA_TYPES if formats.available(name)) + ".", status=400, content_type='text/plain')
+
+        # validators come from the version of the filtered stories, without reading them, once the versions
+        # have caught up with the posts and deletes of every process
+        sequence = await sync_to_async(storycache.syncVersions)()
+        digest, version = await storycache.afilterState(request.get_host(), cat, reg, date, limit, cursor, search, fmt)
+        etag = '"' + digest + '"'
+        lastModified = lastModifiedOf(version)
+
+        # answer 304 if the client already has the current version of these stories
+        notModified = get_conditional_response(request, etag=etag, last_modified=lastModified)
+        if notModified is not None:
+            return addValidators(notModified, etag, lastModified)
+
+        # answer from the response cache if these stories have not changed since it was stored
+        cacheKey = storycache.responseKey(digest)
+        cached = await storycache.agetResponse(cacheKey)
+        if cached is not None:
+            status, content, contentType = cached
+            response = HttpResponse(content, status=status, content_type=contentType)
+            response['X-Cache'] = 'HIT'
+            return addValidators(response, etag, lastModified)
+
+        # a search is paged by searchPage, and is never streamed as an unpaginated one answers its ranked window only
+        fromDate = None if date == '*' else datetime.strptime(date, "%d/%m/%Y").date()
+        streaming = not paginated and search is None and request.GET.get('stream') == '1' and fmt == 'json'
+        stories = None
+        if search is not None:
+            found, searchNext, truncated = await sync_to_async(searchPage)(cat, reg, fromDate, match, decodeSearchCursor(cursor) if cursor is not None else None, limit if paginated else None)
+            rows = {story['id']: story async for story in Story.objects.filter(id__in=[storyId for storyId, rank in found]).values(*STORY_FIELDS)}
+            stories = [rows[storyId] for storyId, rank in found if storyId in rows]
+        # recent stories come from the in-memory index of this process, when it holds every story the answer needs
+        # (a streamed response is meant for results too large to hold, so it always reads the database)
+        elif not streaming:
+            stories = await hotindex.lookup(cat, reg, fromDate, limit + 1 if paginated else None, decodeCursor(cursor) if cursor is not None else None, sequence)
+
+        if stories is None:
+            # get the stories matching the filter, newest first, with id as a tie-break so the order is stable for paging
+            query = filterStories(cat, reg, date).order_by('-date', '-id')
+            if paginated and cursor is not None:
+                # continue after the last story of the previous page
+                lastDate, lastId = decodeCursor(cursor)
+                query = query.filter(Q(date__lt=lastDate) | Q(date=lastDate, id__lt=lastId))
+            if paginated:
+                # fetch one extra story to know if there is another page
+                query = query[:limit + 1]
+
+            # make queryset into list, joining author usernames in the same query
+            rows = query.values(*STORY_FIELDS)
+
+            # stream large unpaginated JSON results instead of building the whole payload in memory
+            # (ASGI servers send an async iterator as it goes, WSGI servers need a sync one to do the same)
+            if streaming:
+                if isinstance(request, ASGIRequest):
+                    rowIterator = rows.aiterator(chunk_size=STREAM_CHUNK_SIZE)
+                    first = await anext(rowIterator, None)
+                    content = None if first is None else astreamStories(first, rowIterator)
+                else:
+                    rowIterator = rows.iterator(chunk_size=STREAM_CHUNK_SIZE)
+                    first = await sync_to_async(next)(rowIterator, None)
+                    content = None if first is None else streamStories(first, rowIterator)
+                if content is None:
+                    return addValidators(HttpResponse("No stories found", status=404, content_type="text/plain"), etag, lastModified)
+                response = StreamingHttpResponse(content, status=200, content_type='application/json')
+                response['X-Cache'] = 'MISS'
+                return addValidators(response, etag, lastModified)
+
+            stories = [story async for story in rows]
+        nextCursor = nextLink = None
+        if search is not None:
+            nextCursor = encodeSearchCursor(searchNext) if searchNext is not None else None
+        elif paginated and len(stories) > limit:
+            stories = stories[:limit]
+            nextCursor = encodeCursor(stories[-1]['date'], stories[-1]['id'])
+        if nextCursor is not None:
+            params = request.GET.copy()
+            params['limit'] = str(limit)
+            params['cursor'] = nextCursor
+            nextLink = request.build_absolute_uri(request.path + '?' + params.urlencode())
+
+        # format for json
+        story_list = [storyItem(story) for story in stories]
+
+        # return error if no stories found (a later page can be empty if stories were deleted)
+        if len(story_list) == 0 and cursor is None:
+            response = HttpResponse("No stories found", status=404, content_type="text/plain")
         else:
-            # make queryset into list
-            stories = query.values('id', 'headline', 'category', 'region', 'author', 'date', 'details')
-            # format for json
-            story_list = []
-            for story in stories:
-                storyAuthor = Author.objects.get(id=story['author'])
-                authorName = storyAuthor.user.username
-                item = {'key': str(story['id']), 'headline':story['headline'], 'story_cat':story['category'], 'story_region':story['region'], 'author': authorName, 'story_date':story['date'].strftime("%d/%m/%Y"), 'story_details': story['details']}
-                story_list.append(item)
             # make payload
             payload = {'stories': story_list}
-            return HttpResponse(json.dumps(payload), status=200, reason='OK', content_type='application/json')
+            if paginated:
+                payload['next'] = nextLink
+            # an unpaginated search says whether matches older than its ranked window were left out
+            if search is not None:
+                payload['truncated'] = truncated
+            response = HttpResponse(formats.encode(payload, fmt), status=200, reason='OK', content_type=formats.MEDIA_TYPES[fmt])
+        await storycache.astoreResponse(cacheKey, response.status_code, response.content, response['Content-Type'])
+        response['X-Cache'] = 'MISS'
+        return addValidators(response, etag, lastModified)
     else:
         return HttpResponse("Method not allowed.", status=405, content_type='text/plain')
         
 
+# delete a story, logging it for the changes feed, returning it or None if it does not exist
+# (transactions are not available to async code, so this runs in a thread through sync_to_async)
+def deleteStory(id):
+    with transaction.atomic():
+        story = Story.objects.filter(id=id).first()
+        if story is None:
+            return None
+        story.delete()
+        DeletedStory.objects.create(key=id, category=story.category, region=story.region)
+    return story
+
+
 # delete request
 @csrf_exempt
-def delete(request, id):
+async def delete(request, id):
     if(request.method == 'DELETE'):
         
         # check if user is authenticated:
-        if not request.user.is_authenticated:
+        user = await request.auser()
+        if not user.is_authenticated:
             return HttpResponse("You are not logged in.", status=503, reason='Service Unavailable', content_type='text/plain')
 
         # retrieve and delete story
-        try:
-            story = Story.objects.get(id=id)
-            story.delete()
-            return HttpResponse(status = 200, reason='OK')
-        except ObjectDoesNotExist:
+        story = await sync_to_async(deleteStory)(id)
+        if story is None:
             return HttpResponse("Story does not exist.", status=503, reason='Service Unavailable', content_type='text/plain')
+        hotindex.remove([id])
+        await storycache.ainvalidate([(story.category, story.region)])
+        return HttpResponse(status = 200, reason='OK')
+
+    else:
+        return HttpResponse("Method not allowed.", status=503, reason='Service Unavailable', content_type='text/plain')
+
+
+# response cache and hot index statistics
+def cacheStats(request):
+    if(request.method == 'GET'):
+        return HttpResponse(json.dumps(dict(storycache.getStats(), hot_index=hotindex.getStats())), status=200, reason='OK', content_type='application/json')
+    else:
+        return HttpResponse("Method not allowed.", status=405, content_type='text/plain')
+
+
+
+
+# metrics request - request timing histograms in the Prometheus text format
+def metricsText(request):
+    if(request.method == 'GET'):
+        text = metrics.prometheusText()
+        text += '# HELP news_subscribers Open story subscriptions in this process.\n# TYPE news_subscribers gauge\n'
+        text += 'news_subscribers %d\n' % broker.subscriberCount()
+        text += ratelimit.prometheusText()
+        return HttpResponse(text, status=200, reason='OK', content_type='text/plain; version=0.0.4')
+    else:
+        return HttpResponse("Method not allowed.", status=405, content_type='text/plain')
+
+
+# changes request - stories created and deleted since a token from an earlier call
+@csrf_exempt
+def changes(request):
+    if(request.method == 'GET'):
+        cat = request.GET.get('story_cat', '*')
+        reg = request.GET.get('story_region', '*')
+        since = request.GET.get('since')
+        limit = request.GET.get('limit', str(DEFAULT_PAGE_SIZE))
+
+        # check parameters are in correct form
+        if cat not in ['pol', 'art', 'tech', 'trivia', '*']:
+            return HttpResponse("Category should be: 'pol', 'art', 'tech' or 'trivia' if specifying.", status=400, content_type='text/plain')
+        if reg not in ['uk', 'eu', 'w', '*']:
+            return HttpResponse("Region should be: 'uk', 'eu' or 'w' if specifying", status=400, content_type='text/plain')
+        if not limit.isdigit() or not 1 <= int(limit) <= MAX_PAGE_SIZE:
+            return HttpResponse("Limit must be a number between 1 and " + str(MAX_PAGE_SIZE) + ".", status=400, content_type='text/plain')
+        limit = int(limit)
+        # no token means start from the beginning
+        position = (0, 0) if since is None else decodeChangesToken(since)
+        if position is None:
+            return HttpResponse("Token is not valid.", status=400, content_type='text/plain')
+        lastStoryId, lastDeletedId = position
+
+        # stories created and deleted after the token, oldest first
+        created = Story.objects.filter(id__gt=lastStoryId)
+        deleted = DeletedStory.objects.filter(id__gt=lastDeletedId)
+        if cat != '*':
+            created = created.filter(category=cat)
+            deleted = deleted.filter(category=cat)
+        if reg != '*':
+            created = created.filter(region=reg)
+            deleted = deleted.filter(region=reg)
+        # fetch one extra of each to know if there are more changes
+        created = list(created.order_by('id').values(*STORY_FIELDS)[:limit + 1])
+        deleted = list(deleted.order_by('id').values('id', 'key')[:limit + 1])
+        more = len(created) > limit or len(deleted) > limit
+        created, deleted = created[:limit], deleted[:limit]
+
+        # move the token on past everything returned
+        if created:
+            lastStoryId = created[-1]['id']
+        if deleted:
+            lastDeletedId = deleted[-1]['id']
+        payload = {
+            'stories': [storyItem(story) for story in created],
+            'deleted': [str(tombstone['key']) for tombstone in deleted],
+            'next': encodeChangesToken(lastStoryId, lastDeletedId),
+            'more': more,
+        }
+        return HttpResponse(json.dumps(payload), status=200, reason='OK', content_type='application/json')
+    else:
+        return HttpResponse("Method not allowed.", status=405, content_type='text/plain')
+
+
+# subscribe request - new stories matching a category and region filter pushed as Server-Sent Events,
+# or with poll=<seconds> held open until there is at least one (long-polling)
+# either way the stories start after the Last-Event-ID header (or last_event_id parameter) if given, otherwise from now
+@csrf_exempt
+async def subscribe(request):
+    if(request.method == 'GET'):
+        cat = request.GET.get('story_cat', '*')
+        reg = request.GET.get('story_region', '*')
+        lastEventId = request.headers.get('Last-Event-ID', request.GET.get('last_event_id'))
+        poll = request.GET.get('poll')
+
+        # check parameters are in correct form
+        if cat not in ['pol', 'art', 'tech', 'trivia', '*']:
+            return HttpResponse("Category should be: 'pol', 'art', 'tech' or 'trivia' if specifying.", status=400, content_type='text/plain')
+        if reg not in ['uk', 'eu', 'w', '*']:
+            return HttpResponse("Region should be: 'uk', 'eu' or 'w' if specifying", status=400, content_type='text/plain')
+        if lastEventId is not None and not lastEventId.isdigit():
+            return HttpResponse("Last event id should be a story key.", status=400, content_type='text/plain')
+        if poll is not None and (not poll.isdigit() or not 1 <= int(poll) <= MAX_POLL_WAIT):
+            return HttpResponse("Poll must be a number of seconds between 1 and " + str(MAX_POLL_WAIT) + ".", status=400, content_type='text/plain')
+        # a WSGI server would try to read the whole endless stream before sending it
+        if poll is None and not isinstance(request, ASGIRequest):
+            return HttpResponse("Event streams need the ASGI server, use poll=<seconds> to long-poll instead.", status=400, content_type='text/plain')
+
+        # stories start after the last one the client saw, or after the newest story now
+        if lastEventId is None:
+            lastId = await Story.objects.order_by('-id').values_list('id', flat=True).afirst() or 0
+        else:
+            lastId = int(lastEventId)
+
+        if poll is None:
+            response = StreamingHttpResponse(storyEvents(cat, reg, lastId), status=200, content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            # stop proxies buffering the stream
+            response['X-Accel-Buffering'] = 'no'
+            return response
+
+        # subscribe before reading the database so no story falls between the two
+        subscription = broker.subscribe(cat, reg)
+        try:
+            items = [(story['id'], storyItem(story)) for story in await storiesAfter(cat, reg, lastId, MAX_PAGE_SIZE)]
+            if not items:
+                # the stories that end the wait come in the queue, so a post wakes every held request without each
+                # of them reading the database again, unless the queue could not keep up
+                try:
+                    items = [await asyncio.wait_for(subscription.queue.get(), int(poll))]
+                except asyncio.TimeoutError:
+                    # stories posted to other processes never reach this queue, so look once more before answering empty
+                    items = [(story['id'], storyItem(story)) for story in await storiesAfter(cat, reg, lastId, MAX_PAGE_SIZE)]
+                else:
+                    while not subscription.queue.empty() and len(items) < MAX_PAGE_SIZE:
+                        items.append(subscription.queue.get_nowait())
+                    if subscription.lagging:
+                        items = [(story['id'], storyItem(story)) for story in await storiesAfter(cat, reg, lastId, MAX_PAGE_SIZE)]
+                    items = sorted(((storyId, item) for storyId, item in items if storyId > lastId), key=lambda pair: pair[0])
+        finally:
+            broker.unsubscribe(subscription)
+        if items:
+            lastId = items[-1][0]
+        payload = {'stories': [item for storyId, item in items], 'last_event_id': str(lastId)}
+        return HttpResponse(json.dumps(payload), status=200, reason='OK', content_type='application/json')
+    else:
+        return HttpResponse("Method not allowed.", status=405, content_type='text/plain')
+
+
+# bulk stories request - author posting many stories as a JSON array or as NDJSON (one story per line),
+# or deleting many stories at once
+@csrf_exempt
+def bulkStories(request):
+    if(request.method == 'POST'):
+        # check if user is authenticated:
+        if not request.user.is_authenticated:
+            return HttpResponse("You are not logged in.", status=503, content_type='text/plain')
+
+        # read the stories, keeping a line that is not valid JSON as an item that will be rejected
+        if request.content_type in ['application/x-ndjson', 'application/jsonl']:
+            try:
+                lines = request.body.decode().splitlines()
+            except UnicodeDecodeError:
+                return HttpResponse("Body should be UTF-8 text with one JSON story per line.", status=400, content_type='text/plain')
+            items = []
+            for line in lines:
+                if line.strip():
+                    try:
+                        items.append(json.loads(line))
+                    except ValueError:
+                        items.append(None)
+        else:
+            try:
+                items = json.loads(request.body)
+            except ValueError:
+                return HttpResponse("Body should be a JSON array of stories.", status=400, content_type='text/plain')
+            if not isinstance(items, list):
+                return HttpResponse("Body should be a JSON array of stories.", status=400, content_type='text/plain')
+        if len(items) > MAX_BULK_STORIES:
+            return HttpResponse("No more than " + str(MAX_BULK_STORIES) + " stories can be posted at once.", status=400, content_type='text/plain')
+
+        # validate every story with the same rules as a single post
+        authorId = getattr(request, 'tokenAuthorId', None)
+        if authorId is None:
+            authorId = Author.objects.get(user=request.user).id
+        currentDate = datetime.now().date()
+        results = []
+        newStories = []
+        for index, item in enumerate(items):
+            error = "Story should be a JSON object." if item is None else validateStory(item)
+            if error is not None:
+                results.append({'index': index, 'created': False, 'error': error})
+            else:
+                results.append({'index': index, 'created': True})
+                newStories.append(Story(headline=item['headline'], category=item['category'], region=item['region'], author_id=authorId, date=currentDate, details=item['details']))
+
+        # add the valid stories in one transaction
+        with transaction.atomic():
+            newStories = Story.objects.bulk_create(newStories)
+        hotindex.add([storyRow(story, request.user.username) for story in newStories])
+        storycache.invalidate(set((story.category, story.region) for story in newStories))
+        publishStories(newStories, request.user.username)
+
+        # give each created result the key of its story
+        createdResults = [result for result in results if result['created']]
+        for result, story in zip(createdResults, newStories):
+            result['key'] = str(story.id)
+        payload = {'created': len(newStories), 'rejected': len(results) - len(newStories), 'results': results}
+        status = 201 if len(newStories) == len(results) else 200
+        return HttpResponse(json.dumps(payload), status=status, content_type='application/json')
+
+    # if delete -> author removing stories by a list of ids ({"ids": [...]} body) or by the same filter as GET
+    elif(request.method == 'DELETE'):
+        # check if user is authenticated:
+        if not request.user.is_authenticated:
+            return HttpResponse("You are not logged in.", status=503, reason='Service Unavailable', content_type='text/plain')
+
+        if request.body:
+            try:
+                ids = json.loads(request.body).get('ids')
+            except (ValueError, AttributeError):
+                ids = None
+            if not isinstance(ids, list) or not all(isinstance(id, int) for id in ids):
+                return HttpResponse("Body should be a JSON object with a list of story ids: {\"ids\": [...]}.", status=400, content_type='text/plain')
+            if len(ids) > MAX_BULK_STORIES:
+                return HttpResponse("No more than " + str(MAX_BULK_STORIES) + " stories can be deleted by id at once.", status=400, content_type='text/plain')
+            query = Story.objects.filter(id__in=ids)
+        else:
+            cat = request.GET.get('story_cat')
+            reg = request.GET.get('story_region')
+            date = request.GET.get('story_date')
+            error = validateFilter(cat, reg, date)
+            if error is not None:
+                return HttpResponse(error, status=400, content_type='text/plain')
+            query = filterStories(cat, reg, date)
 
+        # log the stories for the changes feed, then remove them with a single DELETE
+        with transaction.atomic():
+            removed = list(query.values_list('id', 'category', 'region'))
+            DeletedStory.objects.bulk_create([DeletedStory(key=id, category=cat, region=reg) for id, cat, reg in removed])
+            count, _ = query.delete()
+        hotindex.remove([id for id, cat, reg in removed])
+        storycache.invalidate(set((cat, reg) for id, cat, reg in removed))
+        return HttpResponse(json.dumps({'deleted': count}), status=200, reason='OK', content_type='application/json')
     else:
-        return HttpResponse("Method not allowed.", status=503, reason='Service Unavailable', content_type='text/plain')
\ No newline at end of file
+        return HttpResponse("Method not allowed.", status=405, content_type='text/plain')
+
+
+# the author of a logged-in request to the tokens views, or an error response
+def tokenAuthor(request):
+    if not request.user.is_authenticated:
+        return None, HttpResponse("You are not logged in.", status=401, content_type='text/plain')
+    author = Author.objects.filter(user=request.user).first()
+    if author is None:
+        return None, HttpResponse("Only authors can have API tokens.", status=403, content_type='text/plain')
+    return author, None
+
+
+# tokens request - list the logged-in author's API tokens, or issue a new one to send as 'Authorization: Token <token>'
+# in place of logging in (the token itself is only shown once, when it is issued)
+@csrf_exempt
+def apiTokens(request):
+    if(request.method == 'GET'):
+        author, error = tokenAuthor(request)
+        if error is not None:
+            return error
+        payload = {'tokens': [{'key': str(token.id), 'name': token.name, 'created': token.created.isoformat(), 'revoked': token.revoked}
+                              for token in ApiToken.objects.filter(author=author).order_by('id')]}
+        return HttpResponse(json.dumps(payload), status=200, reason='OK', content_type='application/json')
+    elif(request.method == 'POST'):
+        author, error = tokenAuthor(request)
+        if error is not None:
+            return error
+        name = request.POST.get('name', '')
+        if len(name) > 64:
+            return HttpResponse("Name should be no more than 64 characters.", status=400, content_type='text/plain')
+        token, value = tokens.issue(author, name)
+        payload = {'key': str(token.id), 'name': token.name, 'token': value}
+        return HttpResponse(json.dumps(payload), status=201, reason='CREATED', content_type='application/json')
+    else:
+        return HttpResponse("Method not allowed.", status=405, content_type='text/plain')
+
+
+# revoke token request - a revoked token is refused straight away by this process, and by others within TOKEN_CACHE_TIMEOUT
+@csrf_exempt
+def revokeToken(request, id):
+    if(request.method == 'DELETE'):
+        author, error = tokenAuthor(request)
+        if error is not None:
+            return error
+        if not tokens.revoke(author, id):
+            return HttpResponse("Token does not exist.", status=404, content_type='text/plain')
+        return HttpResponse(status=200, reason='OK')
+    else:
+        return HttpResponse("Method not allowed.", status=405, content_type='text/plain')
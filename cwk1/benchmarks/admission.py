@@ -0,0 +1,93 @@
+# latency seen by a well-behaved aggregator while another hammers GET /api/stories with unfiltered streamed
+# requests, without admission control and with the rate limits and load shedding of api/ratelimit.py
+# usage: python -m benchmarks.admission [--stories 20000] [--hammers 8] [--duration 30] [--json out.json]
+# clients are told apart by X-Forwarded-For, as the server is told there is one proxy in front of it
+import argparse
+import json
+import threading
+import time
+from urllib.parse import urlencode
+
+from benchmarks.common import setupDjango, migrate, seed, startServer, summarise
+from benchmarks.loadtest import Connection
+
+UNFILTERED = {'story_cat': '*', 'story_region': '*', 'story_date': '*', 'stream': '1'}
+FILTERED = {'story_cat': 'tech', 'story_region': 'uk', 'story_date': '*', 'limit': '20'}
+
+
+# make requests as one client address until the deadline, recording (status, milliseconds) of each
+def client(port, address, params, deadline, pause, results):
+    connection = Connection('127.0.0.1', port, timeout=60)
+    path = '/api/stories?' + urlencode(params)
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        connection.request('GET', path, headers={'X-Forwarded-For': address})
+        response = connection.getresponse()
+        response.read()
+        results.append((response.status, (time.perf_counter() - start) * 1000))
+        if pause:
+            time.sleep(pause)
+
+
+def phase(port, hammers, duration):
+    deadline = time.perf_counter() + duration
+    hammered, polite = [], []
+    threads = [threading.Thread(target=client, args=(port, '10.0.0.1', UNFILTERED, deadline, 0, hammered)) for _ in range(hammers)]
+    threads += [threading.Thread(target=client, args=(port, '10.0.0.%d' % (2 + i), FILTERED, deadline, 0.1, polite)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    def statuses(results):
+        counts = {}
+        for status, _ in results:
+            counts[str(status)] = counts.get(str(status), 0) + 1
+        return counts
+
+    return {
+        'hammer': {'statuses': statuses(hammered), 'latency_ms': summarise([ms for status, ms in hammered if status == 200])},
+        'polite': {'statuses': statuses(polite), 'latency_ms': summarise([ms for status, ms in polite if status == 200])},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure admission control of the stories API under a hammering client.')
+    parser.add_argument('--stories', type=int, default=20000)
+    parser.add_argument('--hammers', type=int, default=8, help='concurrent connections of the hammering client')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of each phase')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    setupDjango()
+    migrate()
+    seed(args.stories)
+    from django.conf import settings
+    from api import ratelimit
+    settings.RATE_LIMIT_TRUSTED_PROXIES = 1
+    server, _ = startServer()
+    port = server.server_address[1]
+
+    report = {'stories': args.stories, 'hammers': args.hammers, 'duration': args.duration}
+    # without admission control, as setupDjango leaves it: no rate limits, and the shedder never sees an overload
+    report['without'] = phase(port, args.hammers, args.duration)
+    # with the limits of the project's settings
+    from cwk1 import settings as projectSettings
+    settings.RATE_LIMIT_ENABLED = True
+    settings.SHED_LATENCY_TARGET, settings.SHED_MAX_CONCURRENCY = projectSettings.SHED_LATENCY_TARGET, projectSettings.SHED_MAX_CONCURRENCY
+    ratelimit.reset()
+    report['with'] = phase(port, args.hammers, args.duration)
+    server.shutdown()
+
+    for name in ['without', 'with']:
+        for role in ['hammer', 'polite']:
+            result = report[name][role]
+            print('%-7s admission control  %-6s statuses %-28s 200s p50 %8.2fms p99 %8.2fms' % (
+                name, role, json.dumps(result['statuses']), result['latency_ms'].get('p50', 0), result['latency_ms'].get('p99', 0)))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
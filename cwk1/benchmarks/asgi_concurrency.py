@@ -0,0 +1,305 @@
+# many simultaneous aggregator connections asking for new stories, by polling GET /api/stories, long-polling or
+# holding an event stream open on GET /api/stories/subscribe, served by the threaded WSGI server (a thread per
+# connection) and by uvicorn running the ASGI application, with the server in its own process
+# usage: python -m benchmarks.asgi_concurrency [--stories 10000] [--connections 50,200,500] [--duration 10]
+#                                              [--modes poll,longpoll,sse] [--interval 0.5] [--writes 2]
+#                                              [--servers wsgi,asgi] [--json out.json]
+# the asgi server needs uvicorn installed ('pip install uvicorn')
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.parse
+
+from benchmarks.common import setupDjango, migrate, seed, startServer, summarise, CATEGORIES, REGIONS
+
+SERVERS = ('wsgi', 'asgi')
+# how aggregators ask for new stories: polling GET /api/stories, long-polling or holding an event stream open
+MODES = ('poll', 'longpoll', 'sse')
+# longest a long-poll is held, in seconds
+LONG_POLL_WAIT = 30
+# start of the headline of every story the publisher posts, followed by the time it was posted
+HEADLINE = 'Bench story '
+
+
+# run a server on the seeded database in this process, printing its port once it is listening
+def serve(kind, dbPath):
+    setupDjango(dbPath)
+    if kind == 'wsgi':
+        server, url = startServer()
+        print(server.server_address[1], flush=True)
+        while True:
+            time.sleep(3600)
+    import uvicorn
+    from django.core.asgi import get_asgi_application
+    # asyncio only turns off Nagle on connections accepted from a socket created for IPPROTO_TCP
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    listener.bind(('127.0.0.1', 0))
+    print(listener.getsockname()[1], flush=True)
+    uvicorn.Server(uvicorn.Config(get_asgi_application(), log_level='warning', access_log=False, lifespan='off')).run(sockets=[listener])
+
+
+# start a server process and wait until it accepts connections
+def startServerProcess(kind, dbPath):
+    process = subprocess.Popen([sys.executable, '-m', 'benchmarks.asgi_concurrency', '--serve', kind, '--db', dbPath],
+                               stdout=subprocess.PIPE, text=True)
+    port = int(process.stdout.readline())
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(kind + ' server did not start')
+
+
+# threads and resident memory of a process, from /proc (linux only, otherwise None)
+def processUsage(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return int(fields['Threads']), int(fields['VmRSS'].split()[0]) // 1024
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+# send one HTTP/1.1 request on a keep-alive connection, returning (status, headers, body)
+# headers are keyed by lower case name, with the name=value of every Set-Cookie under 'cookies'
+async def request(reader, writer, method, path, headers=None, body=b''):
+    lines = [method + ' ' + path + ' HTTP/1.1', 'Host: 127.0.0.1', 'Content-Length: ' + str(len(body))]
+    lines += [name + ': ' + value for name, value in (headers or {}).items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+    await writer.drain()
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+    responseHeaders = {'cookies': []}
+    for line in head[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            name = name.strip().lower()
+            if name == 'set-cookie':
+                responseHeaders['cookies'].append(value.strip().split(';')[0])
+            else:
+                responseHeaders[name] = value.strip()
+    length = int(responseHeaders.get('content-length', 0))
+    return int(head[0].split()[1]), responseHeaders, await reader.readexactly(length) if length else b''
+
+
+# filter query string of a random aggregator
+def aggregatorFilter(rng, **extra):
+    return urllib.parse.urlencode(dict({'story_cat': rng.choice(CATEGORIES + ['*']), 'story_region': rng.choice(REGIONS + ['*'])}, **extra))
+
+
+# seconds since a benchmark story was posted, from the time in its headline
+def storyLag(story, seen):
+    if story['key'] in seen or not story['headline'].startswith(HEADLINE):
+        return None
+    seen.add(story['key'])
+    return (time.time() - float(story['headline'][len(HEADLINE):])) * 1000
+
+
+# one aggregator: polls a filter every interval, sending the ETag it last saw
+async def poller(reader, writer, rng, interval, deadline, results, lags):
+    path = '/api/stories?' + aggregatorFilter(rng, story_date='*', limit='20')
+    etag = None
+    seen = set()
+    # spread the first polls over an interval so the connections do not arrive in lock step
+    await asyncio.sleep(rng.random() * interval)
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        status, headers, body = await request(reader, writer, 'GET', path, {'If-None-Match': etag} if etag else None)
+        results.append((status, (time.perf_counter() - start) * 1000))
+        if status == 200:
+            stories = json.loads(body)['stories']
+            # stories that were there before the first poll do not count as delivered
+            if etag is None:
+                seen.update(story['key'] for story in stories)
+            lags.extend(lag for lag in (storyLag(story, seen) for story in stories) if lag is not None)
+        etag = headers.get('etag', etag)
+        await asyncio.sleep(interval)
+
+
+# one aggregator long-polling the subscribe endpoint, asking again as soon as each answer arrives
+async def longPoller(reader, writer, rng, interval, deadline, results, lags):
+    lastEventId = None
+    seen = set()
+    while time.perf_counter() < deadline:
+        wait = max(1, min(LONG_POLL_WAIT, int(deadline - time.perf_counter())))
+        params = aggregatorFilter(rng, poll=str(wait), **({'last_event_id': lastEventId} if lastEventId else {}))
+        start = time.perf_counter()
+        status, headers, body = await request(reader, writer, 'GET', '/api/stories/subscribe?' + params)
+        results.append((status, (time.perf_counter() - start) * 1000))
+        if status != 200:
+            await asyncio.sleep(interval)
+            continue
+        payload = json.loads(body)
+        lastEventId = payload['last_event_id']
+        lags.extend(lag for lag in (storyLag(story, seen) for story in payload['stories']) if lag is not None)
+
+
+# one aggregator holding an event stream open, reading the chunked body as it arrives
+async def streamReader(reader, writer, rng, interval, deadline, results, lags):
+    start = time.perf_counter()
+    status, headers, _ = await request(reader, writer, 'GET', '/api/stories/subscribe?' + aggregatorFilter(rng))
+    results.append((status, (time.perf_counter() - start) * 1000))
+    if status != 200:
+        return
+    seen = set()
+    buffer = ''
+    while time.perf_counter() < deadline:
+        try:
+            size = int(await asyncio.wait_for(reader.readline(), deadline - time.perf_counter()), 16)
+        except asyncio.TimeoutError:
+            return
+        if size == 0:
+            return
+        buffer += (await reader.readexactly(size + 2))[:-2].decode()
+        events, buffer = buffer.rsplit('\n\n', 1) if '\n\n' in buffer else ('', buffer)
+        for line in events.split('\n'):
+            if line.startswith('data: '):
+                lag = storyLag(json.loads(line[6:]), seen)
+                if lag is not None:
+                    lags.append(lag)
+
+
+CLIENTS = {'poll': poller, 'longpoll': longPoller, 'sse': streamReader}
+
+
+# run one aggregator on its own keep-alive connection
+async def aggregator(port, mode, rng, interval, deadline, results, lags):
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    except OSError:
+        results.append((0, 0.0))
+        return
+    try:
+        await CLIENTS[mode](reader, writer, rng, interval, deadline, results, lags)
+    except (OSError, asyncio.IncompleteReadError, ValueError):
+        results.append((0, 0.0))
+    finally:
+        writer.close()
+
+
+# one publisher adding stories at a steady rate, each headline carrying the time it was posted
+async def publisher(port, writes, deadline, rng):
+    if writes <= 0:
+        return
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = urllib.parse.urlencode({'username': 'bench0', 'password': 'password'}).encode()
+    status, headers, _ = await request(reader, writer, 'POST', '/api/login', {'Content-Type': 'application/x-www-form-urlencoded'}, body)
+    cookie = '; '.join(headers['cookies'])
+    while time.perf_counter() < deadline:
+        story = {'headline': HEADLINE + '%.6f' % time.time(), 'category': rng.choice(CATEGORIES), 'region': rng.choice(REGIONS),
+                 'details': 'Posted while aggregators poll'}
+        await request(reader, writer, 'POST', '/api/stories', {'Content-Type': 'application/json', 'Cookie': cookie},
+                      json.dumps(story).encode())
+        await asyncio.sleep(1 / writes)
+    writer.close()
+
+
+async def runLoad(port, pid, mode, connections, duration, interval, writes, seedValue):
+    rng = random.Random(seedValue)
+    results = []
+    lags = []
+    deadline = time.perf_counter() + duration
+    usage = {'threads': 0, 'rss_mb': 0}
+
+    async def sample():
+        while time.perf_counter() < deadline:
+            threads, rss = processUsage(pid)
+            if threads is not None:
+                usage['threads'] = max(usage['threads'], threads)
+                usage['rss_mb'] = max(usage['rss_mb'], rss)
+            await asyncio.sleep(0.2)
+
+    start = time.perf_counter()
+    tasks = [aggregator(port, mode, random.Random(rng.random()), interval, deadline, results, lags) for _ in range(connections)]
+    await asyncio.gather(sample(), publisher(port, writes, deadline, rng), *tasks)
+    elapsed = time.perf_counter() - start
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': len(results),
+        'requests_per_s': round(len(results) / elapsed, 1),
+        'statuses': statuses,
+        # time to answer a request (for a long-poll, how long it was held)
+        'latency_ms': summarise([latency for status, latency in results if status]),
+        # time from a story being posted to an aggregator receiving it
+        'delivery_ms': summarise(lags),
+        'peak_threads': usage['threads'] or None,
+        'peak_rss_mb': usage['rss_mb'] or None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare WSGI and ASGI serving of many simultaneous polling aggregators.')
+    parser.add_argument('--stories', type=int, default=10000)
+    parser.add_argument('--connections', default='50,200,500', help='comma separated numbers of simultaneous connections')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of load for each run')
+    parser.add_argument('--modes', default='poll', help='comma separated ways of asking for stories: ' + ', '.join(MODES))
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds each polling aggregator waits between polls')
+    parser.add_argument('--writes', type=float, default=2.0, help='stories posted per second during each run')
+    parser.add_argument('--servers', default=','.join(SERVERS))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', help='reuse (or create and keep) a seeded database at this path')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--serve', choices=SERVERS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.db)
+        return
+
+    seeded = args.db is not None and os.path.exists(args.db)
+    dbPath = setupDjango(args.db)
+    migrate()
+    if not seeded:
+        seed(args.stories, randomSeed=args.seed)
+    from django.db import connection
+    connection.close()
+
+    # keep clients from running out of file descriptors with many connections
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    report = {'config': {'stories': args.stories, 'duration_s': args.duration, 'interval_s': args.interval, 'writes_per_s': args.writes,
+                         'modes': args.modes,
+                         'python': platform.python_version(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S')},
+              'runs': []}
+    for mode in args.modes.split(','):
+        for kind in args.servers.split(','):
+            # event streams are only served over ASGI
+            if mode == 'sse' and kind == 'wsgi':
+                continue
+            for connections in [int(count) for count in args.connections.split(',')]:
+                process, port = startServerProcess(kind, dbPath)
+                try:
+                    result = asyncio.run(runLoad(port, process.pid, mode, connections, args.duration, args.interval, args.writes, args.seed))
+                finally:
+                    process.terminate()
+                    process.wait()
+                result = dict({'mode': mode, 'server': kind, 'connections': connections}, **result)
+                report['runs'].append(result)
+                print('%-8s %s %5d connections: %7.1f req/s, %5d delivered, delivery p50 %s ms p99 %s ms, %s threads, %s MB' % (
+                    mode, kind, connections, result['requests_per_s'], result['delivery_ms']['count'], result['delivery_ms'].get('p50'),
+                    result['delivery_ms'].get('p99'), result['peak_threads'], result['peak_rss_mb']))
+
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
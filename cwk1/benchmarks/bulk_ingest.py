@@ -0,0 +1,62 @@
+# compare stories/second of single POST /api/stories against POST /api/stories/bulk
+# usage: python -m benchmarks.bulk_ingest [--stories 2000] [--json out.json]
+import argparse
+import json
+import random
+import time
+
+from benchmarks.common import setupDjango, migrate, testClient, loginAuthor, CATEGORIES, REGIONS
+
+
+def makeStories(count, rng):
+    return [{'headline': 'Headline %d' % i, 'category': rng.choice(CATEGORIES), 'region': rng.choice(REGIONS),
+             'details': 'Details of story %d' % i} for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare single and bulk story ingestion throughput.')
+    parser.add_argument('--stories', type=int, default=2000)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    setupDjango()
+    migrate()
+    client = testClient()
+    loginAuthor(client)
+    rng = random.Random(1)
+
+    # one request per story
+    stories = makeStories(args.stories, rng)
+    start = time.perf_counter()
+    for story in stories:
+        client.post('/api/stories', json.dumps(story), content_type='application/json')
+    single = time.perf_counter() - start
+
+    # one request for all of them
+    stories = makeStories(args.stories, rng)
+    start = time.perf_counter()
+    response = client.post('/api/stories/bulk', json.dumps(stories), content_type='application/json')
+    bulk = time.perf_counter() - start
+    assert response.json()['created'] == args.stories
+
+    # NDJSON body
+    body = '\n'.join(json.dumps(story) for story in makeStories(args.stories, rng))
+    start = time.perf_counter()
+    client.post('/api/stories/bulk', body, content_type='application/x-ndjson')
+    ndjson = time.perf_counter() - start
+
+    report = {
+        'stories': args.stories,
+        'single_per_s': round(args.stories / single, 1),
+        'bulk_json_per_s': round(args.stories / bulk, 1),
+        'bulk_ndjson_per_s': round(args.stories / ndjson, 1),
+        'speedup': round(single / bulk, 1),
+    }
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# shared helpers for the benchmark scripts
+# run from the cwk1 folder, e.g. 'python -m benchmarks.story_indexes --rows 1000000'
+import itertools
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+# make the project importable when running a benchmark as a module or a script
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+if str(PROJECT_DIR) not in sys.path:
+    sys.path.insert(0, str(PROJECT_DIR))
+
+CATEGORIES = ['pol', 'art', 'tech', 'trivia']
+REGIONS = ['uk', 'eu', 'w']
+# words for generated headlines and details, drawn with a skewed distribution like real text
+WORDS = ['word%d' % i for i in range(5000)]
+
+
+# point django at a throwaway sqlite database (never the real db.sqlite3) and start it up
+def setupDjango(dbPath=None):
+    if dbPath is None:
+        dbPath = os.path.join(tempfile.mkdtemp(prefix='news-bench-'), 'bench.sqlite3')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cwk1.settings')
+    import django
+    from django.conf import settings
+    settings.DATABASES['default']['NAME'] = dbPath
+    settings.DEBUG = False
+    # the benchmarks serve and request on the local machine
+    settings.ALLOWED_HOSTS = ['127.0.0.1', 'localhost', 'testserver']
+    # every request comes from one address, so the rate limits and load shedding of api/ratelimit.py would measure
+    # themselves rather than the code under test (benchmarks/admission.py turns them on where it measures them)
+    settings.RATE_LIMIT_ENABLED, settings.SHED_LATENCY_TARGET, settings.SHED_MAX_CONCURRENCY = False, float('inf'), 1000000
+    django.setup()
+    return dbPath
+
+
+# serve the project's wsgi application on a free local port from a background thread, returning (server, base url)
+def startServer():
+    import threading
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        # send small responses straight away rather than waiting on delayed acks
+        def setup(self):
+            super().setup()
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler, allow_reuse_address=False)
+    server.set_app(WSGIHandler())
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+# bring the schema up to a migration, e.g. migrate('0002') or migrate() for the latest
+def migrate(target=None):
+    from django.core.management import call_command
+    if target is None:
+        call_command('migrate', verbosity=0)
+    else:
+        call_command('migrate', 'api', target, verbosity=0)
+
+
+# bulk seed users, authors and stories spread over the last 'days' days
+# users are named bench0, bench1, ... and all have the password 'password'
+def seed(stories, authors=100, days=365, batchSize=10000, randomSeed=1):
+    from django.contrib.auth.hashers import make_password
+    from django.contrib.auth.models import User
+    from django.db import transaction
+    from api.models import Author, Story
+
+    rng = random.Random(randomSeed)
+    cumWeights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(WORDS))))
+
+    def text(count):
+        return ' '.join(rng.choices(WORDS, cum_weights=cumWeights, k=count))
+
+    # hash the shared password once rather than once per user
+    password = make_password('password')
+    with transaction.atomic():
+        users = User.objects.bulk_create([User(username='bench%d' % i, password=password) for i in range(authors)])
+        authorList = Author.objects.bulk_create([Author(user=user) for user in users])
+        authorIds = [author.id for author in authorList]
+        today = date.today()
+        for start in range(0, stories, batchSize):
+            batch = []
+            for i in range(start, min(start + batchSize, stories)):
+                batch.append(Story(headline=text(5)[:64], category=rng.choice(CATEGORIES), region=rng.choice(REGIONS),
+                                   author_id=rng.choice(authorIds), date=today - timedelta(days=rng.randrange(days)),
+                                   details=text(12)[:128]))
+            Story.objects.bulk_create(batch)
+    return authorIds
+
+
+# time a function a number of times, returning latency percentiles in milliseconds
+def measure(fn, repeat=20, warmup=2):
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return summarise(timings)
+
+
+# turn a list of millisecond timings into percentiles
+def summarise(timings):
+    timings = sorted(timings)
+    if not timings:
+        return {'count': 0}
+
+    def percentile(p):
+        return round(timings[min(len(timings) - 1, int(p / 100 * len(timings)))], 3)
+
+    return {'count': len(timings), 'mean': round(sum(timings) / len(timings), 3),
+            'p50': percentile(50), 'p95': percentile(95), 'p99': percentile(99), 'max': round(timings[-1], 3)}
+
+
+# a django test client for driving the real url routes in-process
+def testClient():
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+    from django.conf import settings
+    # allows the 'testserver' host used by the test client
+    if 'testserver' not in settings.ALLOWED_HOSTS:
+        setup_test_environment()
+    return Client()
+
+
+# create a user with an author and log a test client in as them
+def loginAuthor(client, username='publisher'):
+    from django.contrib.auth.models import User
+    from api.models import Author
+    user = User.objects.create(username=username)
+    Author.objects.create(user=user)
+    client.force_login(user)
+    return user
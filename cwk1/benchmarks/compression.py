@@ -0,0 +1,75 @@
+# bytes on the wire and CPU per request of GET /api/stories for each content encoding and page size,
+# with the compressed bytes reused from the cache and with them compressed again on every request
+# usage: python -m benchmarks.compression [--stories 20000] [--repeat 50] [--json out.json]
+# br and zstd are only measured when brotli and zstandard are installed
+import argparse
+import json
+import time
+
+from benchmarks.common import setupDjango, migrate, seed, testClient, summarise
+
+PAGE_SIZES = [20, 100, 1000]
+
+
+# CPU milliseconds of each of 'repeat' calls of a function
+def cpuTimes(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.process_time()
+        fn()
+        timings.append((time.process_time() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure response compression of the stories feed.')
+    parser.add_argument('--stories', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    setupDjango()
+    migrate()
+    seed(args.stories)
+
+    from api import compression, storycache
+    client = testClient()
+    encodings = ['identity'] + [encoding for encoding in compression.PREFERENCE if encoding in compression.ENCODERS]
+    report = {'stories': args.stories, 'repeat': args.repeat, 'pages': {}}
+    for limit in PAGE_SIZES:
+        params = {'story_cat': '*', 'story_region': '*', 'story_date': '*', 'limit': str(limit)}
+        results = {}
+        for encoding in encodings:
+            def get():
+                return client.get('/api/stories', params, HTTP_ACCEPT_ENCODING=encoding)
+
+            # warm the response and compressed caches, then time requests served from them
+            response = get()
+            size = len(response.content)
+            reused = cpuTimes(get, args.repeat)
+
+            # the same requests compressing every time, by dropping the compressed copy before each one
+            def getRecompressed():
+                storycache.storyCache().delete(storycache.compressedKey('/api/stories', response['ETag'].removeprefix('W/'), encoding))
+                get()
+
+            recompressed = cpuTimes(getRecompressed, args.repeat) if encoding != 'identity' else reused
+            results[encoding] = {
+                'bytes': size,
+                'ratio': round(size / results['identity']['bytes'], 3) if encoding != 'identity' else 1.0,
+                'cpu_ms_reused': summarise(reused),
+                'cpu_ms_recompressed': summarise(recompressed),
+            }
+            print('limit %4d %-8s %8d bytes (%5.1f%%), CPU per request p50 %.3f ms reused, %.3f ms compressing each time' % (
+                limit, encoding, size, results[encoding]['ratio'] * 100, results[encoding]['cpu_ms_reused']['p50'],
+                results[encoding]['cpu_ms_recompressed']['p50']))
+        report['pages'][str(limit)] = results
+
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# latency of GET /api/stories answered by the in-memory hot index and by the database, and the index's memory
+# usage: python -m benchmarks.hot_index [--stories 500000] [--days 365] [--repeat 50] [--json out.json]
+# the response cache entry of each request is dropped before it, so every request builds its response
+import argparse
+import json
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+from benchmarks.common import setupDjango, migrate, seed, testClient, measure
+
+
+# recent-story requests an aggregator makes, all of them inside the index window
+def requestCases():
+    since = (date.today() - timedelta(days=6)).strftime('%d/%m/%Y')
+    return {
+        'cat+region page': {'story_cat': 'tech', 'story_region': 'uk', 'story_date': '*', 'limit': '20'},
+        'all page': {'story_cat': '*', 'story_region': '*', 'story_date': '*', 'limit': '100'},
+        'region since 7 days': {'story_cat': '*', 'story_region': 'eu', 'story_date': since},
+        'cat+region since 7 days': {'story_cat': 'pol', 'story_region': 'w', 'story_date': since},
+    }
+
+
+def run(client, repeat):
+    from api import storycache
+    results = {}
+    for name, params in requestCases().items():
+        etag = client.get('/api/stories', params)['ETag']
+
+        def get():
+            storycache.storyCache().delete(storycache.responseKey(etag.strip('"')))
+            return client.get('/api/stories', params)
+
+        results[name] = {'stories': len(get().json()['stories']), 'latency_ms': measure(get, repeat=repeat)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare stories requests answered by the hot index and by the database.')
+    parser.add_argument('--stories', type=int, default=500000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    setupDjango()
+    migrate()
+    seed(args.stories, days=args.days)
+
+    from django.conf import settings
+    from django.test.utils import override_settings
+    from api import hotindex
+    client = testClient()
+    report = {'stories': args.stories, 'days': args.days, 'hot_index_days': settings.HOT_INDEX_DAYS}
+
+    # build time and memory of the index
+    tracemalloc.start()
+    start = time.perf_counter()
+    hotindex.index = hotindex.build()
+    buildSeconds = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    held = len(hotindex.index.stories)
+    report['index'] = {'stories': held, 'build_s': round(buildSeconds, 3), 'bytes': memory,
+                       'bytes_per_story': round(memory / held) if held else 0}
+    print('index: %d stories built in %.2fs, %.1f MB (%d bytes per story)' % (
+        held, buildSeconds, memory / 1e6, report['index']['bytes_per_story']))
+
+    report['hot_index'] = run(client, args.repeat)
+    with override_settings(HOT_INDEX_DAYS=0):
+        report['database'] = run(client, args.repeat)
+
+    for name in report['hot_index']:
+        hot, database = report['hot_index'][name], report['database'][name]
+        print('%-24s %5d stories  hot index p50 %.3fms p95 %.3fms  database p50 %.3fms p95 %.3fms' % (
+            name, hot['stories'], hot['latency_ms']['p50'], hot['latency_ms']['p95'], database['latency_ms']['p50'],
+            database['latency_ms']['p95']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+# concurrent load test of the api routes (GET filters, POST, DELETE, login), reporting req/s and latency as JSON
+# usage: python -m benchmarks.loadtest [--stories 10000] [--authors 100] [--concurrency 8] [--duration 10]
+#                                      [--mix get=80,search=5,post=8,delete=4,login=3] [--db path] [--json out.json]
+import argparse
+import http.client
+import http.cookies
+import json
+import os
+import platform
+import random
+import socket
+import threading
+import time
+import urllib.parse
+from datetime import date, timedelta
+
+from benchmarks.common import setupDjango, migrate, seed, startServer, summarise, CATEGORIES, REGIONS, WORDS
+
+DEFAULT_MIX = 'get=80,search=5,post=8,delete=4,login=3'
+
+
+# keep-alive connection that sends small requests straight away rather than waiting on delayed acks
+class Connection(http.client.HTTPConnection):
+
+    def connect(self):
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+# one simulated client with its own keep-alive connection and cookies
+class Worker:
+
+    def __init__(self, host, port, rng, authors, maxStoryId):
+        self.connection = Connection(host, port, timeout=30)
+        self.rng = rng
+        self.authors = authors
+        self.maxStoryId = maxStoryId
+        self.cookies = {}
+        self.results = []
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join(name + '=' + value for name, value in self.cookies.items())
+        try:
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            # reconnect after a dropped connection
+            self.connection.close()
+            return 0
+        for header in response.msg.get_all('Set-Cookie') or []:
+            for name, morsel in http.cookies.SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        return response.status
+
+    def login(self):
+        body = urllib.parse.urlencode({'username': 'bench%d' % self.rng.randrange(self.authors), 'password': 'password'})
+        return self.request('POST', '/api/login', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+
+    def get(self):
+        params = {
+            'story_cat': self.rng.choice(CATEGORIES + ['*']),
+            'story_region': self.rng.choice(REGIONS + ['*']),
+            'story_date': self.rng.choice(['*', (date.today() - timedelta(days=self.rng.randrange(30))).strftime('%d/%m/%Y')]),
+            'limit': '50',
+        }
+        return self.request('GET', '/api/stories?' + urllib.parse.urlencode(params))
+
+    def search(self):
+        params = {'story_cat': '*', 'story_region': '*', 'story_date': '*', 'limit': '20',
+                  'q': self.rng.choice(WORDS[100:2000])}
+        return self.request('GET', '/api/stories?' + urllib.parse.urlencode(params))
+
+    def post(self):
+        story = {'headline': 'Load test story', 'category': self.rng.choice(CATEGORIES), 'region': self.rng.choice(REGIONS),
+                 'details': 'Posted by the load test'}
+        return self.request('POST', '/api/stories', json.dumps(story), {'Content-Type': 'application/json'})
+
+    def delete(self):
+        return self.request('DELETE', '/api/stories/%d' % self.rng.randint(1, self.maxStoryId))
+
+    # run operations picked from the mix until the deadline
+    def run(self, mix, deadline):
+        operations, weights = zip(*mix.items())
+        self.login()
+        while time.perf_counter() < deadline:
+            operation = self.rng.choices(operations, weights)[0]
+            start = time.perf_counter()
+            status = getattr(self, operation)()
+            self.results.append((operation, status, (time.perf_counter() - start) * 1000))
+        self.connection.close()
+
+
+def parseMix(text):
+    mix = {}
+    for part in text.split(','):
+        name, weight = part.split('=')
+        if name not in ('get', 'search', 'post', 'delete', 'login'):
+            raise argparse.ArgumentTypeError('Unknown operation: ' + name)
+        mix[name] = float(weight)
+    return mix
+
+
+# req/s, status codes and latency percentiles for each operation and overall
+def report(results, elapsed):
+    operations = {}
+    for operation in sorted(set(result[0] for result in results)):
+        selected = [result for result in results if result[0] == operation]
+        statuses = {}
+        for _, status, _ in selected:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        operations[operation] = {
+            'requests': len(selected),
+            'req_per_s': round(len(selected) / elapsed, 1),
+            'statuses': statuses,
+            'latency_ms': summarise([result[2] for result in selected]),
+        }
+    return {
+        'requests': len(results),
+        'req_per_s': round(len(results) / elapsed, 1),
+        'errors': sum(1 for result in results if result[1] == 0 or result[1] >= 500),
+        'latency_ms': summarise([result[2] for result in results]),
+        'operations': operations,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the news api routes and report throughput and latency as JSON.')
+    parser.add_argument('--stories', type=int, default=10000)
+    parser.add_argument('--authors', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of load')
+    parser.add_argument('--mix', type=parseMix, default=parseMix(DEFAULT_MIX), help='operation weights, default ' + DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the data and the request mix')
+    parser.add_argument('--db', help='reuse (or create and keep) a seeded database at this path')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    seeded = args.db is not None and os.path.exists(args.db)
+    setupDjango(args.db)
+    migrate()
+    if not seeded:
+        start = time.perf_counter()
+        seed(args.stories, authors=args.authors, randomSeed=args.seed)
+        print('Seeded %d stories by %d authors in %.1fs' % (args.stories, args.authors, time.perf_counter() - start))
+
+    from django.db import connection
+    from api.models import Story
+    maxStoryId = Story.objects.order_by('-id').values_list('id', flat=True).first() or 1
+    connection.close()
+
+    server, url = startServer()
+    host, port = server.server_address
+    workers = [Worker(host, port, random.Random(args.seed * 1000 + i), args.authors, maxStoryId) for i in range(args.concurrency)]
+    start = time.perf_counter()
+    deadline = start + args.duration
+    threads = [threading.Thread(target=worker.run, args=(args.mix, deadline)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    results = [result for worker in workers for result in worker.results]
+    output = {
+        'config': {'stories': args.stories, 'authors': args.authors, 'concurrency': args.concurrency, 'duration_s': args.duration,
+                   'mix': args.mix, 'seed': args.seed, 'python': platform.python_version(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'results': report(results, elapsed),
+    }
+    print(json.dumps(output, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
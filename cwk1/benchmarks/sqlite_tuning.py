@@ -0,0 +1,55 @@
+# mixed read/write load test of the api with SQLite's defaults and with the tuned settings (WAL, synchronous=NORMAL,
+# busy_timeout, cache_size, mmap_size, immediate transactions and persistent connections), each on a fresh database
+# usage: python -m benchmarks.sqlite_tuning [--stories 10000] [--concurrency 8] [--duration 10]
+#                                           [--mix get=55,search=5,post=25,delete=15] [--json out.json]
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+DEFAULT_MIX = 'get=55,search=5,post=25,delete=15'
+
+# environment of each profile, read by cwk1/settings.py
+PROFILES = {
+    'default': {'SQLITE_TUNING': '0', 'DB_CONN_MAX_AGE': '0'},
+    'tuned': {'SQLITE_TUNING': '1', 'SQLITE_JOURNAL_MODE': 'WAL', 'DB_CONN_MAX_AGE': '60'},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare SQLite defaults with the tuned settings under mixed reads and writes.')
+    parser.add_argument('--stories', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of load for each profile')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='operation weights, default ' + DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    report = {'config': vars(args), 'profiles': {}}
+    for name, environment in PROFILES.items():
+        # each profile gets its own database, as WAL mode stays with a database file once set
+        with tempfile.TemporaryDirectory(prefix='news-bench-') as folder:
+            output = os.path.join(folder, 'result.json')
+            subprocess.run([sys.executable, '-m', 'benchmarks.loadtest', '--stories', str(args.stories), '--concurrency', str(args.concurrency),
+                            '--duration', str(args.duration), '--mix', args.mix, '--seed', str(args.seed),
+                            '--db', os.path.join(folder, 'bench.sqlite3'), '--json', output],
+                           env=dict(os.environ, **environment), stdout=subprocess.DEVNULL, check=True)
+            with open(output) as f:
+                results = json.load(f)['results']
+        report['profiles'][name] = results
+        writes = {operation: results['operations'].get(operation, {}).get('statuses', {}) for operation in ('post', 'delete')}
+        print('%-8s %7.1f req/s, %4d errors, p50 %s ms, p99 %s ms, post %s, delete %s' % (
+            name, results['req_per_s'], results['errors'], results['latency_ms'].get('p50'), results['latency_ms'].get('p99'),
+            writes['post'], writes['delete']))
+
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# compare query plans and latency of the stories filters before and after the 0003 indexes
+# usage: python -m benchmarks.story_indexes [--rows 1000000] [--repeat 20] [--json out.json]
+import argparse
+import json
+import time
+from datetime import date, timedelta
+
+from benchmarks.common import setupDjango, migrate, seed, measure
+
+
+# the filter combinations the stories view builds, each as a first page of 100 newest stories
+def filterCases():
+    from api.models import Story
+    since = date.today() - timedelta(days=7)
+    ordered = Story.objects.order_by('-date', '-id')
+    return {
+        'cat+region+date': ordered.filter(category='tech', region='uk', date__gte=since),
+        'region+date': ordered.filter(region='eu', date__gte=since),
+        'date': ordered.filter(date__gte=since),
+        'cat+region': ordered.filter(category='pol', region='w'),
+        'all': ordered,
+    }
+
+
+def run(repeat):
+    results = {}
+    for name, query in filterCases().items():
+        page = query.values('id', 'headline', 'category', 'region', 'author__user__username', 'date', 'details')[:100]
+        results[name] = {
+            'plan': page.explain(),
+            'latency_ms': measure(lambda: list(page.all()), repeat=repeat),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare stories query plans and latency before and after the 0003 indexes.')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    dbPath = setupDjango()
+    # a fresh database with the stories app migrated only as far as before the indexes, so no later
+    # migration is applied and then unapplied around the measurement (seeding needs nothing added after 0002)
+    from django.core.management import call_command
+    call_command('migrate', 'auth', verbosity=0)
+    migrate('0002')
+    start = time.perf_counter()
+    seed(args.rows)
+    print('Seeded %d stories in %.1fs (%s)' % (args.rows, time.perf_counter() - start, dbPath))
+
+    report = {'rows': args.rows}
+    report['before'] = run(args.repeat)
+    start = time.perf_counter()
+    migrate('0003')
+    report['index_build_s'] = round(time.perf_counter() - start, 3)
+    from django.db import connection
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+    report['after'] = run(args.repeat)
+
+    for name in report['before']:
+        before, after = report['before'][name], report['after'][name]
+        print('\n== %s ==' % name)
+        print('before: p50 %.3fms p95 %.3fms\n  %s' % (before['latency_ms']['p50'], before['latency_ms']['p95'], before['plan'].replace('\n', '\n  ')))
+        print('after:  p50 %.3fms p95 %.3fms\n  %s' % (after['latency_ms']['p50'], after['latency_ms']['p95'], after['plan'].replace('\n', '\n  ')))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
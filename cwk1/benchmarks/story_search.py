@@ -0,0 +1,52 @@
+# latency of full-text searches through GET /api/stories?q=
+# usage: python -m benchmarks.story_search [--rows 1000000] [--repeat 20] [--json out.json]
+import argparse
+import json
+import time
+
+from benchmarks.common import setupDjango, migrate, seed, measure, testClient
+
+
+# searches from common to rare words, each for a first page of 20 stories
+SEARCHES = {
+    'common word': 'word0',
+    'mid word': 'word50',
+    'rare word': 'word4000',
+    'two words': 'word3 word7',
+    'rare pair': 'word900 word1200',
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure full-text search latency on the stories feed.')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    setupDjango()
+    migrate()
+    start = time.perf_counter()
+    seed(args.rows)
+    print('Seeded %d stories in %.1fs' % (args.rows, time.perf_counter() - start))
+
+    # skip the response cache so every request runs the search
+    from api import storycache
+    client = testClient()
+    report = {'rows': args.rows, 'searches': {}}
+    for name, search in SEARCHES.items():
+        params = {'story_cat': '*', 'story_region': '*', 'story_date': '*', 'q': search, 'limit': '20'}
+
+        def request():
+            storycache.storyCache().clear()
+            assert client.get('/api/stories', params).status_code in (200, 404)
+
+        report['searches'][name] = {'q': search, 'latency_ms': measure(request, repeat=args.repeat)}
+        print('%-12s %-20s p50 %8.3fms p95 %8.3fms' % (name, search, report['searches'][name]['latency_ms']['p50'], report['searches'][name]['latency_ms']['p95']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
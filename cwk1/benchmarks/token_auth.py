@@ -0,0 +1,83 @@
+# database queries and latency of the write paths (POST and DELETE /api/stories) logged in with a session under each
+# SESSION_PROFILE, and with an API token; also the cost of the password login a publisher makes for a session
+# usage: python -m benchmarks.token_auth [--stories 10000] [--repeat 200] [--json out.json]
+import argparse
+import json
+import re
+
+from benchmarks.common import setupDjango, migrate, seed, testClient, measure
+
+STORY = {'headline': 'Benchmark', 'category': 'tech', 'region': 'uk', 'details': 'Posted by the token benchmark'}
+
+
+# post a story and delete it again 'repeat' times, returning the latency and queries of each
+def run(client, repeat, headers):
+    from api.models import Story
+    posts, deletes = [], []
+
+    def post():
+        response = client.post('/api/stories', json.dumps(STORY), content_type='application/json', headers=headers)
+        assert response.status_code == 201, response.content
+        posts.append(int(re.search(r'"(\d+) queries"', response['Server-Timing']).group(1)))
+
+    def delete():
+        storyId = Story.objects.order_by('-id').values_list('id', flat=True).first()
+        response = client.delete('/api/stories/' + str(storyId), headers=headers)
+        assert response.status_code == 200, response.content
+        deletes.append(int(re.search(r'"(\d+) queries"', response['Server-Timing']).group(1)))
+
+    postLatency = measure(post, repeat=repeat)
+    deleteLatency = measure(delete, repeat=repeat)
+    return {'post_ms': postLatency, 'post_queries': max(posts), 'delete_ms': deleteLatency, 'delete_queries': max(deletes)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare session and token authentication on the write paths.')
+    parser.add_argument('--stories', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    setupDjango()
+    migrate()
+    seed(args.stories)
+
+    from django.test.utils import override_settings
+    from api import tokens
+    from api.models import Author
+    author = Author.objects.select_related('user').first()
+    report = {'stories': args.stories, 'repeat': args.repeat}
+
+    # the password login a session needs, and the first check of a token that is not yet cached
+    client = testClient()
+    report['login_ms'] = measure(lambda: client.post('/api/login', {'username': author.user.username, 'password': 'password'}), repeat=20)
+    _, token = tokens.issue(author)
+    digest = tokens.digestOf(token)
+
+    def coldVerify():
+        tokens.tokenCache().delete(tokens.cacheKey(digest))
+        tokens.verify(token)
+
+    report['token_verify_cold_ms'] = measure(coldVerify, repeat=args.repeat)
+    report['token_verify_cached_ms'] = measure(lambda: tokens.verify(token), repeat=args.repeat)
+
+    for profile in ['db', 'cached_db', 'signed_cookies']:
+        with override_settings(SESSION_ENGINE='django.contrib.sessions.backends.' + profile):
+            client = testClient()
+            client.force_login(author.user)
+            report['session_' + profile] = run(client, args.repeat, {})
+    report['token'] = run(testClient(), args.repeat, {'Authorization': 'Token ' + token})
+
+    print('password login p50 %.2fms, token check p50 %.3fms uncached, %.3fms cached' % (
+        report['login_ms']['p50'], report['token_verify_cold_ms']['p50'], report['token_verify_cached_ms']['p50']))
+    for name in ['session_db', 'session_cached_db', 'session_signed_cookies', 'token']:
+        result = report[name]
+        print('%-24s POST p50 %.3fms (%d queries)  DELETE p50 %.3fms (%d queries)' % (
+            name, result['post_ms']['p50'], result['post_queries'], result['delete_ms']['p50'], result['delete_queries']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
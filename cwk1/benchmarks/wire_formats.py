@@ -0,0 +1,61 @@
+# bytes and CPU to encode (server) and decode (client) a stories payload as JSON, MessagePack and columnar MessagePack
+# usage: python -m benchmarks.wire_formats [--stories 10000] [--repeat 20] [--json out.json]
+import argparse
+import gzip
+import json
+import sys
+
+from benchmarks.common import PROJECT_DIR, setupDjango, migrate, seed, measure
+
+SIZES = [100, 1000, 10000]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the wire formats of the stories feed.')
+    parser.add_argument('--stories', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    setupDjango()
+    migrate()
+    seed(args.stories)
+
+    from api import formats
+    from api.models import Story
+    from api.views import STORY_FIELDS, storyItem
+    # the client's decoder, from the myclient folder next to the project
+    sys.path.insert(0, str(PROJECT_DIR.parent / 'myclient'))
+    import formats as clientFormats
+
+    if formats.msgpack is None:
+        print('msgpack is not installed, only JSON can be measured')
+    names = [name for name in ['json', 'msgpack', 'columnar'] if formats.available(name)]
+    report = {'stories': args.stories, 'repeat': args.repeat, 'sizes': {}}
+    for size in [size for size in SIZES if size <= args.stories]:
+        payload = {'stories': [storyItem(story) for story in Story.objects.order_by('-date', '-id').values(*STORY_FIELDS)[:size]]}
+        results = {}
+        for name in names:
+            body = formats.encode(payload, name)
+            body = body.encode() if isinstance(body, str) else body
+            contentType = formats.MEDIA_TYPES[name]
+            assert clientFormats.decode(contentType, body) == payload
+            results[name] = {
+                'bytes': len(body),
+                'gzip_bytes': len(gzip.compress(body, compresslevel=6)),
+                'encode_ms': measure(lambda: formats.encode(payload, name), repeat=args.repeat),
+                'decode_ms': measure(lambda: clientFormats.decode(contentType, body), repeat=args.repeat),
+            }
+            print('%5d stories %-8s %8d bytes (%7d gzipped), encode p50 %.3f ms, decode p50 %.3f ms' % (
+                size, name, results[name]['bytes'], results[name]['gzip_bytes'], results[name]['encode_ms']['p50'],
+                results[name]['decode_ms']['p50']))
+        report['sizes'][str(size)] = results
+
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,10 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
 from pathlib import Path
+import os
+
+# the project needs Django 5.1 or later (see requirements.txt): the async views use aauthenticate, alogin,
+# request.auser() and the async cache methods, and the SQLite settings below use transaction_mode
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -20,7 +24,9 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
 
 # SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = 'django-insecure-g64$y-@(h3bblog#l51=li#iqzvs7=v7cga&h4+ukksrz8)k3m'
+# a real deployment must set DJANGO_SECRET_KEY in the environment; the key below is public, so anything signed with
+# it (session cookies under SESSION_PROFILE=signed_cookies, password reset links) can be forged
+SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY', 'django-insecure-g64$y-@(h3bblog#l51=li#iqzvs7=v7cga&h4+ukksrz8)k3m')
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
@@ -41,11 +47,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.TimingMiddleware',
+    'api.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'api.middleware.TokenAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -74,13 +83,107 @@ WSGI_APPLICATION = 'cwk1.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# SQLite is tuned for many readers alongside writers; set SQLITE_TUNING=0 for SQLite's own defaults
+# the pragmas are applied to every new connection by api/sqlite.py
+SQLITE_TUNING = os.environ.get('SQLITE_TUNING', '1') != '0'
+SQLITE_PRAGMAS = {
+    # with WAL, only sync at checkpoints; a power cut can lose the last commits but not corrupt the database
+    'synchronous': 'NORMAL',
+    # milliseconds a connection waits for the write lock before 'database is locked'
+    'busy_timeout': 5000,
+    # page cache of about 20MB per connection, and reads through up to 256MB of memory-mapped file
+    'cache_size': -20000,
+    'mmap_size': 268435456,
+}
+# journal mode to switch the database to, e.g. WAL so readers no longer block the writer or each other; unlike the
+# pragmas it is written into the database file, so it is only set when asked for (a deployment step), never by default
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # keep connections open between requests, checking them before reuse
+        # (set DB_CONN_MAX_AGE=0 under ASGI, where requests run on short-lived threads)
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': True,
+        # take the write lock when a transaction begins so a writer waits for busy_timeout, rather than
+        # failing at once when it upgrades from reading to writing while another connection writes
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE'} if SQLITE_TUNING else {},
     }
 }
 
+# in-memory index of recent stories that answers GET /api/stories without the database, see api/hotindex.py
+# each process holds its own copy of the stories dated in the last HOT_INDEX_DAYS days (0 turns it off),
+# dropping the oldest days when there are more than HOT_INDEX_MAX_STORIES
+HOT_INDEX_DAYS = int(os.environ.get('HOT_INDEX_DAYS', '7'))
+HOT_INDEX_MAX_STORIES = int(os.environ.get('HOT_INDEX_MAX_STORIES', '100000'))
+
+# admission control of the API routes, see api/ratelimit.py and the limits in api/urls.py
+# rate limits are kept per process; set RATE_LIMIT_DB to a file path to share them between the workers of a machine
+# through SQLite, and RATE_LIMIT_TRUSTED_PROXIES to the number of proxies in front of the server that add
+# X-Forwarded-For, so clients are told apart by their own address; RATE_LIMIT=0 turns the limits off
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT', '1') != '0'
+RATE_LIMIT_DB = os.environ.get('RATE_LIMIT_DB')
+RATE_LIMIT_TRUSTED_PROXIES = int(os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', '0'))
+# load shedding: once a route's average latency in seconds is over SHED_LATENCY_TARGET with at least
+# SHED_MIN_CONCURRENCY of its requests running, its costly requests are refused; at SHED_MAX_CONCURRENCY all are
+SHED_LATENCY_TARGET = 0.5
+SHED_MIN_CONCURRENCY = 4
+SHED_MAX_CONCURRENCY = 64
+
+
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+# serialized GET /api/stories responses, see api/storycache.py
+# local memory is per process; set STORIES_CACHE_DIR to share one file-based cache between workers
+STORIES_CACHE_TIMEOUT = 300
+STORIES_CACHE_MAX_ENTRIES = 1000
+# verified API tokens, see api/tokens.py; a token revoked in another process is refused after at most this many seconds
+TOKEN_CACHE_TIMEOUT = 60
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'stories': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'stories',
+        'TIMEOUT': STORIES_CACHE_TIMEOUT,
+        # cull a single least recently used entry when full
+        'OPTIONS': {'MAX_ENTRIES': STORIES_CACHE_MAX_ENTRIES, 'CULL_FREQUENCY': STORIES_CACHE_MAX_ENTRIES},
+    },
+    'tokens': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tokens',
+        'TIMEOUT': TOKEN_CACHE_TIMEOUT,
+    },
+}
+
+if os.environ.get('STORIES_CACHE_DIR'):
+    CACHES['stories'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ['STORIES_CACHE_DIR'],
+        'TIMEOUT': STORIES_CACHE_TIMEOUT,
+        'OPTIONS': {'MAX_ENTRIES': STORIES_CACHE_MAX_ENTRIES, 'CULL_FREQUENCY': 10},
+    }
+
+
+# Sessions
+# https://docs.djangoproject.com/en/4.2/topics/http/sessions/
+
+# SESSION_PROFILE picks where logins are kept:
+# db (default) - in the session table, read on every logged-in request, so a logout ends the session in every process
+# cached_db - in the default cache in front of the session table, which is only read on a cache miss; the default cache
+#   is local memory in each process and keeps a session for its whole age (two weeks), so a logout served by one worker
+#   leaves the session alive in the others: only use it with a single worker or a default cache shared between them
+# signed_cookies - in the session cookie signed with SECRET_KEY, never reading the database, but a logout only clears
+#   the browser's copy
+# API tokens (api/tokens.py) avoid the session altogether on the write paths
+SESSION_PROFILE = os.environ.get('SESSION_PROFILE', 'db')
+SESSION_ENGINE = 'django.contrib.sessions.backends.' + SESSION_PROFILE
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
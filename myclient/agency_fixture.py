@@ -0,0 +1,123 @@
+import json
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# stand-in news agency serving GET /api/stories after a fixed delay, for trying out the client locally
+class FakeAgency:
+
+    def __init__(self, code, delay=0.0, stories=3, status=200):
+        self.code = code
+        self.delay = delay
+        self.status = status
+        self.stories = [{'key': str(i), 'headline': code + ' story ' + str(i), 'story_cat': 'tech', 'story_region': 'uk',
+                         'author': code.lower(), 'story_date': date.today().strftime('%d/%m/%Y'),
+                         'story_details': 'Details of ' + code + ' story ' + str(i)} for i in range(stories)]
+        self.requests = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def handler(self):
+        agency = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                agency.requests += 1
+                time.sleep(agency.delay)
+                body = json.dumps({'stories': agency.stories}).encode() if agency.status == 200 else b'Not found'
+                self.send_response(agency.status)
+                self.send_header('Content-Type', 'application/json' if agency.status == 200 else 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    # directory entry for this agency, in the format of the real directory
+    def entry(self):
+        return {'agency_name': self.code + ' News', 'url': self.url, 'agency_code': self.code}
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# stand-in directory listing a set of agencies
+class FakeDirectory(FakeAgency):
+
+    def __init__(self, agencies):
+        super().__init__('DIR')
+        self.agencies = agencies
+        self.notModified = 0
+
+    def handler(self):
+        directory = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                directory.requests += 1
+                body = json.dumps([agency.entry() for agency in directory.agencies]).encode()
+                etag = '"' + str(hash(body)) + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    directory.notModified += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+# start agencies with the given delays and a directory listing them
+def startAgencies(delays):
+    agencies = [FakeAgency('AG%02d' % i, delay).start() for i, delay in enumerate(delays)]
+    directory = FakeDirectory(agencies).start()
+    return directory, agencies
+
+
+# show that a 'news' command takes about as long as the slowest agency rather than the sum of them all
+if __name__ == '__main__':
+    import contextlib
+    import io
+    import os
+    import tempfile
+    # saved directory, stories and agency health go to a throwaway folder rather than ~/.newsclient
+    os.environ['NEWS_CLIENT_DIR'] = tempfile.mkdtemp(prefix='newsclient-fixture-')
+    import client
+
+    delays = [0.1 * (i % 5 + 1) for i in range(20)]
+    directory, agencies = startAgencies(delays)
+    client.directory_url = directory.url + '/api/directory/'
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        client.newsStory(['news'])
+    elapsed = time.perf_counter() - start
+
+    print('Agencies: %d' % len(agencies))
+    print('Sum of agency delays: %.2fs' % sum(delays))
+    print('Slowest agency delay: %.2fs' % max(delays))
+    print('news command wall time: %.2fs' % elapsed)
+
+    for agency in agencies + [directory]:
+        agency.stop()
@@ -1,13 +1,31 @@
 import requests
 import urllib.parse
-import json
-import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import datetime
 
+from directory import AgencyDirectory
+from store import StoryStore, SORTS
+from health import AgencyHealth, healthKey
+from dedupe import mergeDuplicates, DuplicateIndex, Sketch
+import formats
+
 directory_url = "http://newssites.pythonanywhere.com/api/directory/"
 # default url for when running locally
 api_url = 'http://127.0.0.1:8000'
 session = requests.Session()
+threadLocal = threading.local()
+cachedDirectory = None
+savedStories = None
+healthRecords = None
+
+# seconds to wait for each agency to connect and to send a response
+AGENCY_TIMEOUT = (3, 5)
+# seconds to wait for all agencies in a 'news' command
+NEWS_DEADLINE = 10
+# agencies queried at once
+MAX_WORKERS = 20
 
 
 # user enters 'login <url>'
@@ -136,37 +154,14 @@ def newsStory(args):
         invalid()
         return
     
-    # set default values
-    storyId = '*'
-    storyCat = '*'
-    storyReg = '*'
-    storyDate = '*'
-
-    # remove first arg: 'news'
-    args.pop(0)
-    
-    # loop through arguments checking for validity and updating parameters
-    for i in args:
-        if i.startswith('-id='):
-            storyId = i[5:-1]
-        elif i.startswith('-cat='):         
-            storyCat = i[6:-1]
-        elif i.startswith('-reg='):
-            storyReg = i[6:-1]
-        elif i.startswith('-date='):
-            storyDate = i[7:-1]
-            # check date is in valid format:
-            try:
-                date = datetime.strptime(storyDate, '%d/%m/%Y')
-                if storyDate != date.strftime('%d/%m/%Y'):
-                    print("That is not a valid date. Please try again.")
-                    return
-            except ValueError:
-                print("That is not a valid date. Please try again.")                
-                return
-        else:
-            invalid()
-            return
+    # read the switches
+    filters = parseFilters(args[1:], ['-id=', '-cat=', '-reg=', '-date='])
+    if filters is None:
+        return
+    storyId = filters['-id=']
+    storyCat = filters['-cat=']
+    storyReg = filters['-reg=']
+    storyDate = filters['-date=']
     
     # create payload
     payloadString = urllib.parse.urlencode({
@@ -176,48 +171,207 @@ def newsStory(args):
     })
     
     # get all news services from directory
+    directory = agencyDirectory()
     try:
-        response = session.get(directory_url)
-    except requests.exceptions.RequestException as e:
-        print("Error: Unable to connect to url provided: " +api_url + "/api/login. Please try again.")
+        allAgencies = directory.agencies()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print("Error: Unable to get the agency directory from " + directory_url + ". Please try again.")
         return
-    allAgencies = json.loads(response.text)
+    if directory.stale:
+        print("Warning: The agency directory could not be reached, using a saved copy.")
     selectedAgencies = []
 
     # if id is specified - limit to that one if possible
     if(storyId != '*'):
-        for agency in allAgencies:
-            # if found, select that agency
-            if agency["agency_code"] == storyId:
-                selectedAgencies.append(agency) 
-    # pick 20 agencies if there are more than that
-    elif len(allAgencies) > 20:
-        selectedAgencies = random.sample(allAgencies, 20)
+        agency = directory.byCode(storyId)
+        if agency is not None:
+            selectedAgencies.append(agency)
+    # pick up to 20 agencies, favouring fast healthy ones and skipping any that keep failing
     else:
-        selectedAgencies = allAgencies
+        selectedAgencies = agencyHealth().select(allAgencies, 20)
     
     # if not found print error
     if len(selectedAgencies) == 0:
-        print("No agencies found. Check that any id provided is a valid agency code.")
+        if storyId == '*' and len(allAgencies) > 0:
+            print("No agencies available. Every agency has failed recently, please try again later.")
+        else:
+            print("No agencies found. Check that any id provided is a valid agency code.")
         return
     
-    # loop through selected agencies
-    for agency in selectedAgencies:
-        # make GET requests to chosen services
+    # only ask agencies whose saved stories for this filter are out of date, all at the same time,
+    # printing each agency in order as soon as it and those before it are done
+    store = storyStore()
+    staleAgencies = [agency for agency in selectedAgencies if not store.isFresh(healthKey(agency), storyCat, storyReg, storyDate)]
+    futures = dict(zip(map(id, staleAgencies), fetchAll(staleAgencies, payloadString))) if staleAgencies else {}
+    printAgencyResults(selectedAgencies, futures, storyCat, storyReg, storyDate)
+
+
+# user enters 'query [-id=] [-cat=] [-reg=] [-date=] [-sort=]'
+def queryStories(args):
+
+    # check for valid form
+    if len(args) > 6 or len(args) == 0:
+        invalid()
+        return
+
+    # read the switches
+    filters = parseFilters(args[1:], ['-id=', '-cat=', '-reg=', '-date=', '-sort='])
+    if filters is None:
+        return
+    sort = 'date' if filters['-sort='] == '*' else filters['-sort=']
+    if sort not in SORTS:
+        print("Sort should be: " + ", ".join(SORTS) + ".")
+        return
+    agencyCodes = None if filters['-id='] == '*' else [filters['-id=']]
+
+    # answer from the saved stories only, merging copies of a story from different agencies
+    stories = storyStore().query(filters['-cat='], filters['-reg='], filters['-date='], agencyCodes, sort)
+    if len(stories) == 0:
+        print("No saved stories match. Use 'news' to fetch stories from the agencies.")
+        return
+    printMergedStories(mergeDuplicates(stories))
+
+
+# read '-switch="value"' arguments into a dictionary, with '*' for any switch not given
+# prints an error and returns None if an argument is not valid
+def parseFilters(args, switches):
+    filters = dict.fromkeys(switches, '*')
+    for i in args:
+        switch = i[:i.find('=') + 1]
+        if switch not in switches:
+            invalid()
+            return None
+        # remove the switch and the quote marks around the value
+        filters[switch] = i[len(switch) + 1:-1]
+    # check date is in valid format:
+    if '-date=' in filters and filters['-date='] != '*':
         try:
-            response = session.get(agency["url"]+'/api/stories?' + payloadString)
-            print("\n\n-------------------------- From " + agency["agency_name"] + ": --------------------------" )
-            # check for success
-            if response.status_code == 200:
-                # load stories and print them
-                stories = json.loads(response.text)
-                printStories(stories)
-            elif response.status_code == 404: 
-                print("No news stories were found at this agency.")
+            date = datetime.strptime(filters['-date='], '%d/%m/%Y')
+            if filters['-date='] != date.strftime('%d/%m/%Y'):
+                print("That is not a valid date. Please try again.")
+                return None
+        except ValueError:
+            print("That is not a valid date. Please try again.")
+            return None
+    return filters
+
+
+# fetch stories from every agency concurrently, returning futures in the same order as the agencies
+def fetchAll(agencies, payloadString):
+    executor = ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(agencies)))
+    futures = [executor.submit(fetchStories, agency, payloadString) for agency in agencies]
+    # don't wait for agencies still running once the results are collected
+    executor.shutdown(wait=False)
+    return futures
+
+
+# save and print the stories of each agency in order, each as soon as it and the agencies before it are done,
+# giving up on any not done by the global deadline; a story that is a near-duplicate of one already printed
+# from another agency is named rather than printed again
+# agencies without a future in 'futures' (keyed by id of the agency) are printed from the saved stories
+def printAgencyResults(agencies, futures, storyCat, storyReg, storyDate):
+    deadline = time.monotonic() + NEWS_DEADLINE
+    store = storyStore()
+    health = agencyHealth()
+    shown = DuplicateIndex()
+    for agency in agencies:
+        message = None
+        future = futures.get(id(agency))
+        if future is not None:
+            try:
+                status, result, latency = future.result(timeout=max(0, deadline - time.monotonic()))
+            except FutureTimeout:
+                future.cancel()
+                status, result, latency = None, "This agency did not respond in time.", None
+            # check for success, saving what the agency returned
+            if status == 200:
+                stories = result.get("stories") if isinstance(result, dict) else None
+                if not store.replace(agency, storyCat, storyReg, storyDate, stories):
+                    status, result = None, "This news agency hasn't returned the appropriate format."
+            elif status == 404:
+                store.replace(agency, storyCat, storyReg, storyDate, [])
+            elif status is not None:
+                status, result = None, "Could not get stories from this agency"
+            if status is None:
+                message = "Error: " + result
+            health.update(healthKey(agency), latency, status is not None)
+
+        print("\n\n-------------------------- From " + agency["agency_name"] + ": --------------------------" )
+        if message is not None:
+            print(message)
+        # split the agency's stories into those not printed yet and copies of stories printed above
+        sketches = [Sketch(story) for story in store.query(storyCat, storyReg, storyDate, [healthKey(agency)])]
+        newSketches, repeats = [], []
+        for sketch in sketches:
+            original = next(iter(shown.matches(sketch)), None)
+            if original is None:
+                newSketches.append(sketch)
             else:
-                print("Error: Could not get stories from this agency")
-        except requests.exceptions.RequestException as e:
-            print("Error collecting stories from url: " + e)
+                repeats.append((sketch.story, original))
+        if len(newSketches) > 0:
+            if message is not None:
+                print("Showing saved stories from this agency:")
+            printStories({"stories": [sketch.story for sketch in newSketches]})
+        for story, original in repeats:
+            print("\n" + story["headline"] + " (id: " + str(story["key"]) + ") - also reported by " + original["agency_name"] + " above")
+        if len(sketches) == 0 and message is None:
+            print("No news stories were found at this agency.")
+        for sketch in newSketches:
+            shown.add(sketch)
+    health.save()
+
+
+# GET stories from one agency, returning (status code, stories, seconds taken) or (None, error message, seconds taken)
+def fetchStories(agency, payloadString):
+    start = time.monotonic()
+    try:
+        url = agency["url"]+'/api/stories?' + payloadString
+        # ask for a compact binary format, falling back to JSON if the agency refuses it
+        response = threadSession().get(url, headers={'Accept': formats.ACCEPT}, timeout=AGENCY_TIMEOUT)
+        if response.status_code == 406 and formats.ACCEPT != 'application/json':
+            response = threadSession().get(url, headers={'Accept': 'application/json'}, timeout=AGENCY_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        return None, "Unable to collect stories from url: " + str(e), time.monotonic() - start
+    except (KeyError, TypeError):
+        return None, "This agency has no valid url.", None
+    latency = time.monotonic() - start
+    if response.status_code != 200:
+        return response.status_code, None, latency
+    try:
+        return 200, formats.decode(response.headers.get('Content-Type', ''), response.content), latency
+    except ValueError:
+        return None, "This news agency hasn't returned the appropriate format.", latency
+
+
+# a session per worker thread, as requests sessions are not thread safe
+def threadSession():
+    if not hasattr(threadLocal, 'session'):
+        threadLocal.session = requests.Session()
+    return threadLocal.session
+
+
+# cached directory for the current directory url
+def agencyDirectory():
+    global cachedDirectory
+    if cachedDirectory is None or cachedDirectory.url != directory_url:
+        cachedDirectory = AgencyDirectory(directory_url, session)
+    return cachedDirectory
+
+
+# saved stories, opened on first use
+def storyStore():
+    global savedStories
+    if savedStories is None:
+        savedStories = StoryStore()
+    return savedStories
+
+
+# agency health records, loaded on first use
+def agencyHealth():
+    global healthRecords
+    if healthRecords is None:
+        healthRecords = AgencyHealth()
+    return healthRecords
 
 
 # user enters 'list'
@@ -228,18 +382,16 @@ def listServices(args):
         invalid()
         return
     
-    # send get request to directory
+    # get the directory, from the saved copy if it is recent enough
+    directory = agencyDirectory()
     try:
-        response = session.get(directory_url)
-    except requests.exceptions.RequestException as e:
-        print("Error: Unable to connect to url provided: " +api_url + "/api/login. Please try again.")
+        agencies = directory.agencies()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print("Error: Unable to get the agency directory from " + directory_url + ". Please try again.")
         return
-    
-    # check for success
-    if response.status_code == 200:
-        printList(json.loads(response.text))
-    else:
-        print("Error: " + response.status_code + ", " + response.text)
+    if directory.stale:
+        print("Warning: The agency directory could not be reached, using a saved copy.")
+    printList(agencies)
 
 
 # user enters 'delete <story_key>'
@@ -285,6 +437,16 @@ def printStories(stories):
         print("Error: This news agency hasn't returned the appropriate format.")
 
 
+# format stories gathered from several agencies
+def printMergedStories(stories):
+    for story in stories:
+        print("\n" + story["headline"] + " (id: " + str(story["key"])+")")
+        print("By: " + story["author"] + ", " + story["story_date"])
+        print("Category: " + story["story_cat"] + ", Region: " + story["story_region"])
+        print(story["story_details"])
+        print("From: " + ", ".join(story["sources"]))
+
+
 # format list of services
 def printList(services):
     for service in services:
@@ -305,6 +467,7 @@ def viewMenu():
           Logout: 'logout'
           Post a story: 'post'
           View stories: 'news [-id=] [-cat=] [-reg=] [-date=]'
+          Search saved stories: 'query [-id=] [-cat=] [-reg=] [-date=] [-sort=]'
           List services: 'list'
           Delete a story: 'delete <story_key>'\n
           See this menu again: 'menu'
@@ -369,6 +532,8 @@ def main():
             postStory(args)
         elif command == 'news':
             newsStory(args)
+        elif command == 'query':
+            queryStories(args)
         elif command == 'list':
             listServices(args)
         elif command == 'delete':
@@ -0,0 +1,9 @@
+import os
+from pathlib import Path
+
+
+# folder for the client's cached data, set NEWS_CLIENT_DIR to use somewhere other than ~/.newsclient
+def dataDir():
+    path = Path(os.environ.get('NEWS_CLIENT_DIR', Path.home() / '.newsclient'))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
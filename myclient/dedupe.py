@@ -0,0 +1,94 @@
+import hashlib
+import re
+import struct
+
+# words per shingle
+SHINGLE_SIZE = 2
+# MinHash signature length, split into LSH bands of BAND_ROWS rows
+# 8 bands of 4 rows make stories with a Jaccard similarity above about 0.6 likely to share a band
+NUM_HASHES = 32
+BAND_ROWS = 4
+# shingle Jaccard similarity at which two stories count as the same story
+THRESHOLD = 0.6
+
+
+# lower case words of a text, without punctuation
+def words(text):
+    return re.findall(r'[a-z0-9]+', text.lower())
+
+
+# word shingles of a story's headline and details
+def shingles(story):
+    tokens = words(story['headline']) + words(story['story_details'])
+    if len(tokens) < SHINGLE_SIZE:
+        return {' '.join(tokens)}
+    return {' '.join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+
+
+# MinHash signature of a set of shingles
+# one 64 byte blake2b digest per shingle gives NUM_HASHES independent 16 bit hashes, and the
+# signature is the minimum of each of them over the shingles
+def signature(shingleSet):
+    hashes = [struct.unpack('<%dH' % NUM_HASHES, hashlib.blake2b(shingle.encode(), digest_size=NUM_HASHES * 2).digest()) for shingle in shingleSet]
+    return [min(column) for column in zip(*hashes)]
+
+
+# a story with its shingles and the LSH band keys of its signature
+class Sketch:
+    __slots__ = ('story', 'shingles', 'bands')
+
+    def __init__(self, story):
+        self.story = story
+        self.shingles = shingles(story)
+        sig = signature(self.shingles)
+        self.bands = [(band, tuple(sig[band:band + BAND_ROWS])) for band in range(0, NUM_HASHES, BAND_ROWS)]
+
+
+# stories added one at a time, looked up by LSH for near-duplicates of a new story
+# stories from the same agency are never near-duplicates of each other, however alike they are
+class DuplicateIndex:
+
+    def __init__(self):
+        self.sketches = []
+        self.buckets = {}
+
+    def add(self, sketch):
+        for band in sketch.bands:
+            self.buckets.setdefault(band, []).append(len(self.sketches))
+        self.sketches.append(sketch)
+
+    # indexed stories from other agencies whose similarity to a sketched story reaches THRESHOLD, oldest first
+    # stories sharing any band of their signature are candidates, checked against their real similarity
+    def matches(self, sketch):
+        candidates = sorted(set(i for band in sketch.bands for i in self.buckets.get(band, ())))
+        found = []
+        for i in candidates:
+            other = self.sketches[i]
+            if other.story['agency_code'] == sketch.story['agency_code']:
+                continue
+            if len(sketch.shingles & other.shingles) >= THRESHOLD * len(sketch.shingles | other.shingles):
+                found.append(other.story)
+        return found
+
+
+# merge near-duplicate stories reported by different agencies, keeping the first copy of each story in order
+# each merged story gets a 'sources' list with the name of every agency that reported it
+# a story joins the first earlier group whose first story it matches and that has no story from its agency yet,
+# so a group never holds two stories of one agency and never grows through a chain of matches
+def mergeDuplicates(stories):
+    index = DuplicateIndex()
+    merged = []
+    # the merged story standing for each group, and the agency codes in it, by id of the group's first story
+    groups = {}
+    for story in stories:
+        sketch = Sketch(story)
+        group = next((groups[id(first)] for first in index.matches(sketch) if story['agency_code'] not in groups[id(first)][1]), None)
+        if group is None:
+            group = (dict(story, sources=[]), set())
+            groups[id(story)] = group
+            merged.append(group[0])
+            index.add(sketch)
+        group[1].add(story['agency_code'])
+        if story['agency_name'] not in group[0]['sources']:
+            group[0]['sources'].append(story['agency_name'])
+    return merged
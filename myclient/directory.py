@@ -0,0 +1,102 @@
+import json
+import os
+import time
+
+import requests
+
+from datadir import dataDir
+
+# seconds the cached directory is used before checking it with the directory server again
+DIRECTORY_TTL = 600
+
+
+# the agency directory, cached on disk and revalidated with ETag/Last-Modified once its TTL runs out
+class AgencyDirectory:
+
+    def __init__(self, url, session, path=None, ttl=DIRECTORY_TTL):
+        self.url = url
+        self.session = session
+        self.path = path or dataDir() / 'directory.json'
+        self.ttl = ttl
+        self.entry = None
+        self.index = {}
+        # true when the last lookup fell back to an out of date copy
+        self.stale = False
+
+    # list of agencies, fetching or revalidating the directory when the cached copy is too old
+    # raises a requests RequestException if the directory can't be reached or sends something that is not
+    # a list of agencies, and there is no cached copy
+    def agencies(self):
+        if self.entry is None:
+            self.setEntry(self.readCache())
+        if self.entry is not None and time.time() - self.entry['fetched'] < self.ttl:
+            self.stale = False
+            return self.entry['agencies']
+
+        # ask the server, sending validators so an unchanged directory is not downloaded again
+        headers = {}
+        if self.entry is not None:
+            if self.entry.get('etag'):
+                headers['If-None-Match'] = self.entry['etag']
+            if self.entry.get('last_modified'):
+                headers['If-Modified-Since'] = self.entry['last_modified']
+        try:
+            response = self.session.get(self.url, headers=headers, timeout=(3, 10))
+            if response.status_code == 304:
+                # only a copy the validators came from can be not modified
+                if self.entry is None:
+                    raise requests.exceptions.HTTPError("Directory answered 304 Not Modified without a saved copy.", response=response)
+                self.entry['fetched'] = time.time()
+            else:
+                response.raise_for_status()
+                agencies = json.loads(response.text)
+                if not isinstance(agencies, list):
+                    raise requests.exceptions.InvalidJSONError("Directory is not a list of agencies.")
+                self.setEntry({'url': self.url, 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified'),
+                               'fetched': time.time(), 'agencies': agencies})
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # use the out of date copy if there is one
+            if self.entry is None:
+                if isinstance(e, requests.exceptions.RequestException):
+                    raise
+                raise requests.exceptions.InvalidJSONError("Directory is not valid JSON: " + str(e)) from e
+            self.stale = True
+            return self.entry['agencies']
+        self.stale = False
+        self.writeCache()
+        return self.entry['agencies']
+
+    # agency with the given code, or None
+    def byCode(self, code):
+        self.agencies()
+        return self.index.get(code)
+
+    # use a directory entry, indexing its agencies by code
+    def setEntry(self, entry):
+        self.entry = entry
+        self.index = {}
+        if entry is not None:
+            for agency in entry['agencies']:
+                if isinstance(agency, dict) and 'agency_code' in agency:
+                    self.index.setdefault(agency['agency_code'], agency)
+
+    # cached entry for this directory url from disk, or None
+    def readCache(self):
+        try:
+            with open(self.path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(entry, dict) or entry.get('url') != self.url or not isinstance(entry.get('agencies'), list):
+            return None
+        return entry
+
+    # write the entry to disk through a temporary file so a reader never sees half a file
+    def writeCache(self):
+        temp = str(self.path) + '.tmp'
+        try:
+            with open(temp, 'w') as f:
+                json.dump(self.entry, f)
+            os.replace(temp, self.path)
+        except OSError:
+            pass
@@ -0,0 +1,47 @@
+import json
+
+# the compact story formats are asked for when the msgpack package is installed ('pip install msgpack')
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+COLUMNAR = 'application/vnd.news.columnar+msgpack'
+MSGPACK = 'application/msgpack'
+# story fields in the order of the columnar format, and those sent as distinct values with an index per story
+FIELDS = ('key', 'headline', 'story_cat', 'story_region', 'author', 'story_date', 'story_details')
+DICTIONARY_FIELDS = ('story_cat', 'story_region', 'author', 'story_date')
+
+# Accept header for story requests: the columnar format first, then MessagePack, then JSON
+# agencies that do not know the binary formats ignore it and send JSON
+ACCEPT = COLUMNAR + ', ' + MSGPACK + ';q=0.9, application/json;q=0.5' if msgpack is not None else 'application/json'
+
+
+# columns of the columnar format back to a list of stories in the JSON format
+def rows(columns):
+    fields = []
+    for field in FIELDS:
+        column = columns[field]
+        if field in DICTIONARY_FIELDS:
+            values = column['values']
+            column = [values[index] for index in column['indexes']]
+        fields.append(column)
+    stories = [dict(zip(FIELDS, values)) for values in zip(*fields)]
+    for story in stories:
+        story['key'] = str(story['key'])
+    return stories
+
+
+# a stories response body to the JSON payload ({"stories": [...], ...}), by its content type
+# raises ValueError if the body is not in that format
+def decode(contentType, content):
+    mediaType = contentType.split(';')[0].strip().lower()
+    try:
+        if mediaType in (COLUMNAR, MSGPACK, 'application/x-msgpack') and msgpack is not None:
+            payload = msgpack.unpackb(content)
+            if mediaType == COLUMNAR:
+                payload['stories'] = rows(payload['stories'])
+            return payload
+        return json.loads(content)
+    except (KeyError, TypeError, IndexError, AttributeError, ValueError) as e:
+        raise ValueError(str(e))
@@ -0,0 +1,96 @@
+import json
+import math
+import os
+import random
+import time
+
+from datadir import dataDir
+
+# weight of the newest sample in the latency and error rate moving averages
+EWMA_ALPHA = 0.3
+# failures in a row that open an agency's circuit breaker
+FAILURE_THRESHOLD = 3
+# seconds an open circuit skips an agency, doubling each time a probe fails, up to MAX_COOLDOWN
+COOLDOWN = 300
+MAX_COOLDOWN = 3600
+# recovering agencies probed per selection
+PROBES = 2
+# latency assumed for an agency that has not been asked yet
+UNKNOWN_LATENCY = 1.0
+
+
+# the key of an agency's health record: its code, or its url for an agency listed without one, so such
+# agencies do not share one record and one circuit breaker
+def healthKey(agency):
+    code = agency.get('agency_code')
+    return code if code is not None else 'url:' + str(agency.get('url'))
+
+
+# latency, error rate and circuit breaker state of every agency, saved between runs, by healthKey
+class AgencyHealth:
+
+    def __init__(self, path=None):
+        self.path = path or dataDir() / 'health.json'
+        try:
+            with open(self.path) as f:
+                self.records = json.load(f)
+        except (OSError, ValueError):
+            self.records = {}
+
+    def record(self, code):
+        return self.records.setdefault(code, {'latency': None, 'error_rate': 0.0, 'last_success': None,
+                                              'failures': 0, 'cooldown': COOLDOWN, 'open_until': 0})
+
+    # update an agency's record after asking it for stories
+    def update(self, code, latency, ok):
+        record = self.record(code)
+        if latency is not None:
+            record['latency'] = latency if record['latency'] is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * record['latency']
+        record['error_rate'] = EWMA_ALPHA * (0.0 if ok else 1.0) + (1 - EWMA_ALPHA) * record['error_rate']
+        if ok:
+            record['last_success'] = time.time()
+            record['failures'] = 0
+            record['cooldown'] = COOLDOWN
+            record['open_until'] = 0
+        else:
+            record['failures'] += 1
+            if record['failures'] >= FAILURE_THRESHOLD:
+                # a failed probe of a recovering agency backs off for longer
+                if record['open_until']:
+                    record['cooldown'] = min(record['cooldown'] * 2, MAX_COOLDOWN)
+                record['open_until'] = time.time() + record['cooldown']
+
+    # 'healthy', 'open' (skipped until its cool-down ends) or 'recovering' (cool-down over, waiting for a probe)
+    def state(self, code):
+        record = self.records.get(code)
+        if record is None or not record['open_until']:
+            return 'healthy'
+        return 'open' if record['open_until'] > time.time() else 'recovering'
+
+    # how much an agency is preferred: fast agencies with few errors first
+    def weight(self, code):
+        record = self.records.get(code)
+        if record is None:
+            return 1.0 / UNKNOWN_LATENCY
+        latency = record['latency'] if record['latency'] is not None else UNKNOWN_LATENCY
+        return max(1.0 - record['error_rate'], 0.05) / max(latency, 0.05)
+
+    # pick up to 'count' agencies, skipping open circuits, probing a few recovering agencies
+    # and otherwise sampling in favour of healthy fast agencies
+    def select(self, agencies, count, rng=random):
+        recovering = [agency for agency in agencies if self.state(healthKey(agency)) == 'recovering']
+        healthy = [agency for agency in agencies if self.state(healthKey(agency)) == 'healthy']
+        selected = rng.sample(recovering, min(PROBES, len(recovering), count))
+        # weighted sampling without replacement: highest random ** (1 / weight) wins, compared as logs
+        keyed = sorted(healthy, key=lambda agency: math.log(1.0 - rng.random()) / self.weight(healthKey(agency)), reverse=True)
+        return selected + keyed[:count - len(selected)]
+
+    # write the records to disk through a temporary file so a reader never sees half a file
+    def save(self):
+        temp = str(self.path) + '.tmp'
+        try:
+            with open(temp, 'w') as f:
+                json.dump(self.records, f)
+            os.replace(temp, self.path)
+        except OSError:
+            pass
@@ -0,0 +1,122 @@
+import sqlite3
+import time
+from datetime import datetime
+
+from datadir import dataDir
+from health import healthKey
+
+# seconds stories fetched from an agency are used before asking the agency again
+STORE_TTL = 300
+
+SORTS = {
+    'date': 'date DESC, agency_code, CAST(key AS INTEGER) DESC',
+    'agency': 'agency_code, date DESC, CAST(key AS INTEGER) DESC',
+    'headline': 'headline COLLATE NOCASE, date DESC',
+}
+
+
+# stories fetched from every agency, kept in a local SQLite database keyed by (agency_code, key)
+# agency_code holds health.healthKey of the agency, so an agency listed without a code is kept under its url
+class StoryStore:
+
+    def __init__(self, path=None, ttl=STORE_TTL):
+        self.ttl = ttl
+        self.db = sqlite3.connect(str(path or dataDir() / 'stories.sqlite3'))
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS stories (
+                agency_code TEXT NOT NULL,
+                key TEXT NOT NULL,
+                agency_name TEXT NOT NULL,
+                headline TEXT NOT NULL,
+                category TEXT NOT NULL,
+                region TEXT NOT NULL,
+                author TEXT NOT NULL,
+                date TEXT NOT NULL,
+                details TEXT NOT NULL,
+                PRIMARY KEY (agency_code, key)
+            );
+            CREATE INDEX IF NOT EXISTS stories_category_date ON stories (category, date);
+            CREATE INDEX IF NOT EXISTS stories_region_date ON stories (region, date);
+            CREATE INDEX IF NOT EXISTS stories_date ON stories (date);
+            CREATE TABLE IF NOT EXISTS refreshes (
+                agency_code TEXT NOT NULL,
+                category TEXT NOT NULL,
+                region TEXT NOT NULL,
+                since TEXT NOT NULL,
+                fetched REAL NOT NULL,
+                PRIMARY KEY (agency_code, category, region, since)
+            );
+        ''')
+
+    # true if the agency was asked for these stories, or a wider set of them, within the TTL
+    def isFresh(self, agencyCode, cat, reg, date):
+        since = toIsoDate(date)
+        rows = self.db.execute('SELECT category, region, since FROM refreshes WHERE agency_code = ? AND fetched > ?',
+                               (agencyCode, time.time() - self.ttl))
+        for row in rows:
+            if row['category'] in (cat, '*') and row['region'] in (reg, '*') and (row['since'] == '' or (since != '' and row['since'] <= since)):
+                return True
+        return False
+
+    # replace the agency's stories matching a filter with those it just returned
+    # returns False, changing nothing, if any story is not in the expected format
+    def replace(self, agency, cat, reg, date, stories):
+        agencyCode = healthKey(agency)
+        rows = []
+        try:
+            for story in stories:
+                rows.append((agencyCode, str(story['key']), agency['agency_name'], story['headline'], story['story_cat'],
+                             story['story_region'], story['author'], toIsoDate(story['story_date']), story['story_details']))
+        except (KeyError, TypeError, ValueError):
+            return False
+        where, params = filterClause(cat, reg, date)
+        with self.db:
+            self.db.execute('DELETE FROM stories WHERE agency_code = ?' + where, [agencyCode] + params)
+            self.db.executemany('INSERT OR REPLACE INTO stories VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.execute('INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?, ?, ?)',
+                            (agencyCode, cat, reg, toIsoDate(date), time.time()))
+        return True
+
+    # stored stories matching a filter, in the format agencies return them, optionally for a list of agency codes
+    # (healthKey of each agency)
+    def query(self, cat='*', reg='*', date='*', agencyCodes=None, sort='date'):
+        where, params = filterClause(cat, reg, date)
+        if agencyCodes is not None:
+            where += ' AND agency_code IN (' + ', '.join('?' * len(agencyCodes)) + ')'
+            params += list(agencyCodes)
+        rows = self.db.execute('SELECT * FROM stories WHERE 1 = 1' + where + ' ORDER BY ' + SORTS[sort], params)
+        return [toStory(row) for row in rows]
+
+    def close(self):
+        self.db.close()
+
+
+# SQL conditions (with a leading AND) and parameters for a category, region and date filter
+def filterClause(cat, reg, date):
+    where = ''
+    params = []
+    if cat != '*':
+        where += ' AND category = ?'
+        params.append(cat)
+    if reg != '*':
+        where += ' AND region = ?'
+        params.append(reg)
+    if date != '*':
+        where += ' AND date >= ?'
+        params.append(toIsoDate(date))
+    return where, params
+
+
+# 'dd/mm/YYYY' to a sortable 'YYYY-mm-dd', with '*' (any date) as ''
+def toIsoDate(date):
+    if date == '*':
+        return ''
+    return datetime.strptime(date, '%d/%m/%Y').strftime('%Y-%m-%d')
+
+
+# stored row to a story in the agency format, with where it came from
+def toStory(row):
+    return {'key': row['key'], 'headline': row['headline'], 'story_cat': row['category'], 'story_region': row['region'],
+            'author': row['author'], 'story_date': datetime.strptime(row['date'], '%Y-%m-%d').strftime('%d/%m/%Y'),
+            'story_details': row['details'], 'agency_code': row['agency_code'], 'agency_name': row['agency_name']}
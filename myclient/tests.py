@@ -0,0 +1,479 @@
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+import unittest
+from concurrent.futures import Future
+
+import requests
+
+from agency_fixture import FakeAgency, FakeDirectory, startAgencies
+from directory import AgencyDirectory
+from store import StoryStore
+from health import AgencyHealth, healthKey
+from dedupe import mergeDuplicates, DuplicateIndex, Sketch
+import dedupe
+import formats
+import health
+import client
+
+
+# runs each test with its own data folder in place of ~/.newsclient, and with the client's saved state forgotten
+class ClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp(prefix='newsclient-test-')
+        self.previousDir = os.environ.get('NEWS_CLIENT_DIR')
+        os.environ['NEWS_CLIENT_DIR'] = self.dataDir
+        self.resetClient()
+
+    def tearDown(self):
+        self.resetClient()
+        if self.previousDir is None:
+            del os.environ['NEWS_CLIENT_DIR']
+        else:
+            os.environ['NEWS_CLIENT_DIR'] = self.previousDir
+        shutil.rmtree(self.dataDir, ignore_errors=True)
+
+    def resetClient(self):
+        if client.savedStories is not None:
+            client.savedStories.close()
+        client.cachedDirectory = client.savedStories = client.healthRecords = None
+
+
+# what a client function prints
+def output(function, *args):
+    with contextlib.redirect_stdout(io.StringIO()) as printed:
+        function(*args)
+    return printed.getvalue()
+
+
+# tests for the concurrent 'news' command
+class NewsCommandTests(ClientTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory, self.agencies = startAgencies([0.3, 0.1, 0.2, 0.3, 0.3])
+        client.directory_url = self.directory.url + '/api/directory/'
+
+    def tearDown(self):
+        for agency in self.agencies + [self.directory]:
+            agency.stop()
+        super().tearDown()
+
+    def test_agencies_are_asked_at_the_same_time(self):
+        start = time.perf_counter()
+        printed = output(client.newsStory, ['news'])
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertEqual(printed.count('-------------------------- From '), 5)
+        self.assertTrue(all(agency.requests == 1 for agency in self.agencies))
+
+    def test_results_printed_in_agency_order(self):
+        entries = [agency.entry() for agency in self.agencies]
+        futures = dict(zip(map(id, entries), client.fetchAll(entries, 'story_cat=*&story_region=*&story_date=*')))
+        printed = output(client.printAgencyResults, entries, futures, '*', '*', '*')
+        self.assertEqual(re.findall(r'From (AG\d+) News', printed), [agency.code for agency in self.agencies])
+
+    def test_agency_past_the_deadline_is_reported(self):
+        slow = FakeAgency('SLOW', delay=1.0).start()
+        self.addCleanup(slow.stop)
+        entries = [self.agencies[1].entry(), slow.entry()]
+        futures = dict(zip(map(id, entries), client.fetchAll(entries, 'story_cat=*&story_region=*&story_date=*')))
+        deadline = client.NEWS_DEADLINE
+        client.NEWS_DEADLINE = 0.5
+        try:
+            printed = output(client.printAgencyResults, entries, futures, '*', '*', '*')
+        finally:
+            client.NEWS_DEADLINE = deadline
+        self.assertIn('AG01 story 0', printed)
+        self.assertIn('Error: This agency did not respond in time.', printed)
+
+
+# a requests response with a status, body and headers, for the stand-in session
+def stubResponse(status, body=b'', headers=None):
+    response = requests.models.Response()
+    response.status_code = status
+    response._content = body
+    response.headers.update(headers or {})
+    return response
+
+
+# stands in for a requests session, answering each get with the next of a list of responses (or raising an exception)
+class StubSession:
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.sent.append(headers)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+# tests for the agency directory cached on disk
+class AgencyDirectoryTests(ClientTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.agency = FakeAgency('AG00')
+        self.server = FakeDirectory([self.agency]).start()
+        self.url = self.server.url + '/api/directory/'
+
+    def tearDown(self):
+        self.server.stop()
+        self.agency.server.server_close()
+        super().tearDown()
+
+    def test_cached_copy_used_until_its_ttl_runs_out(self):
+        directory = AgencyDirectory(self.url, requests.Session())
+        self.assertEqual(directory.agencies(), [self.agency.entry()])
+        # a new directory object reads the copy saved on disk
+        self.assertEqual(AgencyDirectory(self.url, requests.Session()).byCode('AG00'), self.agency.entry())
+        self.assertEqual(self.server.requests, 1)
+
+    def test_out_of_date_copy_revalidated_with_its_etag(self):
+        AgencyDirectory(self.url, requests.Session()).agencies()
+        directory = AgencyDirectory(self.url, requests.Session(), ttl=0)
+        self.assertEqual(directory.agencies(), [self.agency.entry()])
+        self.assertEqual((self.server.requests, self.server.notModified), (2, 1))
+        self.assertFalse(directory.stale)
+
+    def test_saved_copy_used_when_directory_cannot_be_reached(self):
+        AgencyDirectory(self.url, requests.Session()).agencies()
+        directory = AgencyDirectory(self.url, StubSession(requests.exceptions.ConnectionError()), ttl=0)
+        self.assertEqual(directory.agencies(), [self.agency.entry()])
+        self.assertTrue(directory.stale)
+
+    def test_not_modified_without_a_saved_copy_is_an_error(self):
+        directory = AgencyDirectory(self.url, StubSession(stubResponse(304)))
+        self.assertRaises(requests.exceptions.RequestException, directory.agencies)
+
+    def test_body_that_is_not_a_list_of_agencies_is_an_error(self):
+        for body in [b'', b'{not json', b'{"agency_code": "AG00"}']:
+            directory = AgencyDirectory(self.url, StubSession(stubResponse(200, body)), path=os.path.join(self.dataDir, 'other.json'))
+            self.assertRaises(requests.exceptions.RequestException, directory.agencies)
+
+    def test_list_command_reports_a_bad_directory(self):
+        client.directory_url = self.url
+        client.cachedDirectory = AgencyDirectory(self.url, StubSession(stubResponse(304)))
+        self.assertIn('Error: Unable to get the agency directory', output(client.listServices, ['list']))
+
+
+# a story in the format agencies return them
+def agencyStory(key, headline, cat='tech', reg='uk', storyDate='01/02/2024', author='writer'):
+    return {'key': str(key), 'headline': headline, 'story_cat': cat, 'story_region': reg, 'author': author,
+            'story_date': storyDate, 'story_details': 'Details of ' + headline}
+
+
+# tests for the local store of fetched stories
+class StoryStoreTests(ClientTestCase):
+
+    agency = {'agency_code': 'AG00', 'agency_name': 'AG00 News'}
+    other = {'agency_code': 'AG01', 'agency_name': 'AG01 News'}
+
+    def setUp(self):
+        super().setUp()
+        self.store = StoryStore(os.path.join(self.dataDir, 'stories.sqlite3'))
+        self.addCleanup(self.store.close)
+
+    def test_replace_only_changes_the_filter_asked_for(self):
+        self.store.replace(self.agency, '*', '*', '*', [agencyStory(1, 'Tech'), agencyStory(2, 'Art', cat='art')])
+        self.store.replace(self.other, '*', '*', '*', [agencyStory(1, 'Other tech')])
+        # the agency's tech stories are now just one new story; its art story and the other agency are untouched
+        self.store.replace(self.agency, 'tech', '*', '*', [agencyStory(3, 'New tech')])
+        stored = self.store.query(sort='headline')
+        self.assertEqual([(story['agency_code'], story['headline']) for story in stored],
+                         [('AG00', 'Art'), ('AG00', 'New tech'), ('AG01', 'Other tech')])
+        self.assertEqual(stored[0]['agency_name'], 'AG00 News')
+
+    def test_query_filters_and_sorts(self):
+        self.store.replace(self.agency, '*', '*', '*', [agencyStory(1, 'Old', storyDate='01/01/2024'), agencyStory(2, 'New', storyDate='03/01/2024'),
+                                                        agencyStory(3, 'Europe', reg='eu', storyDate='02/01/2024')])
+        self.assertEqual([story['headline'] for story in self.store.query()], ['New', 'Europe', 'Old'])
+        self.assertEqual([story['headline'] for story in self.store.query(reg='uk', date='02/01/2024')], ['New'])
+        self.assertEqual(self.store.query(agencyCodes=['AG01']), [])
+        self.assertEqual(self.store.query(cat='tech', reg='eu')[0]['story_date'], '02/01/2024')
+
+    def test_agencies_without_a_code_are_kept_by_url(self):
+        missing = {'agency_name': 'No code', 'url': 'http://one.example'}
+        null = {'agency_code': None, 'agency_name': 'Null code', 'url': 'http://two.example'}
+        self.assertTrue(self.store.replace(missing, '*', '*', '*', [agencyStory(1, 'First')]))
+        self.assertTrue(self.store.replace(null, '*', '*', '*', [agencyStory(1, 'Second')]))
+        self.assertTrue(self.store.replace(missing, 'art', '*', '*', []))
+        self.assertEqual([story['headline'] for story in self.store.query(agencyCodes=[healthKey(null)])], ['Second'])
+        self.assertEqual(len(self.store.query()), 2)
+        self.assertTrue(self.store.isFresh(healthKey(missing), 'art', '*', '*'))
+
+    def test_news_prints_agencies_without_a_code(self):
+        agencies = [{'agency_name': 'No code', 'url': 'http://one.example'}, {'agency_code': None, 'agency_name': 'Null code', 'url': 'http://two.example'}]
+        futures = {}
+        for agency, result in zip(agencies, [(404, None, 0.1), (200, {'stories': [agencyStory(1, 'Found')]}, 0.1)]):
+            futures[id(agency)] = Future()
+            futures[id(agency)].set_result(result)
+        printed = output(client.printAgencyResults, agencies, futures, '*', '*', '*')
+        self.assertIn('No news stories were found at this agency.', printed)
+        self.assertIn('Found', printed)
+
+    def test_freshness_covers_the_same_or_a_narrower_filter(self):
+        self.store.replace(self.agency, 'tech', '*', '01/01/2024', [])
+        self.assertTrue(self.store.isFresh('AG00', 'tech', '*', '01/01/2024'))
+        self.assertTrue(self.store.isFresh('AG00', 'tech', 'uk', '05/01/2024'))
+        self.assertFalse(self.store.isFresh('AG00', 'tech', '*', '*'))
+        self.assertFalse(self.store.isFresh('AG00', 'art', '*', '01/01/2024'))
+        self.assertFalse(self.store.isFresh('AG01', 'tech', '*', '01/01/2024'))
+
+    def test_freshness_runs_out_after_the_ttl(self):
+        store = StoryStore(os.path.join(self.dataDir, 'stories.sqlite3'), ttl=0)
+        self.addCleanup(store.close)
+        store.replace(self.agency, '*', '*', '*', [])
+        self.assertFalse(store.isFresh('AG00', '*', '*', '*'))
+
+    def test_badly_formed_stories_change_nothing(self):
+        self.store.replace(self.agency, '*', '*', '*', [agencyStory(1, 'Kept')])
+        self.assertFalse(self.store.replace(self.agency, '*', '*', '*', [agencyStory(2, 'Fine'), {'key': '3'}]))
+        self.assertFalse(self.store.replace(self.agency, '*', '*', '*', [agencyStory(2, 'Bad date', storyDate='2024-01-01')]))
+        self.assertEqual([story['headline'] for story in self.store.query()], ['Kept'])
+
+
+# tests for agency health and the circuit breaker
+class AgencyHealthTests(ClientTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.dataDir, 'health.json')
+        self.health = AgencyHealth(self.path)
+
+    def failRequests(self, key, times):
+        for _ in range(times):
+            self.health.update(key, None, False)
+
+    def test_breaker_opens_after_failures_in_a_row(self):
+        self.failRequests('AG00', health.FAILURE_THRESHOLD - 1)
+        self.health.update('AG00', 0.1, True)
+        self.failRequests('AG00', health.FAILURE_THRESHOLD - 1)
+        self.assertEqual(self.health.state('AG00'), 'healthy')
+        self.failRequests('AG00', 1)
+        self.assertEqual(self.health.state('AG00'), 'open')
+
+    def test_failed_probe_doubles_the_cool_down(self):
+        self.failRequests('AG00', health.FAILURE_THRESHOLD)
+        self.health.records['AG00']['open_until'] = time.time() - 1
+        self.assertEqual(self.health.state('AG00'), 'recovering')
+        self.failRequests('AG00', 1)
+        self.assertEqual(self.health.state('AG00'), 'open')
+        self.assertEqual(self.health.records['AG00']['cooldown'], 2 * health.COOLDOWN)
+        self.health.records['AG00']['open_until'] = time.time() - 1
+        self.health.update('AG00', 0.2, True)
+        self.assertEqual(self.health.state('AG00'), 'healthy')
+        self.assertEqual(self.health.records['AG00']['cooldown'], health.COOLDOWN)
+
+    def test_selection_skips_open_agencies_and_probes_recovering_ones(self):
+        agencies = [{'agency_code': 'AG%02d' % i} for i in range(6)]
+        self.failRequests('AG00', health.FAILURE_THRESHOLD)
+        self.failRequests('AG01', health.FAILURE_THRESHOLD)
+        self.health.records['AG01']['open_until'] = time.time() - 1
+        selected = [agency['agency_code'] for agency in self.health.select(agencies, 3, random.Random(1))]
+        self.assertEqual(len(selected), 3)
+        self.assertEqual(selected[0], 'AG01')
+        self.assertNotIn('AG00', selected)
+
+    def test_fast_reliable_agencies_are_preferred(self):
+        agencies = [{'agency_code': 'FAST'}, {'agency_code': 'SLOW'}]
+        self.health.update('FAST', 0.05, True)
+        self.health.update('SLOW', 2.0, True)
+        rng = random.Random(1)
+        firsts = [self.health.select(agencies, 1, rng)[0]['agency_code'] for _ in range(200)]
+        self.assertGreater(firsts.count('FAST'), 150)
+
+    def test_records_saved_between_runs(self):
+        self.failRequests('AG00', health.FAILURE_THRESHOLD)
+        self.health.save()
+        self.assertEqual(AgencyHealth(self.path).state('AG00'), 'open')
+
+    def test_agencies_without_a_code_are_kept_apart_by_url(self):
+        broken, working = {'url': 'http://broken.example'}, {'url': 'http://working.example', 'agency_code': None}
+        self.assertNotEqual(healthKey(broken), healthKey(working))
+        self.failRequests(healthKey(broken), health.FAILURE_THRESHOLD)
+        self.health.save()
+        reloaded = AgencyHealth(self.path)
+        self.assertEqual([agency['url'] for agency in reloaded.select([broken, working], 2)], ['http://working.example'])
+        self.assertNotIn('null', reloaded.records)
+
+
+# a stored story as it comes out of the store, from an agency
+def storedStory(code, key, headline, details):
+    return dict(agencyStory(key, headline), story_details=details, agency_code=code, agency_name=code + ' News')
+
+
+# tests for MinHash/LSH grouping of near-duplicate stories
+class DedupeTests(unittest.TestCase):
+
+    details = 'Ministers announced a new plan for rail services across the north of England on Monday morning'
+
+    def test_near_duplicates_from_different_agencies_are_merged(self):
+        stories = [storedStory('AG00', 1, 'Rail plan announced', self.details),
+                   storedStory('AG01', 7, 'Rail plan announced', self.details.replace('Monday', 'Tuesday')),
+                   storedStory('AG02', 3, 'Cup final result', 'The home side won the cup final after extra time')]
+        merged = mergeDuplicates(stories)
+        self.assertEqual([story['key'] for story in merged], ['1', '3'])
+        self.assertEqual(merged[0]['sources'], ['AG00 News', 'AG01 News'])
+        self.assertEqual(merged[1]['sources'], ['AG02 News'])
+
+    def test_stories_of_one_agency_are_never_merged(self):
+        first = storedStory('AG00', 1, 'Rail plan announced', self.details)
+        self.assertEqual(len(mergeDuplicates([first, dict(first, key='2')])), 2)
+
+    def test_no_chain_of_matches_joins_one_agencys_stories(self):
+        # each story is close to the next: AG00's two stories are only linked through AG01's
+        words = self.details.split()
+        stories = [storedStory('AG00', 1, 'Rail plan', ' '.join(words)),
+                   storedStory('AG01', 1, 'Rail plan', ' '.join(words[:-1] + ['evening'])),
+                   storedStory('AG00', 2, 'Rail plan', ' '.join(words[:-2] + ['this', 'evening']))]
+        merged = mergeDuplicates(stories)
+        self.assertEqual([(story['agency_code'], story['key'], story['sources']) for story in merged],
+                         [('AG00', '1', ['AG00 News', 'AG01 News']), ('AG00', '2', ['AG00 News'])])
+
+    def test_signature_agreement_estimates_similarity(self):
+        base = Sketch(storedStory('AG00', 1, 'Rail plan announced', self.details))
+        for replacement in ['Monday', 'Tuesday morning', 'a cold and windy Tuesday']:
+            other = Sketch(storedStory('AG01', 1, 'Rail plan announced', self.details.replace('Monday morning', replacement)))
+            jaccard = len(base.shingles & other.shingles) / len(base.shingles | other.shingles)
+            agreement = sum(a == b for a, b in zip(dedupe.signature(base.shingles), dedupe.signature(other.shingles))) / dedupe.NUM_HASHES
+            self.assertAlmostEqual(agreement, jaccard, delta=0.25)
+
+    def test_index_finds_close_stories_and_checks_the_threshold(self):
+        index = DuplicateIndex()
+        original = storedStory('AG00', 1, 'Rail plan announced', self.details)
+        index.add(Sketch(original))
+        close = Sketch(storedStory('AG01', 1, 'Rail plan announced', self.details.replace('Monday', 'Tuesday')))
+        self.assertEqual(index.matches(close), [original])
+        # shares its opening words, and perhaps a band, but not enough of its shingles
+        distant = Sketch(storedStory('AG01', 2, 'Rail plan', 'Ministers announced a new plan for schools'))
+        self.assertEqual(index.matches(distant), [])
+
+
+# stdout that records when each line was written
+class TimedOutput(io.StringIO):
+
+    def __init__(self):
+        super().__init__()
+        self.times = []
+
+    def write(self, text):
+        self.times.append((time.perf_counter(), text))
+        return super().write(text)
+
+
+# tests for printing the agencies of a 'news' command as they answer
+class NewsPrintingTests(ClientTestCase):
+
+    query = 'story_cat=*&story_region=*&story_date=*'
+
+    def setUp(self):
+        super().setUp()
+        self.fast, self.slow = FakeAgency('FAST').start(), FakeAgency('SLOW', delay=1.0).start()
+        self.addCleanup(self.fast.stop)
+        self.addCleanup(self.slow.stop)
+
+    def test_agencies_printed_as_they_answer(self):
+        entries = [self.fast.entry(), self.slow.entry()]
+        start = time.perf_counter()
+        futures = dict(zip(map(id, entries), client.fetchAll(entries, self.query)))
+        with contextlib.redirect_stdout(TimedOutput()) as printed:
+            client.printAgencyResults(entries, futures, '*', '*', '*')
+        fastAt = next(at for at, text in printed.times if 'From FAST News' in text)
+        slowAt = next(at for at, text in printed.times if 'From SLOW News' in text)
+        self.assertLess(fastAt - start, 0.5)
+        self.assertGreater(slowAt - start, 0.9)
+
+    def test_copies_of_printed_stories_are_named_not_printed(self):
+        self.slow.delay = 0
+        self.slow.stories = [dict(story, key=str(10 + i)) for i, story in enumerate(self.fast.stories)]
+        self.slow.stories.append(dict(self.fast.stories[0], key='20', headline='Something else', story_details='Unrelated news from elsewhere'))
+        entries = [self.fast.entry(), self.slow.entry()]
+        futures = dict(zip(map(id, entries), client.fetchAll(entries, self.query)))
+        printed = output(client.printAgencyResults, entries, futures, '*', '*', '*')
+        slowPart = printed[printed.index('From SLOW News'):]
+        self.assertIn('FAST story 0 (id: 10) - also reported by FAST News above', slowPart)
+        self.assertNotIn('Details of FAST story 0', slowPart)
+        self.assertIn('Unrelated news from elsewhere', slowPart)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# the stories of a page in the columnar format, as an agency sends them
+def columnarStories(stories):
+    columns = {}
+    for field in formats.FIELDS:
+        column = [story[field] for story in stories]
+        if field in formats.DICTIONARY_FIELDS:
+            values = sorted(set(column))
+            column = {'values': values, 'indexes': [values.index(value) for value in column]}
+        columns[field] = column
+    return columns
+
+
+# tests for decoding story responses in MessagePack, the columnar format and JSON
+@unittest.skipIf(formats.msgpack is None, 'msgpack is not installed')
+class FormatsTests(ClientTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stories = [dict(agencyStory(1, 'First', 'pol', 'uk'), key=1), dict(agencyStory(2, 'Second', 'art', 'uk'), key=2),
+                        dict(agencyStory(3, 'Third', 'pol', 'w', author='other'), key=3)]
+        self.expected = [dict(story, key=str(story['key'])) for story in self.stories]
+
+    def test_columnar(self):
+        content = formats.msgpack.packb({'stories': columnarStories(self.stories), 'next': None})
+        payload = formats.decode(formats.COLUMNAR, content)
+        self.assertEqual(payload, {'stories': self.expected, 'next': None})
+
+    def test_msgpack(self):
+        content = formats.msgpack.packb({'stories': self.stories})
+        self.assertEqual(formats.decode(formats.MSGPACK + '; charset=binary', content)['stories'], self.stories)
+        self.assertEqual(formats.decode('application/x-msgpack', content)['stories'], self.stories)
+
+    def test_json(self):
+        content = json.dumps({'stories': self.expected}).encode()
+        self.assertEqual(formats.decode('application/json; charset=utf-8', content)['stories'], self.expected)
+        self.assertEqual(formats.decode('', content)['stories'], self.expected)
+
+    def test_bad_bodies(self):
+        columns = columnarStories(self.stories)
+        del columns['headline']
+        shortIndexes = columnarStories(self.stories)
+        shortIndexes['author']['values'] = []
+        for contentType, content in [(formats.COLUMNAR, formats.msgpack.packb({'stories': columns})),
+                                     (formats.COLUMNAR, formats.msgpack.packb({'stories': shortIndexes})),
+                                     (formats.COLUMNAR, formats.msgpack.packb([1, 2])),
+                                     (formats.MSGPACK, b'\xc1'),
+                                     ('application/json', b'{"stories": '),
+                                     ('application/json', b'\xff\xfe')]:
+            with self.assertRaises(ValueError, msg=contentType + ' ' + repr(content)):
+                formats.decode(contentType, content)
+
+    def test_fetch_asks_for_columnar_and_falls_back_to_json(self):
+        content = json.dumps({'stories': self.expected}).encode()
+        session = client.threadLocal.session = StubSession(stubResponse(406), stubResponse(200, content, {'Content-Type': 'application/json'}))
+        self.addCleanup(delattr, client.threadLocal, 'session')
+        status, payload, latency = client.fetchStories({'url': 'http://agency.example'}, 'story_cat=*&story_region=*&story_date=*')
+        self.assertEqual((status, payload['stories']), (200, self.expected))
+        self.assertEqual([headers['Accept'] for headers in session.sent], [formats.ACCEPT, 'application/json'])
+        self.assertTrue(formats.ACCEPT.startswith(formats.COLUMNAR))
+
+    def test_fetch_reports_a_bad_body(self):
+        client.threadLocal.session = StubSession(stubResponse(200, b'\xc1', {'Content-Type': formats.COLUMNAR}))
+        self.addCleanup(delattr, client.threadLocal, 'session')
+        status, message, latency = client.fetchStories({'url': 'http://agency.example'}, 'story_cat=*&story_region=*&story_date=*')
+        self.assertIsNone(status)
+        self.assertEqual(message, "This news agency hasn't returned the appropriate format.")